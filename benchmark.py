@@ -0,0 +1,222 @@
+"""Benchmarks for the counting code, run against synthetic corpora of several
+sizes (see synth_corpus.py).
+
+    python benchmark.py --save-baseline   # record baselines for this machine
+    python benchmark.py                   # compare against them
+
+For each corpus scale (number of comments), reports the throughput of each
+benchmark (comments, or for matricize_df dataframe rows, per second; median of
+--repeat runs) and its peak memory use (as measured by tracemalloc, in a
+separate run). Exits with status 1 if any throughput has dropped, or peak
+memory grown, by more than --tolerance relative to the stored baseline. A
+throughput drop only fails the run if it was measured over at least
+MIN_GATED_RUNS runs or MIN_GATED_SECONDS; otherwise it's too noisy to trust,
+and is only warned about.
+
+Corpora are generated on first use and kept in --corpus-dir, so later runs
+measure the same data. Baselines are only meaningful on the machine they were
+recorded on.
+"""
+import os
+import sys
+import json
+import time
+import statistics
+import argparse
+import tracemalloc
+
+import pandas as pd
+
+import compute_counts
+from compute_counts import load_comments, load_compact_comments, is_valid_comment, count_for_term, sub_counts_for_term, CountingEngine
+from heatmap import matricize_df
+from reddit_counts import prefixes, suffixes
+import synth_corpus
+
+DEFAULT_SCALES = [10000, 50000, 200000]
+DEFAULT_CORPUS_DIR = 'bench_corpus'
+BASELINE_PATH = 'benchmark_baselines.json'
+DEFAULT_TOLERANCE = .25
+DEFAULT_REPEAT = 5
+# A throughput regression only fails the run if the measurement took at least
+# this many runs, or this many seconds in total.
+MIN_GATED_RUNS = 5
+MIN_GATED_SECONDS = 2.0
+# matricize_df is fast, and its input doesn't grow with the corpus, so run it
+# this many times per measurement.
+MATRICIZE_REPS = 20
+
+def bench_load_comments(terms):
+    n = 0
+    for term in terms:
+        comments, _ = load_comments(term)
+        n += len(comments)
+    return n
+
+def bench_load_compact_comments(terms):
+    n = 0
+    for term in terms:
+        comments, _ = load_compact_comments(term)
+        n += len(comments)
+    return n
+
+def bench_is_valid_comment(pairs):
+    for comment, term in pairs:
+        is_valid_comment(comment, term)
+    return len(pairs)
+
+def bench_count_for_term(terms):
+    engine = CountingEngine(terms)
+    for term in terms:
+        count_for_term(term, raw=False, engine=engine)
+    # count_for_term streams each of the term's comments once
+    return sum(nloaded.values())
+
+def bench_sub_counts_for_term(terms):
+    engine = CountingEngine(terms)
+    for term in terms:
+        sub_counts_for_term(term, engine)
+    return sum(nloaded.values())
+
+def bench_matricize_df(df):
+    for _ in range(MATRICIZE_REPS):
+        matricize_df(df, sort='log')
+    return MATRICIZE_REPS * len(df)
+
+# Number of comments loaded per term in the current corpus, set by run_scale
+nloaded = {}
+
+def measure(fn, arg, repeat):
+    """Return a dict of the throughput (in items/sec, from the median of
+    repeat runs) and peak memory (in MB) of calling fn(arg), where fn returns
+    the number of items processed, plus the number of runs and their total
+    time in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        n = fn(arg)
+        times.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    fn(arg)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return dict(throughput=n / statistics.median(times), peak_mb=peak / 2**20,
+            runs=len(times), seconds=sum(times),
+    )
+
+def corpus_path(corpus_dir, scale):
+    return os.path.join(corpus_dir, f'n{scale}')
+
+def ensure_corpus(corpus_dir, scale):
+    path = corpus_path(corpus_dir, scale)
+    done_marker = os.path.join(path, '.done')
+    if not os.path.exists(done_marker):
+        sys.stderr.write(f"Generating corpus of {scale} comments in {path}\n")
+        synth_corpus.generate(path, scale)
+        open(done_marker, 'w').close()
+    return path
+
+def run_scale(corpus_dir, scale, repeat):
+    """Run all benchmarks on the corpus of the given scale. Return a dict
+    mapping benchmark name to dict of throughput and peak_mb.
+    """
+    path = ensure_corpus(corpus_dir, scale)
+    cwd = os.getcwd()
+    os.chdir(path)
+    # Data paths are relative to the working directory
+    compute_counts._ingest_manifest.cache_clear()
+    try:
+        terms = compute_counts.all_terms()
+        nloaded.clear()
+        pairs = []
+        for term in terms:
+            comments, _ = load_comments(term)
+            nloaded[term] = len(comments)
+            pairs += [(comment, term) for comment in comments]
+        df = pd.DataFrame(dict(
+            pre=[pre for pre in prefixes for _ in suffixes],
+            suff=[suff for _ in prefixes for suff in suffixes],
+            count=[nloaded[term] for term in terms],
+        ))
+        benches = [
+            ('load_comments', bench_load_comments, terms),
+            ('load_compact_comments', bench_load_compact_comments, terms),
+            ('is_valid_comment', bench_is_valid_comment, pairs),
+            ('count_for_term', bench_count_for_term, terms),
+            ('sub_counts_for_term', bench_sub_counts_for_term, terms),
+            ('matricize_df', bench_matricize_df, df),
+        ]
+        results = {}
+        for name, fn, arg in benches:
+            res = results[name] = measure(fn, arg, repeat)
+            print(f"{scale:>9} {name:<22} {res['throughput']:>14,.0f}/s {res['peak_mb']:>10.1f} MB")
+        return results
+    finally:
+        os.chdir(cwd)
+
+def regressions(results, baselines, tolerance):
+    """Return a tuple of lists of descriptions of results that are worse than
+    their baselines by more than the given tolerance (a fraction): those that
+    should fail the run, and throughput drops measured too briefly to be
+    trusted (see MIN_GATED_RUNS).
+    """
+    problems = []
+    warnings = []
+    for scale, benches in results.items():
+        for name, res in benches.items():
+            base = baselines.get(scale, {}).get(name)
+            if base is None:
+                continue
+            if res['throughput'] < base['throughput'] * (1 - tolerance):
+                problem = f"{name} @ {scale}: throughput {res['throughput']:,.0f}/s < baseline {base['throughput']:,.0f}/s"
+                if res['runs'] >= MIN_GATED_RUNS or res['seconds'] >= MIN_GATED_SECONDS:
+                    problems.append(problem)
+                else:
+                    warnings.append(f"{problem} (only {res['runs']} runs in {res['seconds']:.2f}s)")
+            if res['peak_mb'] > base['peak_mb'] * (1 + tolerance):
+                problems.append(f"{name} @ {scale}: peak memory {res['peak_mb']:.1f} MB > baseline {base['peak_mb']:.1f} MB")
+    return problems, warnings
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the counting code on synthetic corpora")
+    parser.add_argument('--scales', type=int, nargs='+', default=DEFAULT_SCALES,
+            help="Corpus sizes (numbers of comments) to benchmark",
+    )
+    parser.add_argument('--corpus-dir', default=DEFAULT_CORPUS_DIR)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true',
+            help="Record the results as the new baselines, rather than comparing against the old ones",
+    )
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+            help="Fractional slowdown (or memory growth) at which to fail",
+    )
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    args = parser.parse_args()
+
+    print(f"{'scale':>9} {'benchmark':<22} {'throughput':>16} {'peak mem':>13}")
+    # Keyed by str(scale), to survive a round trip through json
+    results = {str(scale): run_scale(args.corpus_dir, scale, args.repeat) for scale in args.scales}
+    if args.save_baseline:
+        try:
+            with open(args.baseline) as f:
+                baselines = json.load(f)
+        except FileNotFoundError:
+            baselines = {}
+        baselines.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2)
+        sys.stderr.write(f"Saved baselines to {args.baseline}\n")
+        sys.exit(0)
+    try:
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    except FileNotFoundError:
+        sys.stderr.write(f"No baselines at {args.baseline}. Run with --save-baseline to record some.\n")
+        sys.exit(0)
+    problems, warnings = regressions(results, baselines, args.tolerance)
+    for warning in warnings:
+        sys.stderr.write(f"WARNING: possible regression, too noisy to fail on: {warning}\n")
+    for problem in problems:
+        sys.stderr.write(f"REGRESSION: {problem}\n")
+    sys.exit(1 if problems else 0)
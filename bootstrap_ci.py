@@ -0,0 +1,97 @@
+"""Bootstrap confidence intervals for the counts of sampled terms.
+
+The count for a sampled term is extrapolated from the comments on a sample of
+days of each year (see sampled_counts.py), so it's uncertain. We get an
+interval for it by resampling, with replacement, the days sampled within each
+year (keeping the number of days per year fixed) and recomputing the
+extrapolated count, many times over.
+
+This is done for all sampled terms at once. The per-day counts are held in a
+terms x days matrix (SampledDayCounts), which is flattened to a vector of the
+sampled (term, day) cells, grouped into (term, year) strata. A bootstrap
+replicate then needs only one random index per cell, and a sum per term, so
+batches of replicates are computed with a few numpy operations.
+"""
+import numpy as np
+
+DEFAULT_REPLICATES = 1000
+DEFAULT_CONFIDENCE = .95
+# Max number of random draws (replicates x sampled cells) per batch
+BATCH_SIZE = 2**22
+
+class SampledDayCounts:
+    """Number of (valid) comments per term on each sampled day.
+
+    days: (D, 2) int array of (year, start timestamp) per column, sorted
+    counts: (T, D) int array of comments per term and day
+    sampled: (T, D) bool array of whether the day was sampled for the term
+    weights: (T, D) float array of how many comments each sampled comment
+        stands for (constant within each year, for a given term)
+    """
+
+    def __init__(self, terms, days, counts, sampled, weights):
+        self.terms = list(terms)
+        self.days = np.asarray(days, dtype=np.int64).reshape(-1, 2)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.sampled = np.asarray(sampled, dtype=bool)
+        self.weights = np.asarray(weights, dtype=np.float64)
+
+    @classmethod
+    def build(cls, term_days):
+        """Build from a dict mapping each term to a list of (year, start, count,
+        weight) tuples, one per sampled day.
+        """
+        terms = list(term_days)
+        days = sorted({(year, start) for rows in term_days.values() for year, start, _, _ in rows})
+        col = {day: j for j, day in enumerate(days)}
+        shape = (len(terms), len(days))
+        counts = np.zeros(shape, dtype=np.int64)
+        sampled = np.zeros(shape, dtype=bool)
+        weights = np.zeros(shape)
+        for i, term in enumerate(terms):
+            for year, start, count, weight in term_days[term]:
+                j = col[(year, start)]
+                counts[i, j] = count
+                sampled[i, j] = True
+                weights[i, j] = weight
+        return cls(terms, days, counts, sampled, weights)
+
+    def estimates(self):
+        """Return the extrapolated count for each term."""
+        return (self.counts * self.weights).sum(axis=1)
+
+    def bootstrap(self, replicates=DEFAULT_REPLICATES, seed=1337):
+        """Return a (replicates, T) array of bootstrapped counts."""
+        rng = np.random.default_rng(seed)
+        term_idx, day_idx = np.nonzero(self.sampled)
+        values = self.counts[term_idx, day_idx] * self.weights[term_idx, day_idx]
+        years = self.days[day_idx, 0]
+        totals = np.zeros((replicates, len(self.terms)))
+        if len(values) == 0:
+            return totals
+        # Cells come grouped by term, then sorted by day, so each (term, year)
+        # stratum is a contiguous run
+        new_stratum = np.r_[True, (term_idx[1:] != term_idx[:-1]) | (years[1:] != years[:-1])]
+        stratum_starts = np.flatnonzero(new_stratum)
+        stratum_sizes = np.diff(np.r_[stratum_starts, len(values)])
+        stratum = np.cumsum(new_stratum) - 1
+        offsets = stratum_starts[stratum]
+        sizes = stratum_sizes[stratum]
+        term_starts = np.flatnonzero(np.r_[True, term_idx[1:] != term_idx[:-1]])
+        present = term_idx[term_starts]
+        batch = max(1, BATCH_SIZE // len(values))
+        for b in range(0, replicates, batch):
+            n = min(batch, replicates - b)
+            # For each cell, draw a random cell from the same stratum
+            draws = offsets + (rng.random((n, len(values))) * sizes).astype(np.int64)
+            totals[b:b+n, present] = np.add.reduceat(values[draws], term_starts, axis=1)
+        return totals
+
+    def intervals(self, confidence=DEFAULT_CONFIDENCE, replicates=DEFAULT_REPLICATES, seed=1337):
+        """Return a tuple of arrays (lo, hi) giving a percentile bootstrap
+        confidence interval for each term's count.
+        """
+        alpha = (1 - confidence) / 2
+        totals = self.bootstrap(replicates, seed)
+        lo, hi = np.quantile(totals, [alpha, 1 - alpha], axis=0)
+        return lo, hi
@@ -0,0 +1,267 @@
+"""SQLite store holding each downloaded comment once, as an alternative to the
+per-term files in comment_data/ and sampled_comment_data/ (where a comment
+containing several of our compounds is stored once per compound).
+
+Tables:
+    comments: one row per comment, keyed by permalink (see
+        comment_store.comment_key), with the full comment json plus indexed
+        subreddit, score and created_utc columns.
+    comments_fts: full text (FTS5) index of comment bodies.
+    term_comments: links each term to its comments, per source directory
+        (e.g. 'comment_data' or 'sampled_comment_data'), in download order.
+    cursors: download progress per (term, source), as in the files' cursors.
+
+To use it, import the existing files with
+    python comment_db.py import
+and set the COMMENT_DB environment variable to the path of the database
+(comments.sqlite by default). compute_counts.py then reads comments from it,
+and reddit_counts.py and sampled_counts.py write new downloads into it.
+Cross-term queries can be run directly, e.g.
+    db = CommentDB('comments.sqlite')
+    db.search('"dumb ass"', subreddit='nba')
+"""
+import os
+import sys
+import json
+import sqlite3
+import argparse
+
+import comment_store
+
+DEFAULT_DB_PATH = 'comments.sqlite'
+# If set, the path of a CommentDB that the scripts should use instead of the per-term files
+DB_ENV_VAR = 'COMMENT_DB'
+DB_PATH = os.environ.get(DB_ENV_VAR)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS comments (
+    id INTEGER PRIMARY KEY,
+    -- comment_store.comment_key: permalink (or id). NULL for comments having
+    -- neither, which are stored once per time they're added.
+    key TEXT UNIQUE,
+    body TEXT,
+    subreddit TEXT,
+    score INTEGER,
+    created_utc INTEGER,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS comments_subreddit ON comments(subreddit);
+CREATE INDEX IF NOT EXISTS comments_score ON comments(score);
+CREATE INDEX IF NOT EXISTS comments_created_utc ON comments(created_utc);
+CREATE VIRTUAL TABLE IF NOT EXISTS comments_fts USING fts5(body, content='comments', content_rowid='id');
+CREATE TABLE IF NOT EXISTS term_comments (
+    term TEXT NOT NULL,
+    source TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    comment_id INTEGER NOT NULL REFERENCES comments(id),
+    PRIMARY KEY (term, source, seq)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS term_comments_comment ON term_comments(comment_id);
+CREATE TABLE IF NOT EXISTS cursors (
+    term TEXT NOT NULL,
+    source TEXT NOT NULL,
+    cursor TEXT NOT NULL,
+    PRIMARY KEY (term, source)
+);
+"""
+
+class CommentDB:
+
+    def __init__(self, path=DEFAULT_DB_PATH):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def has_term(self, term, source):
+        """Return whether the given term's comments from the given source
+        directory have finished downloading (i.e. its cursor is marked done,
+        as in comment_store.is_finished).
+        """
+        cursor = self.read_cursor(term, source)
+        return cursor is not None and bool(cursor.get('done'))
+
+    def read_cursor(self, term, source):
+        row = self.conn.execute("SELECT cursor FROM cursors WHERE term = ? AND source = ?",
+                (term, source)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _write_cursor(self, term, source, cursor):
+        self.conn.execute("INSERT OR REPLACE INTO cursors (term, source, cursor) VALUES (?, ?, ?)",
+                (term, source, json.dumps(cursor)))
+
+    def _insert_comment(self, comment):
+        """Insert the given comment if we don't have it already. Return its id."""
+        key = comment_store.comment_key(comment)
+        cur = self.conn.execute("""INSERT OR IGNORE INTO comments (key, body, subreddit, score, created_utc, data)
+                VALUES (?, ?, ?, ?, ?, ?)""",
+                (key, comment.get('body'), comment.get('subreddit'), comment.get('score'),
+                    comment.get('created_utc'), json.dumps(comment)))
+        if cur.rowcount:
+            self.conn.execute("INSERT INTO comments_fts (rowid, body) VALUES (?, ?)",
+                    (cur.lastrowid, comment.get('body')))
+            return cur.lastrowid
+        # (A comment without a key is never ignored, so never gets here)
+        return self.conn.execute("SELECT id FROM comments WHERE key = ?", (key,)).fetchone()[0]
+
+    def add(self, term, source, comments, cursor):
+        """Append the given comments to those stored for term from source, and
+        record the given cursor, in a single transaction.
+        """
+        with self.conn:
+            seq = self.count(term, source)
+            for comment in comments:
+                self.conn.execute("INSERT INTO term_comments (term, source, seq, comment_id) VALUES (?, ?, ?, ?)",
+                        (term, source, seq, self._insert_comment(comment)))
+                seq += 1
+            self._write_cursor(term, source, cursor)
+
+    def count(self, term, source):
+        return self.conn.execute("SELECT COUNT(*) FROM term_comments WHERE term = ? AND source = ?",
+                (term, source)).fetchone()[0]
+
+    def term_signature(self, term, source):
+        """Return a dict identifying the current state of the comments stored
+        for the given term and source, and their cursor. Comments are never
+        modified once stored, and a term's links to them are only appended to
+        (or replaced wholesale on import), so this changes whenever they do,
+        without reading any comments.
+        """
+        rows, last_seq, ids = self.conn.execute("""SELECT COUNT(*), MAX(seq), TOTAL(comment_id)
+                FROM term_comments WHERE term = ? AND source = ?""", (term, source)).fetchone()
+        return dict(rows=rows, last_seq=last_seq, ids=int(ids), cursor=self.read_cursor(term, source))
+
+    def iter_comments(self, term, source):
+        """Yield the comments stored for the given term and source, in the order
+        they were added.
+        """
+        rows = self.conn.execute("""SELECT c.data FROM term_comments tc JOIN comments c ON c.id = tc.comment_id
+                WHERE tc.term = ? AND tc.source = ? ORDER BY tc.seq""", (term, source))
+        for (data,) in rows:
+            yield json.loads(data)
+
+    def search(self, match, subreddit=None, min_score=None, start=None, end=None, limit=None):
+        """Return a list of comments whose bodies match the given FTS5 query,
+        optionally restricted by subreddit, minimum score, and [start, end)
+        range of created_utc.
+        """
+        sql = "SELECT c.data FROM comments_fts JOIN comments c ON c.id = comments_fts.rowid WHERE comments_fts MATCH ?"
+        params = [match]
+        for clause, value in [('c.subreddit = ?', subreddit), ('c.score >= ?', min_score),
+                ('c.created_utc >= ?', start), ('c.created_utc < ?', end)]:
+            if value is not None:
+                sql += ' AND ' + clause
+                params.append(value)
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return [json.loads(data) for (data,) in self.conn.execute(sql, params)]
+
+    def terms_of(self, comment):
+        """Return the set of terms the given comment is stored under (empty if
+        it has no comment_key to look it up by).
+        """
+        rows = self.conn.execute("""SELECT DISTINCT tc.term FROM term_comments tc JOIN comments c ON c.id = tc.comment_id
+                WHERE c.key = ?""", (comment_store.comment_key(comment),))
+        return {term for (term,) in rows}
+
+    def import_file(self, term, source, path):
+        """Import the comments in the given per-term file (and its cursor)."""
+        comments = list(comment_store.iter_comments(path))
+        cursor = comment_store.read_cursor(path)
+        if cursor is None:
+            # Legacy json files were written all at once, by older versions of the downloaders
+            cursor = dict(count=len(comments), done=comment_store.is_finished(path))
+        cursor.pop('offset', None)
+        self.conn.execute("DELETE FROM term_comments WHERE term = ? AND source = ?", (term, source))
+        self.add(term, source, comments, cursor)
+
+class DbCommentWriter:
+    """Like comment_store.CommentWriter, but appending to a CommentDB. Each
+    page of comments is committed along with the cursor in one transaction.
+    """
+
+    def __init__(self, db, term, source):
+        self.db = db
+        self.term = term
+        self.source = source
+        self.cursor = db.read_cursor(term, source)
+        if self.cursor is None:
+            self.cursor = dict(count=0)
+            with db.conn:
+                db._write_cursor(term, source, self.cursor)
+
+    @property
+    def count(self):
+        return self.cursor['count']
+
+    def append(self, comments, **cursor_fields):
+        cursor = dict(self.cursor, **cursor_fields)
+        cursor['count'] += len(comments)
+        self.db.add(self.term, self.source, comments, cursor)
+        self.cursor = cursor
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Opened lazily, once per process (connections mustn't be shared with forked workers)
+_default_db = (None, None)
+
+def default_db():
+    """Return the CommentDB at the path given by the COMMENT_DB environment
+    variable, or None if it's unset.
+    """
+    global _default_db
+    if not DB_PATH:
+        return None
+    pid, db = _default_db
+    if pid != os.getpid():
+        db = CommentDB(DB_PATH)
+        _default_db = (os.getpid(), db)
+    return db
+
+def import_dirs(db, dirnames):
+    for source in dirnames:
+        n = 0
+        for fname in sorted(os.listdir(source)):
+            if fname.endswith(comment_store.SAMPLE_INFO_EXT):
+                continue
+            term, ext = os.path.splitext(fname)
+            if ext == comment_store.LEGACY_EXT and os.path.exists(comment_store.comments_path(source, term)):
+                # Superseded by the jsonl version
+                continue
+            if ext in (comment_store.JSONL_EXT, comment_store.LEGACY_EXT):
+                db.import_file(term, source, os.path.join(source, fname))
+                n += 1
+        sys.stderr.write(f"Imported {n} terms from {source}\n")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build or query the deduplicated comment database")
+    parser.add_argument('--db', default=DB_PATH or DEFAULT_DB_PATH)
+    subparsers = parser.add_subparsers(dest='cmd', required=True)
+    import_parser = subparsers.add_parser('import', help="Import per-term comment files")
+    import_parser.add_argument('dirs', nargs='*', default=['comment_data', 'sampled_comment_data'])
+    search_parser = subparsers.add_parser('search', help="Full text search of comment bodies")
+    search_parser.add_argument('query')
+    search_parser.add_argument('--sub')
+    search_parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+
+    db = CommentDB(args.db)
+    if args.cmd == 'import':
+        import_dirs(db, args.dirs)
+        ncomments, = db.conn.execute("SELECT COUNT(*) FROM comments").fetchone()
+        nlinks, = db.conn.execute("SELECT COUNT(*) FROM term_comments").fetchone()
+        print(f"{ncomments} unique comments ({nlinks} term-comment links) in {args.db}")
+    elif args.cmd == 'search':
+        for comment in db.search(args.query, subreddit=args.sub, limit=args.limit):
+            print(f"{comment['permalink']}\t{sorted(db.terms_of(comment))}\t{comment['body'][:100]!r}")
+    db.close()
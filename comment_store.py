@@ -0,0 +1,221 @@
+"""Reading and writing per-term comment data.
+
+Comments for a term are stored as newline-delimited json, one comment per
+line (e.g. comment_data/poophead.jsonl). Downloaders append comments a page at
+a time, flushing each page to disk and then recording their progress in a
+small sidecar cursor file (e.g. comment_data/poophead.cursor). The cursor holds
+the byte offset of the end of the last complete page, so if a download crashes
+partway through writing a page, the partial page is truncated away when the
+download resumes.
+
+Older data stored as a single json array per term (e.g. comment_data/poophead.json)
+is still readable, though it has to be parsed all at once.
+
+Comments ingested from monthly Reddit dump files (see ingest_dumps.py) are
+stored as one shard per (term, month), e.g. dump_comment_data/poophead/RC_2015-06.jsonl,
+with a manifest recording which months and terms have been ingested.
+
+If the COMMENT_DB environment variable is set, open_writer and
+iter_term_comments use the deduplicated database in comment_db.py instead of
+per-term files.
+"""
+import os
+import json
+
+JSONL_EXT = '.jsonl'
+LEGACY_EXT = '.json'
+CURSOR_EXT = '.cursor'
+# Sidecar describing how a term's sampled data was sampled (see sampled_counts.fetch_adaptive)
+SAMPLE_INFO_EXT = '.sample.json'
+
+def comment_key(comment):
+    """Return the key identifying the given comment across terms and sources:
+    its permalink (or id), or None if it has neither. Distinct comments can
+    have the same body, so it's never used in their place.
+    """
+    return comment.get('permalink') or comment.get('id')
+
+def comments_path(dirname, term):
+    return os.path.join(dirname, term + JSONL_EXT)
+
+def find_comments_file(dirname, term):
+    """Return the path to the file holding comments for the given term in the
+    given directory (preferring jsonl over the legacy format), or None if there
+    isn't one.
+    """
+    for ext in (JSONL_EXT, LEGACY_EXT):
+        path = os.path.join(dirname, term + ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+def is_finished(path):
+    """Return whether the given comment file holds a finished download: one
+    whose cursor has been marked done, or a legacy json file (which older
+    versions of the downloaders only wrote once they were done).
+    """
+    if path.endswith(LEGACY_EXT):
+        return True
+    cursor = read_cursor(path)
+    return cursor is not None and bool(cursor.get('done'))
+
+def iter_comments(path):
+    """Yield comment dicts from the given jsonl (or legacy json) file.
+    """
+    if path.endswith(LEGACY_EXT):
+        with open(path) as f:
+            yield from json.load(f)
+        return
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def cursor_path(path):
+    return os.path.splitext(path)[0] + CURSOR_EXT
+
+def read_cursor(path):
+    """Return the cursor dict for the given comment file, or None if no progress
+    has been recorded.
+    """
+    try:
+        with open(cursor_path(path)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def write_cursor(path, cursor):
+    # Write to a temp file and rename, so the cursor is never seen half-written.
+    cpath = cursor_path(path)
+    tmp = cpath + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(cursor, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, cpath)
+
+def sample_info_path(dirname, term):
+    return os.path.join(dirname, term + SAMPLE_INFO_EXT)
+
+def read_sample_info(dirname, term):
+    """Return the sampling info dict for the given term, or None if there
+    isn't any (e.g. because it was sampled with fixed intervals).
+    """
+    try:
+        with open(sample_info_path(dirname, term)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def write_sample_info(dirname, term, info):
+    path = sample_info_path(dirname, term)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(info, f)
+    os.replace(tmp, path)
+
+INGEST_MANIFEST = '_ingested.json'
+
+def read_ingest_manifest(dirname):
+    """Return the manifest of dump ingestion into the given directory (a dict
+    with keys 'terms' and 'months'), or None if nothing has been ingested.
+    """
+    try:
+        with open(os.path.join(dirname, INGEST_MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def write_ingest_manifest(dirname, manifest):
+    path = os.path.join(dirname, INGEST_MANIFEST)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, path)
+
+def shard_path(dirname, term, month):
+    return os.path.join(dirname, term, month + JSONL_EXT)
+
+def find_dump_shards(dirname, term, manifest=None):
+    """Return a list of paths to shards of dump data for the given term (which
+    may be empty, if no ingested comments matched), or None if the term wasn't
+    covered by dump ingestion.
+    """
+    if manifest is None:
+        manifest = read_ingest_manifest(dirname)
+    if manifest is None or term not in manifest['terms']:
+        return None
+    return [shard_path(dirname, term, month) for month in sorted(manifest['months'])
+            if os.path.exists(shard_path(dirname, term, month))]
+
+class CommentWriter:
+    """Appends comments to a term's jsonl file a page at a time.
+
+    Usage:
+        with CommentWriter(path) as writer:
+            before = writer.cursor.get('created_utc', END_TIMESTAMP)
+            ...
+            writer.append(page, created_utc=page[-1]['created_utc'])
+
+    Any keyword args passed to append are saved to the cursor, along with the
+    file offset and total number of comments written so far.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.cursor = read_cursor(path) or dict(offset=0, count=0)
+        self.f = open(path, 'ab')
+        # Drop anything written after the last recorded page.
+        self.f.truncate(self.cursor['offset'])
+
+    @property
+    def count(self):
+        return self.cursor['count']
+
+    def append(self, comments, **cursor_fields):
+        for comment in comments:
+            self.f.write(json.dumps(comment).encode('utf-8') + b'\n')
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.cursor.update(cursor_fields)
+        self.cursor['offset'] = self.f.tell()
+        self.cursor['count'] += len(comments)
+        write_cursor(self.path, self.cursor)
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_writer(dirname, term):
+    """Return a writer for the given term's comments in dirname: a CommentWriter,
+    or a comment_db.DbCommentWriter if COMMENT_DB is set.
+    """
+    import comment_db
+    db = comment_db.default_db()
+    if db is not None:
+        return comment_db.DbCommentWriter(db, term, dirname)
+    return CommentWriter(comments_path(dirname, term))
+
+def stored_cursor(dirname, term):
+    """Return the cursor recorded for the given term's comments in dirname
+    (by open_writer), or None if there isn't one.
+    """
+    import comment_db
+    db = comment_db.default_db()
+    if db is not None:
+        return db.read_cursor(term, dirname)
+    path = comments_path(dirname, term)
+    return read_cursor(path) if os.path.exists(path) else None
+
+def iter_term_comments(dirname, term):
+    """Yield the comments written for the given term by open_writer(dirname, term)."""
+    import comment_db
+    db = comment_db.default_db()
+    if db is not None:
+        return db.iter_comments(term, dirname)
+    return iter_comments(comments_path(dirname, term))
@@ -0,0 +1,127 @@
+"""Compact in-memory representation of a term's comments, for holding many
+comments at once (e.g. several heavily sampled terms).
+
+A comment dict as parsed from json costs a few hundred bytes of overhead on top
+of its body. CompactComments instead stores only the fields the counting code
+needs, column-wise: bodies and permalinks as lists of strings, subreddits as
+small integer ids (interned in a SubredditTable shared across terms), and
+timestamps and scores in typed arrays. Comments are added one at a time as
+they're parsed, so the full dicts never accumulate.
+
+Indexing gives a CommentView, which supports the subset of the dict interface
+used by is_valid_comment and friends (comment['body'], comment.get('permalink'), ...).
+"""
+from array import array
+
+import numpy as np
+
+class SubredditTable:
+    """Two-way mapping between subreddit names and small integer ids."""
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+
+    def intern(self, name):
+        i = self.ids.get(name)
+        if i is None:
+            i = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return i
+
+    def __len__(self):
+        return len(self.names)
+
+class CommentView:
+    __slots__ = ('comments', 'i')
+
+    def __init__(self, comments, i):
+        self.comments = comments
+        self.i = i
+
+    def __getitem__(self, field):
+        return self.comments.field(field, self.i)
+
+    def get(self, field, default=None):
+        try:
+            return self[field]
+        except KeyError:
+            return default
+
+class CompactComments:
+
+    FIELDS = ('body', 'permalink', 'subreddit', 'created_utc', 'score')
+
+    def __init__(self, subreddits=None):
+        self.subreddits = subreddits if subreddits is not None else SubredditTable()
+        self.bodies = []
+        self.permalinks = []
+        self.sub_ids = array('i')
+        self.created_utc = array('q')
+        self.scores = array('i')
+
+    @classmethod
+    def from_iter(cls, comments, subreddits=None):
+        compact = cls(subreddits)
+        compact.extend(comments)
+        return compact
+
+    def extend(self, comments):
+        # Same as calling append on each comment, minus the attribute lookups
+        add_body, add_permalink = self.bodies.append, self.permalinks.append
+        add_sub_id, add_created_utc, add_score = self.sub_ids.append, self.created_utc.append, self.scores.append
+        intern = self.subreddits.intern
+        for comment in comments:
+            add_body(comment['body'])
+            add_permalink(comment.get('permalink'))
+            add_sub_id(intern(comment['subreddit']))
+            add_created_utc(comment['created_utc'])
+            add_score(comment.get('score') or 0)
+
+    def append(self, comment):
+        self.bodies.append(comment['body'])
+        self.permalinks.append(comment.get('permalink'))
+        self.sub_ids.append(self.subreddits.intern(comment['subreddit']))
+        self.created_utc.append(comment['created_utc'])
+        self.scores.append(comment.get('score') or 0)
+
+    def field(self, field, i):
+        if field == 'body':
+            return self.bodies[i]
+        if field == 'permalink':
+            return self.permalinks[i]
+        if field == 'subreddit':
+            return self.subreddits.names[self.sub_ids[i]]
+        if field == 'created_utc':
+            return self.created_utc[i]
+        if field == 'score':
+            return self.scores[i]
+        raise KeyError(field)
+
+    def __len__(self):
+        return len(self.bodies)
+
+    def __getitem__(self, i):
+        if not -len(self) <= i < len(self):
+            raise IndexError(i)
+        return CommentView(self, i % len(self))
+
+    def __iter__(self):
+        return (CommentView(self, i) for i in range(len(self)))
+
+    def sub_totals(self, weights=None):
+        """Return a dict mapping subreddit name to the number (or sum of weights)
+        of comments in it, with subreddits in order of first appearance.
+        """
+        return totals_by_sub(self.sub_ids, self.subreddits, weights)
+
+def totals_by_sub(sub_ids, subreddits, weights=None):
+    """Return a dict mapping subreddit name to the number (or sum of weights) of
+    occurrences of its id in sub_ids, in order of first appearance.
+    """
+    sub_ids = np.frombuffer(sub_ids, dtype=np.int32) if isinstance(sub_ids, array) else np.asarray(sub_ids)
+    if weights is not None:
+        weights = np.frombuffer(weights, dtype=np.float64) if isinstance(weights, array) else np.asarray(weights)
+    totals = np.bincount(sub_ids, weights=weights, minlength=len(subreddits))
+    uniq, first = np.unique(sub_ids, return_index=True)
+    return {subreddits.names[i]: totals[i].item() for i in uniq[np.argsort(first)]}
@@ -5,28 +5,55 @@ Takes care of the following details:
     - Extrapolating counts for high-frequency terms for which we have sampled
       comment data.
 
-TODO: Consider adding (optionally?) columns related to munging:
-    - raw count (w/o any filtering or scaling)
-    - whether count is extrapolated based on sampling
-    - number of comments filtered
-might be useful for debugging
+Pass --metrics to also get (as json) the raw count, whether the count was
+extrapolated from sampled data, the number of comments filtered for each
+reason, and the time spent in each stage of counting, per term.
 """
 import re
 import os
-import json
 import itertools
-from collections import defaultdict
+import functools
+import math
+import multiprocessing
+import bisect
+import time
+import datetime
+import json
+from collections import Counter
 import argparse
+import sys
 
-from reddit_counts import prefixes, suffixes
+import numpy as np
+
+from reddit_counts import prefixes, suffixes, END_TIMESTAMP, high_water_mark
+from term_matcher import TermMatcher
+import comment_store
+import comment_db
+from count_cache import CountCache, logic_fingerprint, file_signature
+from sub_matrix import SubCountMatrix
+from month_cube import MonthCube, month_axis, bin_by_month, FIRST_MONTH
+from compact_comments import CompactComments, SubredditTable, totals_by_sub
+import copypasta_index
+import sampled_counts
+import sharding
+from bootstrap_ci import SampledDayCounts
 
 SAMPLED_DIR = 'sampled_comment_data'
 RAW_DIR = 'comment_data'
+# Exact data ingested from monthly dump files (see ingest_dumps.py)
+DUMP_DIR = 'dump_comment_data'
+
+
+# Index of near-duplicate copypasta found in our data (see copypasta_index.py).
+# Only used if it exists.
+COPYPASTA_INDEX_PATH = copypasta_index.DEFAULT_INDEX_PATH
+
+# We also split on square brackets to account for markdown formatting (don't want link text to be mingled with url)
+token_split_pattern = re.compile(r'[\s\[\]]')
 
 def tokens_having_term(text, term):
     """Case insensitive."""
-    # We also split on square brackets to account for markdown formatting (don't want link text to be mingled with url)
-    tokens = re.split('[\s\[\]]', text)
+    tokens = token_split_pattern.split(text)
     for token in tokens:
         if term in token.lower():
             yield token
@@ -71,10 +98,23 @@ def is_probably_copypasta(text):
     # Similar one that comes up is dark souls 2 chat blacklist
     if '2 girls 1 cup, 2g1c' in text:
         return True
-    
-    
+
+    # Any other long comment that's a near-duplicate of many others in our data
+    index = default_copypasta_index()
+    if index is not None and text in index:
+        return True
+
     return False
 
+@functools.lru_cache(maxsize=None)
+def default_copypasta_index():
+    """Return the CopypastaIndex saved at COPYPASTA_INDEX_PATH (loaded once
+    per process), or None if there isn't one.
+    """
+    if not os.path.exists(COPYPASTA_INDEX_PATH):
+        return None
+    return copypasta_index.CopypastaIndex.load(COPYPASTA_INDEX_PATH)
+
 def is_valid_comment(comment, term):
     """Return whether the given comment should contribute to our cuont of the
     occurrences of the given term. Currently disqualifying if
@@ -95,58 +135,745 @@ def is_valid_comment(comment, term):
             return True
     return False
 
+# Reasons a comment may fail to count towards a term, in the order they're checked
+REJECTION_REASONS = ('copypasta_sub', 'copypasta_signature', 'urlish', 'no_match')
+
+def rejection_reason(comment, term):
+    """Return the reason (one of REJECTION_REASONS) why is_valid_comment(comment, term)
+    is False, or None if it's True. 'no_match' means the term doesn't occur
+    in the body at all (Pushshift's search matches some things we don't).
+    """
+    if comment['subreddit'] == 'copypasta':
+        return 'copypasta_sub'
+    body = comment['body']
+    if is_probably_copypasta(body):
+        return 'copypasta_signature'
+    tokens = list(tokens_having_term(body, term))
+    if not tokens:
+        return 'no_match'
+    if all(looks_urlish(token) for token in tokens):
+        return 'urlish'
+    return None
+
+class CountingEngine:
+    """Computes comment validity for every compound at once.
+
+    Equivalent to calling is_valid_comment(comment, term) for each term, but a
+    comment's body is tokenized and checked for copypasta only once, with all
+    the terms it contains found by a single automaton scan. Verdicts are cached
+    per comment (by comment_store.comment_key and subreddit), so a comment
+    appearing in the files of several terms is only ever scanned once.
+    Comments without a key aren't cached.
+    """
+
+    def __init__(self, terms):
+        self.matcher = TermMatcher(terms)
+        self._verdicts = {}
+        # Cumulative time spent computing verdicts, by stage (see TermMetrics)
+        self.stage_times = dict(tokenize=0.0, filter=0.0)
+
+    def valid_terms(self, comment):
+        """Return the set of terms for which this comment is valid."""
+        key = comment_store.comment_key(comment)
+        if key is None:
+            return self._compute_valid_terms(comment)
+        # (The verdict depends on the subreddit, so it's part of the key)
+        key = (key, comment['subreddit'])
+        verdict = self._verdicts.get(key)
+        if verdict is None:
+            verdict = self._verdicts[key] = self._compute_valid_terms(comment)
+        return verdict
+
+    def _compute_valid_terms(self, comment):
+        times = self.stage_times
+        t0 = time.perf_counter()
+        body = comment['body']
+        if comment['subreddit'] == 'copypasta' or is_probably_copypasta(body):
+            times['filter'] += time.perf_counter() - t0
+            return frozenset()
+        t1 = time.perf_counter()
+        hits = []
+        for token in token_split_pattern.split(body):
+            found = self.matcher.terms_in(token.lower())
+            if found:
+                hits.append((token, found))
+        t2 = time.perf_counter()
+        terms = set()
+        for token, found in hits:
+            if not looks_urlish(token):
+                terms |= found
+        times['tokenize'] += t2 - t1
+        times['filter'] += (t1 - t0) + (time.perf_counter() - t2)
+        return frozenset(terms)
+
+    def is_valid(self, comment, term):
+        return term in self.valid_terms(comment)
+
+    def valid_mask(self, comments, term):
+        """Return a bool array of is_valid for each of the given
+        CompactComments, looking up cached verdicts straight from its columns.
+        """
+        verdicts = self._verdicts
+        names = comments.subreddits.names
+        valid = []
+        # (CompactComments keep no ids, so the permalink is the whole comment_key)
+        for i, (permalink, sub_id) in enumerate(zip(comments.permalinks, comments.sub_ids)):
+            if permalink is None:
+                verdict = self._compute_valid_terms(comments[i])
+            else:
+                key = (permalink, names[sub_id])
+                verdict = verdicts.get(key)
+                if verdict is None:
+                    verdict = verdicts[key] = self._compute_valid_terms(comments[i])
+            valid.append(term in verdict)
+        return np.array(valid, dtype=bool)
+
+def all_terms():
+    return [pre + suff for pre, suff in itertools.product(prefixes, suffixes)]
+
+def comment_sources(term):
+    """Return a tuple of (paths, sampled), where paths is a list of the files
+    holding comments for the given term, and sampled is whether they're
+    sampled data. Exact data ingested from dumps (if every month has been
+    ingested) takes precedence over sampled data, which takes precedence over
+    raw data from the API. Data from the API is only used once its download
+    has finished: a partial download would be counted as if it were complete
+    (and a partial sample extrapolated as if every day had been fetched).
+    Raise FileNotFoundError if the term has no finished data.
+    If COMMENT_DB is set, data from the API is read from that database (see
+    comment_db.py) rather than per-term files.
+    """
+    shards = comment_store.find_dump_shards(DUMP_DIR, term, _ingest_manifest())
+    if shards is not None:
+        return shards, False
+    db = comment_db.default_db()
+    if db is not None:
+        # The whole database is the input for every term
+        for dirname, sampled in ((SAMPLED_DIR, True), (RAW_DIR, False)):
+            if db.has_term(term, dirname):
+                return [db.path], sampled
+            if db.read_cursor(term, dirname) is not None:
+                _warn_unfinished(term, f'{db.path} ({dirname})')
+        raise FileNotFoundError(f"No finished comment data for term {term!r} in {db.path}")
+    for dirname, sampled in ((SAMPLED_DIR, True), (RAW_DIR, False)):
+        path = comment_store.find_comments_file(dirname, term)
+        if path is None:
+            continue
+        if comment_store.is_finished(path):
+            return [path], sampled
+        _warn_unfinished(term, path)
+    raise FileNotFoundError(f"No finished comment data for term {term!r} in {SAMPLED_DIR} or {RAW_DIR}")
+
+def _warn_unfinished(term, where):
+    sys.stderr.write(f"WARNING: ignoring unfinished download of {term!r} in {where}\n")
+
+# The first month of comments on Reddit, and of the dumps
+FIRST_DUMP_MONTH = np.datetime64('2005-12', 'M')
+
+def missing_dump_months(manifest):
+    """Return the months (e.g. 'RC_2015-06') up to END_TIMESTAMP that haven't
+    been ingested, according to the given ingest manifest.
+    """
+    ingested = set(manifest['months'])
+    return [f'RC_{month}' for month in month_axis(END_TIMESTAMP)
+            if month >= FIRST_DUMP_MONTH and f'RC_{month}' not in ingested]
+
+@functools.lru_cache(maxsize=None)
+def _ingest_manifest():
+    """Return the manifest of the dumps ingested into DUMP_DIR, or None if
+    there are none, or they're missing any months. A term's shards only hold
+    its comments from the months ingested, so counting them in place of its
+    API data would undercount it.
+    """
+    manifest = comment_store.read_ingest_manifest(DUMP_DIR)
+    if manifest is None:
+        return None
+    missing = missing_dump_months(manifest)
+    if missing:
+        sys.stderr.write(f"WARNING: IGNORING DUMP DATA in {DUMP_DIR}, which is missing {len(missing)} "
+                f"months (e.g. {', '.join(missing[:3])}). Ingest them to count from the dumps.\n")
+        return None
+    return manifest
+
+def data_end(terms):
+    """Return the timestamp up to which the stored comments for the given
+    terms extend: the latest of their high-water marks (see refresh.py), and
+    the end of the last month ingested from dumps.
+    """
+    end = END_TIMESTAMP
+    manifest = _ingest_manifest()
+    if manifest and manifest['months']:
+        last_month = np.datetime64(max(manifest['months'])[len('RC_'):], 'M')
+        end = max(end, int((last_month + 1).astype('datetime64[s]').astype(np.int64)))
+    for term in terms:
+        for dirname in (SAMPLED_DIR, RAW_DIR):
+            cursor = comment_store.stored_cursor(dirname, term)
+            if cursor is not None:
+                end = max(end, high_water_mark(cursor))
+    return end
+
+def stream_comments(term):
+    """Return a tuple of (comments, sampled), where comments is a generator over
+    the comments stored for the given term, and sampled is whether they come
+    from sampled data.
+    """
+    paths, sampled = comment_sources(term)
+    db = comment_db.default_db()
+    if db is not None and paths == [db.path]:
+        return db.iter_comments(term, SAMPLED_DIR if sampled else RAW_DIR), sampled
+    return itertools.chain.from_iterable(map(comment_store.iter_comments, paths)), sampled
+
 def load_comments(term):
-    fname = f'{term}.json'
-    samplepath = os.path.join(SAMPLED_DIR, fname)
-    if os.path.exists(samplepath):
-        with open(samplepath) as f:
-            return json.load(f), True
-    path = os.path.join(RAW_DIR, fname)
-    with open(path) as f:
-        return json.load(f), False
-
-def count_for_term(term, raw):
-    comments, sampled = load_comments(term)
+    """Like stream_comments, but with comments returned as a list."""
+    comments, sampled = stream_comments(term)
+    return list(comments), sampled
+
+# Subreddit ids shared by all the terms loaded/counted in this process
+SUBREDDITS = SubredditTable()
+
+def load_compact_comments(term):
+    """Like load_comments, but with comments returned as a CompactComments,
+    which takes much less memory than a list of dicts.
+    """
+    comments, sampled = stream_comments(term)
+    return CompactComments.from_iter(comments, SUBREDDITS), sampled
+
+# Sampled data fetched with fixed intervals is based on sampling comments from 30
+# randomly chosen days per year. So scale up by a bit more than a factor of 10
+FIXED_SAMPLING_MULTIPLIER = 365.25 / 30
+
+class SamplingWeights:
+    """For a term that was sampled adaptively (see sampled_counts.fetch_adaptive),
+    knows how many comments each sampled comment stands for. This depends on
+    the year it's from: if we sampled n of the N days in a year, each comment
+    from that year counts for N/n.
+    """
+
+    def __init__(self, info):
+        intervals = sorted(info['intervals'], key=lambda iv: iv[1])
+        self.years = [year for (year, _, _) in intervals]
+        self.starts = [start for (_, start, _) in intervals]
+        self.ends = [end for (_, _, end) in intervals]
+        ndays = Counter(self.years)
+        self.year_weights = {year: info['days_in_year'][str(year)] / n for year, n in ndays.items()}
+
+    def day_of(self, comment):
+        """Return the index of the sampled day this comment belongs to (or None
+        if it's not from any of our sampled days, which shouldn't happen).
+        """
+        t = comment['created_utc']
+        i = bisect.bisect_right(self.starts, t) - 1
+        if i >= 0 and t <= self.ends[i]:
+            return i
+        return None
+
+    def year_of(self, comment):
+        i = self.day_of(comment)
+        return None if i is None else self.years[i]
+
+    def years_of(self, timestamps):
+        """Like year_of, but for an array of comment timestamps at once, with
+        0 for those not from any sampled day.
+        """
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        if not self.starts:
+            return np.zeros(len(timestamps), dtype=np.int64)
+        i = np.searchsorted(self.starts, timestamps, side='right') - 1
+        j = np.maximum(i, 0)
+        in_day = (i >= 0) & (timestamps <= np.asarray(self.ends)[j])
+        return np.where(in_day, np.asarray(self.years)[j], 0)
+
+    def weight(self, comment):
+        return self.year_weights.get(self.year_of(comment), 0.0)
+
+    def extrapolate(self, year_counts):
+        """Given a mapping from year to number of sampled comments, return the
+        estimated total count.
+        """
+        return sum(self.year_weights.get(year, 0.0) * count for year, count in year_counts.items())
+
+def load_sampling_weights(term):
+    info = comment_store.read_sample_info(SAMPLED_DIR, term)
+    return SamplingWeights(info) if info else None
+
+class TermMetrics:
+    """Instrumentation for counting a single term: the number of comments read,
+    counted, and rejected for each reason, and the time spent in each stage:
+    - load: reading and parsing comments
+    - tokenize: splitting bodies into tokens and finding terms in them
+    - filter: copypasta and url checks
+    - aggregate: everything else (tallying, extrapolating)
+    When counting with a CountingEngine, tokenize and filter time for a comment
+    is charged to whichever term's file it was first seen in.
+    (When counting without one, both are charged to filter.)
+    """
+    STAGES = ('load', 'tokenize', 'filter', 'aggregate')
+
+    def __init__(self, term):
+        self.term = term
+        self.sampled = None
+        self.comments = 0
+        self.valid = 0
+        self.count = None
+        self.rejections = dict.fromkeys(REJECTION_REASONS, 0)
+        self.times = dict.fromkeys(self.STAGES, 0.0)
+        # Time spent on instrumentation (working out rejection reasons), which
+        # is excluded from the stage times.
+        self._overhead = 0.0
+
+    def start(self, engine):
+        self._t0 = time.perf_counter()
+        self._engine_times = dict(engine.stage_times) if engine else None
+
+    def timed_load(self, comments):
+        """Wrap an iterator of comments, timing how long each takes to load."""
+        it = iter(comments)
+        while True:
+            t0 = time.perf_counter()
+            try:
+                comment = next(it)
+            except StopIteration:
+                self.times['load'] += time.perf_counter() - t0
+                return
+            self.times['load'] += time.perf_counter() - t0
+            self.comments += 1
+            yield comment
+
+    def timed_filter(self, is_valid):
+        """Wrap a validity function, charging the time it takes to filter."""
+        def timed(comment, term):
+            t0 = time.perf_counter()
+            res = is_valid(comment, term)
+            self.times['filter'] += time.perf_counter() - t0
+            return res
+        return timed
+
+    def reject(self, comment):
+        t0 = time.perf_counter()
+        self.rejections[rejection_reason(comment, self.term)] += 1
+        self._overhead += time.perf_counter() - t0
+
+    def finish(self, engine, valid, count):
+        elapsed = time.perf_counter() - self._t0
+        self.valid = valid
+        self.count = count
+        if engine:
+            for stage in ('tokenize', 'filter'):
+                self.times[stage] += engine.stage_times[stage] - self._engine_times[stage]
+        self.times['aggregate'] = max(0.0,
+                elapsed - self._overhead - sum(self.times[stage] for stage in ('load', 'tokenize', 'filter')))
+
+    def to_dict(self):
+        return dict(sampled=self.sampled, comments=self.comments, valid=self.valid, count=self.count,
+                rejections=self.rejections, times=self.times)
+
+def valid_compact_comments(comments, term, engine=None, is_valid=is_valid_comment, metrics=None):
+    """Parse the given comments into a CompactComments, and return a tuple of
+    it and a bool array of which of them are valid for the given term
+    (according to the engine, if given, or else is_valid).
+    """
+    compact = CompactComments.from_iter(comments, SUBREDDITS)
+    if engine:
+        valid = engine.valid_mask(compact, term)
+    else:
+        valid = np.fromiter((is_valid(comment, term) for comment in compact), dtype=bool, count=len(compact))
+    if metrics:
+        for i in np.flatnonzero(~valid):
+            metrics.reject(compact[i])
+    return compact, valid
+
+def count_for_term(term, raw, engine=None, months=None, metrics=None):
+    """Return the (estimated) number of comments using the given term.
+
+    If months (an axis from month_cube.month_axis) is given, return a tuple of
+    (count, array of counts per month in months), with the months' counts also
+    extrapolated for sampled terms.
+    If a TermMetrics is given, record instrumentation in it.
+    """
+    if metrics:
+        metrics.start(engine)
+    comments, sampled = stream_comments(term)
+    # (Only used without an engine)
+    is_valid = is_valid_comment
+    if metrics:
+        metrics.sampled = sampled
+        comments = metrics.timed_load(comments)
+        if not engine:
+            is_valid = metrics.timed_filter(is_valid)
     if raw:
-        count = len(comments)
+        assert months is None, "Counts by month not supported for raw counts"
+        count = sum(1 for _ in comments)
+        if metrics:
+            metrics.finish(engine, count, count)
+        return count
+    weights = load_sampling_weights(term) if sampled else None
+    comments, valid = valid_compact_comments(comments, term, engine, is_valid, metrics)
+    timestamps = np.frombuffer(comments.created_utc, dtype=np.int64)[valid]
+    nvalid = count = len(timestamps)
+    if weights:
+        years = weights.years_of(timestamps).tolist()
+        # (Counter keeps years in order of first appearance, so the sum is
+        # always done in the same order)
+        count = weights.extrapolate(Counter(years))
+    elif sampled:
+        count *= FIXED_SAMPLING_MULTIPLIER
+    if metrics:
+        metrics.finish(engine, nvalid, count)
+    if months is None:
+        return count
+    if weights:
+        month_weights = [weights.year_weights.get(year, 0.0) for year in years]
     else:
-        count = sum(is_valid_comment(c, term) for c in comments)
-    if sampled and not raw:
-        # Our counts are based on sampling comments from 30 randomly
-        # chosen days per year. So scale up by a bit more than a factor
-        # of 10
-        count *= 365.25 / 30
-    return count
+        month_weights = None
+    month_counts = bin_by_month(timestamps, months, month_weights)
+    if sampled and not weights:
+        month_counts *= FIXED_SAMPLING_MULTIPLIER
+    return count, month_counts
 
-def sub_counts_for_term(term):
+def sub_counts_for_term(term, engine=None):
     """Return dict mapping subreddit name to count.
     """
-    comments, sampled = load_comments(term)
-    multiplier = (365.25 / 30) if sampled else 1.0
-    counts = defaultdict(float)
-    for comment in comments:
-        if not is_valid_comment(comment, term):
+    comments, sampled = stream_comments(term)
+    multiplier = FIXED_SAMPLING_MULTIPLIER if sampled else 1.0
+    weights = load_sampling_weights(term) if sampled else None
+    comments, valid = valid_compact_comments(comments, term, engine)
+    # Subreddits were interned as the comments were parsed
+    sub_ids = np.frombuffer(comments.sub_ids, dtype=np.int32)[valid]
+    if weights:
+        timestamps = np.frombuffer(comments.created_utc, dtype=np.int64)[valid]
+        sub_weights = [weights.year_weights.get(year, 0.0) for year in weights.years_of(timestamps).tolist()]
+    else:
+        sub_weights = np.full(len(sub_ids), multiplier)
+    return totals_by_sub(sub_ids, SUBREDDITS, sub_weights)
+
+# When running with multiple jobs, each worker process builds its own engine
+# (and verdict cache) once, in _init_worker.
+_engine = None
+
+@functools.lru_cache(maxsize=None)
+def legacy_sampled_days(last_year=sampled_counts.LAST_YEAR):
+    """Return a list of (year, start, end) for the days up to the end of
+    last_year sampled with fixed intervals (see sampled_counts.get_intervals),
+    in order of start.
+    """
+    days = sampled_counts.intervals_by_year(seed=1337, last_year=last_year)
+    return sorted(days, key=lambda day: day[1])
+
+def day_counts_for_term(term, engine=None):
+    """For a term with sampled data, return a list of [year, start, count,
+    weight] for each of its sampled days: the day's year and start timestamp,
+    the number of valid comments from that day, and the number of comments
+    each of those stands for (see bootstrap_ci.py).
+    """
+    comments, sampled = stream_comments(term)
+    assert sampled, f"No sampled data for {term!r}"
+    is_valid = engine.is_valid if engine else is_valid_comment
+    weights = load_sampling_weights(term)
+    if weights:
+        days = list(zip(weights.years, weights.starts))
+        day_weights = [weights.year_weights[year] for year in weights.years]
+        day_of = weights.day_of
+    else:
+        # The fixed intervals started at local midnight on the machine that
+        # downloaded them, so rather than trusting their exact boundaries,
+        # assign each comment to the nearest sampled day.
+        # Including any years added by refresh.py
+        cursor = comment_store.stored_cursor(SAMPLED_DIR, term) or {}
+        last_year = datetime.datetime.fromtimestamp(high_water_mark(cursor) - 1).year
+        legacy = legacy_sampled_days(last_year)
+        days = [(year, start) for year, start, _ in legacy]
+        day_weights = [FIXED_SAMPLING_MULTIPLIER] * len(days)
+        mids = [(start + end) / 2 for _, start, end in legacy]
+        def day_of(comment):
+            t = comment['created_utc']
+            i = bisect.bisect(mids, t)
+            if i == len(mids) or (i > 0 and t - mids[i-1] <= mids[i] - t):
+                return i - 1
+            return i
+    counts = [0] * len(days)
+    for c in comments:
+        if not is_valid(c, term):
+            continue
+        i = day_of(c)
+        if i is not None:
+            counts[i] += 1
+    return [[year, start, count, weight] for (year, start), count, weight in zip(days, counts, day_weights)]
+
+def window_count_for_term(term, start, end, engine=None):
+    """Return the (estimated) number of valid comments using the given term
+    that were created in [start, end). Comments from outside the window are
+    skipped before being checked, so this is much cheaper than count_for_term
+    for a short window (e.g. the one fetched by refresh.py).
+    """
+    comments, sampled = stream_comments(term)
+    is_valid = engine.is_valid if engine else is_valid_comment
+    weights = load_sampling_weights(term) if sampled else None
+    multiplier = FIXED_SAMPLING_MULTIPLIER if sampled else 1
+    count = 0
+    for c in comments:
+        if not start <= c['created_utc'] < end or not is_valid(c, term):
             continue
-        counts[comment['subreddit']] += multiplier
-    return counts
+        count += weights.weight(c) if weights else multiplier
+    return count
+
+def _init_worker(raw):
+    global _engine
+    _engine = None if raw else CountingEngine(all_terms())
+
+def _count_in_worker(term, raw, months=None, with_metrics=False):
+    metrics = TermMetrics(term) if with_metrics else None
+    result = count_for_term(term, raw, _engine, months, metrics)
+    if months is not None:
+        # Plain lists, so the result can go in the (json) count cache
+        count, month_counts = result
+        result = count, month_counts.tolist()
+    if with_metrics:
+        return result, metrics.to_dict()
+    return result
 
-def print_all_compound_counts(raw):
+def _sub_counts_in_worker(term):
+    return sub_counts_for_term(term, _engine)
+
+def _day_counts_in_worker(term):
+    return day_counts_for_term(term, _engine)
+
+def _window_count_in_worker(window):
+    term, start, end = window
+    return window_count_for_term(term, start, end, _engine)
+
+# Number of chunks handed to each worker (on average). Chunks are contiguous
+# runs of terms in the order given (for all_terms, prefix by prefix, so a chunk
+# may cover part of one prefix's terms or span several). They're large enough
+# for the per-worker verdict cache to pay off, but there are enough of them to
+# even out the load when some terms are much heavier than others.
+CHUNKS_PER_JOB = 4
+
+def map_terms(fn, terms, raw=False, jobs=1):
+    """Yield fn(term) for each of the given terms, in order, spreading the work
+    across a pool of jobs processes if jobs > 1.
+    """
+    if jobs == 1:
+        _init_worker(raw)
+        yield from map(fn, terms)
+        return
+    chunksize = max(1, math.ceil(len(terms) / (jobs * CHUNKS_PER_JOB)))
+    # Read before forking, so workers inherit it (and any warning about it is only given once)
+    _ingest_manifest()
+    with multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(raw,)) as pool:
+        # imap (unlike imap_unordered) returns results in order of input
+        yield from pool.imap(fn, terms, chunksize)
+
+def input_paths(term):
+    """Return the paths of the files that counts for the given term are
+    computed from. Comments in COMMENT_DB are represented by a key standing for
+    just the term's rows in it (see db_signatures).
+    """
+    paths, sampled = comment_sources(term)
+    db = comment_db.default_db()
+    if db is not None and paths == [db.path]:
+        # The database changes whenever any term's comments do, so isn't
+        # fingerprinted as a whole
+        paths = [f"{db.path}#{SAMPLED_DIR if sampled else RAW_DIR}/{term}"]
+    if sampled:
+        infopath = comment_store.sample_info_path(SAMPLED_DIR, term)
+        if os.path.exists(infopath):
+            paths.append(infopath)
+    # Which comments count as copypasta depends on the index
+    if os.path.exists(COPYPASTA_INDEX_PATH):
+        paths.append(COPYPASTA_INDEX_PATH)
+    return paths
+
+def db_signatures(paths):
+    """Return a dict mapping each of the given inputs that stands for a term's
+    rows in COMMENT_DB (see input_paths) to its CommentDB.term_signature.
+    """
+    db = comment_db.default_db()
+    if db is None:
+        return {}
+    sigs = {}
+    for path in paths:
+        if path.startswith(db.path + '#'):
+            source, term = path[len(db.path) + 1:].split('/', 1)
+            sigs[path] = db.term_signature(term, source)
+    return sigs
+
+# Everything that determines the count for a term, given its input files. Used
+# to invalidate cached counts when any of it changes.
+COUNTING_LOGIC = [
+        token_split_pattern.pattern, tokens_having_term,
+        reddit_entity_ref_pattern.pattern, looks_urlish,
+        is_probably_copypasta, is_valid_comment,
+        copypasta_index.signature, copypasta_index.band_keys, copypasta_index.CopypastaIndex,
+        copypasta_index.SIMILARITY_THRESHOLD, copypasta_index.MIN_TOKENS,
+        TermMatcher, CountingEngine,
+        FIXED_SAMPLING_MULTIPLIER, SamplingWeights,
+        count_for_term, sub_counts_for_term, day_counts_for_term, window_count_for_term,
+        sampled_counts.get_intervals, sampled_counts.intervals_by_year,
+        sampled_counts.FIRST_YEAR, sampled_counts.DAYS_PER_YEAR,
+        bin_by_month, str(FIRST_MONTH), totals_by_sub,
+]
+
+def open_count_cache():
+    return CountCache(logic_fingerprint(COUNTING_LOGIC))
+
+def map_terms_cached(fn, terms, kind, cache, raw=False, jobs=1):
+    """Like map_terms, but only call fn on terms that have no cached result of
+    the given kind (or whose input files have changed), and cache the new results.
+    """
+    paths = {term: input_paths(term) for term in terms}
+    db_sigs = {term: db_signatures(paths[term]) for term in terms}
+    cached = {}
+    stale = []
+    for term in terms:
+        result = cache.get(term, kind, paths[term], db_sigs[term])
+        if result is None:
+            stale.append(term)
+        else:
+            cached[term] = result
+    sys.stderr.write(f"Reusing cached results for {len(cached)} terms. Counting {len(stale)}.\n")
+    # Take signatures before counting, so any changes made while we're counting
+    # will be picked up next time.
+    signatures = {term: {path: db_sigs[term][path] if path in db_sigs[term] else file_signature(path)
+        for path in paths[term]} for term in stale}
+    fresh = map_terms(fn, stale, raw, jobs)
+    try:
+        for term in terms:
+            if term in cached:
+                yield cached[term]
+            else:
+                result = next(fresh)
+                cache.put(term, kind, result, signatures[term])
+                yield result
+    finally:
+        cache.save()
+
+def write_metrics(path, term_metrics, elapsed, jobs):
+    """Write a json file of the given per-term metrics (a dict mapping term to
+    TermMetrics.to_dict()), along with totals over all terms.
+    """
+    totals = dict(
+            comments=sum(m['comments'] for m in term_metrics.values()),
+            valid=sum(m['valid'] for m in term_metrics.values()),
+            rejections={reason: sum(m['rejections'][reason] for m in term_metrics.values())
+                for reason in REJECTION_REASONS},
+            # NB: with jobs > 1, these are summed over all processes
+            times={stage: sum(m['times'][stage] for m in term_metrics.values())
+                for stage in TermMetrics.STAGES},
+    )
+    with open(path, 'w') as f:
+        json.dump(dict(elapsed=elapsed, jobs=jobs, totals=totals, terms=term_metrics), f, indent=1)
+
+def sampled_count_intervals(terms, jobs=1, incremental=False):
+    """Return a dict mapping each of the given terms that has sampled data to
+    a (lo, hi) bootstrap confidence interval for its count (see bootstrap_ci.py).
+    """
+    sampled_terms = [term for term in terms if comment_sources(term)[1]]
+    if incremental:
+        day_counts = map_terms_cached(_day_counts_in_worker, sampled_terms, 'day_counts',
+                open_count_cache(), jobs=jobs)
+    else:
+        day_counts = map_terms(_day_counts_in_worker, sampled_terms, jobs=jobs)
+    # (Exhausting the iterator, so the cache gets saved before we count)
+    day_counts = list(day_counts)
+    t0 = time.perf_counter()
+    lo, hi = SampledDayCounts.build(dict(zip(sampled_terms, day_counts))).intervals()
+    sys.stderr.write(f"Bootstrapped intervals for {len(sampled_terms)} sampled terms in {time.perf_counter() - t0:.2f}s\n")
+    return {term: (l.item(), h.item()) for term, l, h in zip(sampled_terms, lo, hi)}
+
+def all_pairs(shard=None):
+    """Return a list of all (pre, suff) pairs, or only those in the given
+    (i, n) shard (see sharding.py).
+    """
+    pairs = list(itertools.product(prefixes, suffixes))
+    if shard:
+        pairs = sharding.shard_pairs(pairs, shard, _shard_weights())
+    return pairs
+
+# Path of the counts used to balance shards (set from --shard-weights)
+SHARD_WEIGHTS_PATH = sharding.DEFAULT_WEIGHTS_PATH
+
+@functools.lru_cache(maxsize=None)
+def _shard_weights():
+    return sharding.load_weights(SHARD_WEIGHTS_PATH)
+
+def print_all_compound_counts(raw, jobs=1, incremental=False, cube_path=None, metrics_path=None, ci=False, shard=None):
+    """Print a csv of counts for all terms. If cube_path is given, also save
+    counts per month for each term there (see month_cube.py). If metrics_path
+    is given, write instrumentation for each term there (see TermMetrics). If
+    ci, add columns count_lo and count_hi giving a 95% confidence interval for
+    each count (which is just the count itself, for terms that weren't sampled).
+    If shard is given, only count the terms in it.
+    """
+    t0 = time.perf_counter()
+    pairs = all_pairs(shard)
+    terms = [pre + suff for pre, suff in pairs]
+    if ci:
+        intervals = sampled_count_intervals(terms, jobs, incremental)
     # header
-    print("pre,suff,count")
-    for pre, suff in itertools.product(prefixes, suffixes):
-        term = pre + suff
-        count = count_for_term(term, raw)
-        print(f"{pre},{suff},{count}")
+    print("pre,suff,count,count_lo,count_hi" if ci else "pre,suff,count")
+    by_month = bool(cube_path)
+    # The cube's months run up to the newest stored comments, which may be
+    # past END_TIMESTAMP for terms brought up to date by refresh.py
+    months = month_axis(data_end(all_terms())) if by_month else None
+    with_metrics = bool(metrics_path)
+    assert not (with_metrics and incremental), "Metrics aren't cached"
+    fn = functools.partial(_count_in_worker, raw=raw, months=months, with_metrics=with_metrics)
+    if incremental:
+        # (Cached counts by month are only reusable with the same axis)
+        kind = 'raw' if raw else (f'count_by_month:{months[-1]}' if by_month else 'count')
+        results = map_terms_cached(fn, terms, kind, open_count_cache(), raw, jobs)
+    else:
+        results = map_terms(fn, terms, raw, jobs)
+    cube_rows = []
+    term_metrics = {}
+    for (pre, suff), result in zip(pairs, results):
+        if with_metrics:
+            result, term_metrics[pre + suff] = result
+        if by_month:
+            count, month_counts = result
+            cube_rows.append((pre, suff, month_counts))
+        else:
+            count = result
+        if ci:
+            lo, hi = intervals.get(pre + suff, (count, count))
+            print(f"{pre},{suff},{count},{lo},{hi}")
+        else:
+            print(f"{pre},{suff},{count}")
+    if by_month:
+        cube = MonthCube.build(prefixes, suffixes, months, cube_rows)
+        cube.save(cube_path)
+        sys.stderr.write(f"Saved counts by month to {cube_path}\n")
+    if with_metrics:
+        write_metrics(metrics_path, term_metrics, time.perf_counter() - t0, jobs)
+        sys.stderr.write(f"Saved metrics to {metrics_path}\n")
+
+def all_sub_counts(jobs=1, incremental=False, shard=None):
+    """Return a tuple of ((pre, suff) pairs, parallel iterator of dicts mapping
+    subreddit to count for each term).
+    """
+    pairs = all_pairs(shard)
+    terms = [pre + suff for pre, suff in pairs]
+    if incremental:
+        sub_counts = map_terms_cached(_sub_counts_in_worker, terms, 'sub', open_count_cache(), jobs=jobs)
+    else:
+        sub_counts = map_terms(_sub_counts_in_worker, terms, jobs=jobs)
+    return pairs, sub_counts
 
-def print_counts_by_subreddit():
+def print_counts_by_subreddit(jobs=1, incremental=False, shard=None):
     # header
     print("pre,suff,sub,count")
-    for pre, suff in itertools.product(prefixes, suffixes):
-        term = pre + suff
-        counts = sub_counts_for_term(term)
+    pairs, sub_counts = all_sub_counts(jobs, incremental, shard)
+    for (pre, suff), counts in zip(pairs, sub_counts):
         for (sub, count) in counts.items():
             print(f"{pre},{suff},{sub},{count}")
 
+def save_sub_matrix(path, jobs=1, incremental=False):
+    """Save counts by subreddit as a sparse term x subreddit matrix (see sub_matrix.py)."""
+    pairs, sub_counts = all_sub_counts(jobs, incremental)
+    mat = SubCountMatrix.build(pairs, sub_counts)
+    mat.save(path)
+    sys.stderr.write(f"Saved {mat.shape[0]} x {mat.shape[1]} matrix with {len(mat.data)} nonzero entries to {path}\n")
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Output a csv of term counts to stdout")
     parser.add_argument('--raw', action='store_true',
@@ -155,9 +882,43 @@ if __name__ == '__main__':
     parser.add_argument('--sub', action='store_true',
             help="Add a grouping by subreddit",
     )
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+            help="Number of worker processes to count with. Output order is unaffected.",
+    )
+    parser.add_argument('--matrix', metavar='PATH',
+            help="With --sub, save counts as a sparse term x subreddit matrix (.npz) "
+            "at the given path, rather than outputting a csv",
+    )
+    parser.add_argument('--cube', metavar='PATH',
+            help="Also save a prefix x suffix x month array of counts (.npz) at the given path",
+    )
+    parser.add_argument('--metrics', metavar='PATH',
+            help="Write per-term stage timings and counts of filtered comments (.json) to the given path",
+    )
+    parser.add_argument('--ci', action='store_true',
+            help="Add columns count_lo and count_hi, a bootstrap 95%% confidence interval for "
+            "the counts of sampled terms",
+    )
+    parser.add_argument('--incremental', action='store_true',
+            help="Reuse counts cached by previous runs for terms whose comment data "
+            "(and our filtering logic) hasn't changed since",
+    )
+    sharding.add_shard_arguments(parser)
     args = parser.parse_args()
+    SHARD_WEIGHTS_PATH = args.shard_weights
+    assert not (args.matrix and not args.sub), "--matrix requires --sub"
+    # Partial matrices/cubes can't be merged (yet)
+    assert not (args.shard and (args.matrix or args.cube)), "This combination of args not supported"
+    assert not (args.cube and (args.sub or args.raw)), "This combination of args not supported"
+    assert not (args.ci and (args.sub or args.raw)), "This combination of args not supported"
+    assert not (args.metrics and (args.sub or args.incremental)), "This combination of args not supported"
     if args.sub:
         assert not args.raw, "This combination of args not supported"
-        print_counts_by_subreddit()
+        if args.matrix:
+            save_sub_matrix(args.matrix, jobs=args.jobs, incremental=args.incremental)
+        else:
+            print_counts_by_subreddit(jobs=args.jobs, incremental=args.incremental, shard=args.shard)
     else:
-        print_all_compound_counts(raw=args.raw)
+        print_all_compound_counts(raw=args.raw, jobs=args.jobs, incremental=args.incremental,
+                cube_path=args.cube, metrics_path=args.metrics, ci=args.ci, shard=args.shard,
+        )
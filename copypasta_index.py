@@ -0,0 +1,186 @@
+"""Near-duplicate detection of copypasta, via MinHash and locality sensitive
+hashing (LSH) over the bodies of all downloaded comments.
+
+is_probably_copypasta only knows a couple of hard-coded signatures, and misses
+mutated variants and lists we haven't seen. This finds clusters of long
+comments which are near-duplicates of one another (judged by the overlap of
+their sets of word 3-grams), and treats any cluster with at least
+MIN_CLUSTER_SIZE distinct comments as copypasta.
+
+    python copypasta_index.py build
+    python copypasta_index.py check "some comment text"
+
+build saves the MinHash signatures of the members of those clusters to
+copypasta_index.npz. If that file exists, compute_counts.is_probably_copypasta
+also rejects any comment that's a near-duplicate of one of them, which costs
+one signature computation and a few dict lookups per (long) comment.
+
+Comments with fewer than MIN_TOKENS words are never considered copypasta by
+this method.
+"""
+import re
+import zlib
+import argparse
+
+import numpy as np
+
+DEFAULT_INDEX_PATH = 'copypasta_index.npz'
+
+# Words per shingle
+SHINGLE_SIZE = 3
+MIN_TOKENS = 40
+NUM_PERM = 64
+# Signatures are split into this many bands of NUM_PERM / BANDS rows each. Two
+# comments become candidates if they agree on all the rows of any band. With
+# 16 bands of 4 rows, comments with Jaccard similarity 0.5 are caught with
+# probability ~0.65, and those with 0.7 with probability ~0.998
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+# Candidates are only counted as near-duplicates if their estimated Jaccard
+# similarity is at least this
+SIMILARITY_THRESHOLD = .5
+MIN_CLUSTER_SIZE = 5
+
+word_pattern = re.compile(r'\w+')
+
+_rng = np.random.RandomState(1337)
+# Parameters of the multiply-shift hash functions (one per permutation).
+# Multipliers must be odd.
+_A = _rng.randint(0, 2**63, NUM_PERM, dtype=np.int64).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+_B = _rng.randint(0, 2**63, NUM_PERM, dtype=np.int64).astype(np.uint64)
+# For combining the rows of a band, and each band's index, into one key
+_MIX = _rng.randint(0, 2**63, ROWS, dtype=np.int64).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+_BAND_SALT = np.arange(BANDS, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+
+def shingle_hashes(text):
+    """Return an array of (uint64) hashes of the word shingles in the given
+    text, or None if it's too short to consider.
+    """
+    words = word_pattern.findall(text.lower())
+    if len(words) < MIN_TOKENS:
+        return None
+    h = np.array([zlib.crc32(w.encode('utf-8')) for w in words], dtype=np.uint64)
+    n = len(h) - SHINGLE_SIZE + 1
+    shingles = np.zeros(n, dtype=np.uint64)
+    for k in range(SHINGLE_SIZE):
+        shingles = shingles * np.uint64(0x100000001B3) ^ h[k:k+n]
+    return np.unique(shingles)
+
+def signature(text):
+    """Return the MinHash signature (an array of NUM_PERM uint32s) of the given
+    text, or None if it's too short.
+    """
+    shingles = shingle_hashes(text)
+    if shingles is None:
+        return None
+    hashed = (_A[:, None] * shingles[None, :] + _B[:, None]) >> np.uint64(32)
+    return hashed.min(axis=1).astype(np.uint32)
+
+def band_keys(sig):
+    """Return an array of BANDS uint64 keys, one per band of the given signature."""
+    rows = sig.astype(np.uint64).reshape(BANDS, ROWS)
+    return (rows * _MIX[None, :]).sum(axis=1) ^ _BAND_SALT
+
+def similarity(sig1, sig2):
+    """Estimated Jaccard similarity of the shingle sets of two signatures."""
+    return float(np.mean(sig1 == sig2))
+
+class UnionFind:
+
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, i):
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, i, j):
+        self.parent[self.find(i)] = self.find(j)
+
+def find_clusters(sigs):
+    """Given a list of signatures, return a list of clusters of near-duplicates
+    (each a list of indices into sigs), including singletons.
+    """
+    buckets = {}
+    uf = UnionFind(len(sigs))
+    for i, sig in enumerate(sigs):
+        for key in band_keys(sig).tolist():
+            first = buckets.setdefault(key, i)
+            if first != i and similarity(sig, sigs[first]) >= SIMILARITY_THRESHOLD:
+                uf.union(i, first)
+    clusters = {}
+    for i in range(len(sigs)):
+        clusters.setdefault(uf.find(i), []).append(i)
+    return list(clusters.values())
+
+class CopypastaIndex:
+    """The signatures of known copypasta comments, bucketed by band key."""
+
+    def __init__(self, sigs, cluster_ids):
+        self.sigs = np.asarray(sigs, dtype=np.uint32).reshape(-1, NUM_PERM)
+        self.cluster_ids = np.asarray(cluster_ids, dtype=np.int64)
+        self.buckets = {}
+        for i, sig in enumerate(self.sigs):
+            for key in band_keys(sig).tolist():
+                self.buckets.setdefault(key, []).append(i)
+
+    @classmethod
+    def build(cls, bodies, min_cluster_size=MIN_CLUSTER_SIZE):
+        sigs = [sig for sig in map(signature, bodies) if sig is not None]
+        members, cluster_ids = [], []
+        clusters = [cluster for cluster in find_clusters(sigs) if len(cluster) >= min_cluster_size]
+        for cluster_id, cluster in enumerate(clusters):
+            members += cluster
+            cluster_ids += [cluster_id] * len(cluster)
+        return cls([sigs[i] for i in members], cluster_ids)
+
+    def save(self, path=DEFAULT_INDEX_PATH):
+        np.savez_compressed(path, sigs=self.sigs, cluster_ids=self.cluster_ids)
+
+    @classmethod
+    def load(cls, path=DEFAULT_INDEX_PATH):
+        with np.load(path) as f:
+            return cls(f['sigs'], f['cluster_ids'])
+
+    @property
+    def nclusters(self):
+        return len(np.unique(self.cluster_ids))
+
+    def match(self, text):
+        """Return the id of the copypasta cluster the given text is a
+        near-duplicate of, or None.
+        """
+        sig = signature(text)
+        if sig is None:
+            return None
+        for key in band_keys(sig).tolist():
+            for i in self.buckets.get(key, ()):
+                if similarity(sig, self.sigs[i]) >= SIMILARITY_THRESHOLD:
+                    return int(self.cluster_ids[i])
+        return None
+
+    def __contains__(self, text):
+        return self.match(text) is not None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build or query an index of near-duplicate copypasta")
+    parser.add_argument('--index', default=DEFAULT_INDEX_PATH)
+    subparsers = parser.add_subparsers(dest='cmd', required=True)
+    build_parser = subparsers.add_parser('build')
+    build_parser.add_argument('--min-cluster-size', type=int, default=MIN_CLUSTER_SIZE)
+    check_parser = subparsers.add_parser('check')
+    check_parser.add_argument('text')
+    args = parser.parse_args()
+
+    if args.cmd == 'build':
+        from substring_index import iter_corpus_comments
+        index = CopypastaIndex.build((comment['body'] for comment in iter_corpus_comments()),
+                args.min_cluster_size)
+        index.save(args.index)
+        print(f"Saved {len(index.sigs)} comments in {index.nclusters} copypasta clusters to {args.index}")
+    elif args.cmd == 'check':
+        index = CopypastaIndex.load(args.index)
+        cluster = index.match(args.text)
+        print("Not copypasta" if cluster is None else f"Copypasta (cluster {cluster})")
@@ -0,0 +1,125 @@
+"""On-disk cache of per-term counting results, used by compute_counts --incremental.
+
+The cache is a json manifest recording, for each term, the size, mtime and
+content hash of each input file its results were computed from, along with
+the results themselves. A cached result is reused as long as its input files
+are unchanged (judged by size and mtime, falling back to the content hash if
+the mtime has changed) and the fingerprint of the counting logic matches the
+one the cache was written with. Changing any of the filtering functions
+therefore invalidates the whole cache.
+
+Inputs that aren't files of their own (e.g. a term's rows in a CommentDB) are
+recorded with a signature supplied by the caller, and are unchanged as long as
+that signature is the same.
+"""
+import os
+import sys
+import json
+import hashlib
+import inspect
+
+DEFAULT_CACHE_PATH = '.count_cache.json'
+
+def logic_fingerprint(objs):
+    """Return a hash of the source code of the given functions/classes (or
+    the reprs of any constants among them).
+    """
+    h = hashlib.sha256()
+    for obj in objs:
+        try:
+            src = inspect.getsource(obj)
+        except TypeError:
+            src = repr(obj)
+        h.update(src.encode('utf-8'))
+    return h.hexdigest()
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def file_signature(path):
+    st = os.stat(path)
+    return dict(size=st.st_size, mtime=st.st_mtime_ns, sha256=file_hash(path))
+
+def _contents(sig):
+    # Only the hash identifies a file's contents. Other signatures are compared whole.
+    return sig.get('sha256', sig)
+
+def same_contents(sigs1, sigs2):
+    return (sorted(sigs1) == sorted(sigs2)
+            and all(_contents(sigs1[path]) == _contents(sigs2[path]) for path in sigs1))
+
+class CountCache:
+
+    def __init__(self, fingerprint, path=DEFAULT_CACHE_PATH):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.terms = {}
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return
+        if manifest['fingerprint'] != fingerprint:
+            sys.stderr.write("Counting logic has changed since cache was written. Ignoring cached counts.\n")
+            return
+        self.terms = manifest['terms']
+
+    def _unchanged(self, inputs, paths, signatures):
+        """Return whether the files at the given paths match the given recorded
+        signatures. Inputs with a current signature in signatures are compared
+        by that instead. Updates the recorded mtimes of files whose mtime has
+        changed but whose contents haven't.
+        """
+        if sorted(inputs) != sorted(paths):
+            return False
+        for path in paths:
+            sig = inputs[path]
+            if path in signatures:
+                if signatures[path] != sig:
+                    return False
+                continue
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                return False
+            if st.st_size != sig['size']:
+                return False
+            if st.st_mtime_ns != sig['mtime']:
+                if file_hash(path) != sig['sha256']:
+                    return False
+                sig['mtime'] = st.st_mtime_ns
+        return True
+
+    def get(self, term, kind, paths, signatures=None):
+        """Return the cached result of the given kind for the given term, if
+        there is one computed from the current contents of the given inputs.
+        Otherwise return None. signatures gives the current signatures of any
+        inputs that aren't files.
+        """
+        entry = self.terms.get(term)
+        if entry is None or kind not in entry['results']:
+            return None
+        if not self._unchanged(entry['inputs'], paths, signatures or {}):
+            return None
+        return entry['results'][kind]
+
+    def put(self, term, kind, result, signatures):
+        """Record a result for the given term, computed from inputs with the
+        given signatures (a dict mapping path to file_signature(path), or to
+        the signature passed to get, for inputs that aren't files).
+        """
+        entry = self.terms.get(term)
+        if entry is None or not same_contents(entry['inputs'], signatures):
+            entry = self.terms[term] = dict(results={})
+        entry['inputs'] = signatures
+        entry['results'][kind] = result
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(dict(fingerprint=self.fingerprint, terms=self.terms), f)
+        os.replace(tmp, self.path)
@@ -0,0 +1,120 @@
+"""Plan the order in which reddit_counts.py downloads terms, so that a run
+with a limited budget of requests spends it on the most useful terms first.
+
+Each term not already covered by counts.csv gets an estimated count, taken
+from Pushshift's hit counts (reddit_counts.py --count-only) if we have them,
+and otherwise predicted from the counts of the other terms sharing its prefix
+and suffix: log(1 + count) is modelled as a prefix effect plus a suffix
+effect. From the estimate we get the number of requests the download should
+take, and a value: log10(1 + estimate), i.e. how much the term matters to the
+plots, which are mostly on a log scale. Terms whose estimate exceeds the
+per-term cap will end up being sampled, so downloading them in full is worth
+much less. Terms are downloaded in decreasing order of value per request.
+
+The plan is saved to a json file so that later runs (e.g. nightly, each with
+a budget of a few thousand requests) carry on in the same order, skipping
+terms that have been finished.
+"""
+import os
+import json
+import math
+import datetime
+
+import numpy as np
+
+DEFAULT_PLAN_PATH = 'download_plan.json'
+
+# Downloading a term that will end up being sampled only tells us its count is
+# above the cap, so is worth this fraction of what it otherwise would be.
+SAMPLED_DISCOUNT = .1
+
+def covered_terms(counts_df):
+    """Return the set of terms which already have a row in the given counts dataframe."""
+    return set(counts_df.pre + counts_df.suff)
+
+def marginal_estimates(counts_df, pairs):
+    """Return a dict mapping each of the given (pre, suff) pairs to a count
+    predicted from the counts (in counts_df) of other terms with the same
+    prefix or suffix, under an additive model of log(1 + count).
+    """
+    logs = np.log1p(counts_df['count'].astype(float))
+    grand = logs.mean() if len(logs) else 0.0
+    pre_effects = (logs.groupby(counts_df.pre).mean() - grand).to_dict()
+    suff_effects = (logs.groupby(counts_df.suff).mean() - grand).to_dict()
+    return {(pre, suff): math.expm1(max(0.0, grand + pre_effects.get(pre, 0.0) + suff_effects.get(suff, 0.0)))
+            for pre, suff in pairs}
+
+def expected_requests(estimate, results_per_request, max_requests):
+    # The last page is the first one that isn't full
+    return min(max_requests, math.floor(estimate / results_per_request) + 1)
+
+def make_plan(pairs, counts_df, hits=None, results_per_request=100, max_requests=400):
+    """Return a plan (a dict) for downloading the given (pre, suff) pairs that
+    aren't already covered by counts_df. hits, if given, maps terms to
+    Pushshift hit counts, which are preferred to our own estimates.
+    """
+    covered = covered_terms(counts_df)
+    todo = [(pre, suff) for pre, suff in pairs if pre + suff not in covered]
+    estimates = marginal_estimates(counts_df, todo)
+    cap = results_per_request * max_requests
+    entries = []
+    for pre, suff in todo:
+        term = pre + suff
+        if hits is not None and term in hits:
+            estimate, source = float(hits[term]), 'hits'
+        else:
+            estimate, source = estimates[(pre, suff)], 'marginals'
+        requests = expected_requests(estimate, results_per_request, max_requests)
+        value = math.log10(1 + estimate) * (SAMPLED_DISCOUNT if estimate >= cap else 1)
+        entries.append(dict(term=term, estimate=round(estimate, 1), source=source,
+            requests=requests, priority=value / requests, done=False,
+        ))
+    # Stable sort, so ties stay in declaration order
+    entries.sort(key=lambda entry: -entry['priority'])
+    return dict(created=datetime.datetime.now().isoformat(timespec='seconds'), terms=entries)
+
+def shard_plan_path(i, n):
+    """Default path of the plan for the i-th of n shards (see sharding.py)."""
+    root, ext = os.path.splitext(DEFAULT_PLAN_PATH)
+    return f"{root}.{i}of{n}{ext}"
+
+def load_plan(path=DEFAULT_PLAN_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def save_plan(plan, path=DEFAULT_PLAN_PATH):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(plan, f, indent=1)
+    os.replace(tmp, path)
+
+def pending_terms(plan):
+    return [entry['term'] for entry in plan['terms'] if not entry['done']]
+
+def mark_done(plan, term):
+    for entry in plan['terms']:
+        if entry['term'] == term:
+            entry['done'] = True
+
+class RequestBudget:
+    """A global limit on the number of requests a run may make."""
+
+    def __init__(self, n=None):
+        # None means unlimited
+        self.remaining = n
+
+    def take(self):
+        """Use up one request from the budget. Return False if there were none left."""
+        if self.remaining is None:
+            return True
+        if self.remaining <= 0:
+            return False
+        self.remaining -= 1
+        return True
+
+    @property
+    def exhausted(self):
+        return self.remaining is not None and self.remaining <= 0
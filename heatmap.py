@@ -3,6 +3,7 @@ import matplotlib as mpl
 from matplotlib import pyplot as plt
 import math
 import numpy as np
+import pandas as pd
 
 DEFAULT_FIGSIZE = (18, 14)
 
@@ -42,22 +43,23 @@ def make_heatmap(df,
         normalize_rows=False,
         **heatmap_kwargs,
         ):
+    """df may be either a dataframe with a row per compound (as returned by
+    viz_helpers.load_df), or an AffixMatrix. The latter is faster if making
+    lots of heatmaps from the same data.
+    """
     assert not (ax and return_fig), "return_fig not supported when providing ax"
     if ax is None:
         fig, ax = plt.subplots(figsize=figsize)
-    mat = matricize_df(df, sort, 'count')
+    am = df if isinstance(df, AffixMatrix) else AffixMatrix.from_df(df)
+    am = am.sorted(sort)
 
     if normalize_rows:
         # make rows sum to same amount
-        rowsum = mat.mean(axis=1).mean()
-        mat = mat.apply(lambda row: rowsum * (row/row.mean()), axis=1) 
+        am = am.normalize_rows()
+    mat = am.to_frame()
 
     if wiki:
-        dd = df.copy()
-        # Column for annot text
-        dd['wtext'] = ''
-        dd.loc[dd.wikt, 'wtext'] = wiki_glyph
-        annots = matricize_df(dd, sort, 'wtext')
+        annots = am.to_frame(np.where(am.wikt, wiki_glyph, ''))
     else:
         annots = None
 
@@ -111,7 +113,7 @@ def matricize_df(df, sort=False, col='count'):
             otherwise, order of rows and columns is undefined
     - col: name of column in df having comment counts
     """
-    mat = df.pivot("pre", "suff", col)
+    mat = df.pivot(index="pre", columns="suff", values=col)
     if sort == 'log':
         xf = df.copy()
         xf['logcount'] = np.log10(xf['count'] + 10)
@@ -124,3 +126,107 @@ def matricize_df(df, sort=False, col='count'):
         suffcounts = df.groupby('suff')['count'].sum().sort_values(ascending=False)
         mat = mat.loc[precounts.index, suffcounts.index]
     return mat
+
+class AffixMatrix:
+    """Dense matrix of counts with rows labelled by prefixes and columns by
+    suffixes. Equivalent to the output of matricize_df, but meant to be built
+    once (e.g. from the full dataframe returned by viz_helpers.load_df()) and
+    then cheaply sliced, sorted and normalized to make lots of small heatmaps.
+
+    am = AffixMatrix.from_df(viz_helpers.load_df())
+    make_heatmap(am.sub(pres=['butt', 'ass', 'bum'], suffs=am.top_suffixes(['butt', 'ass', 'bum'], 10)))
+    """
+
+    def __init__(self, counts, pres, suffs, wikt=None):
+        self.counts = counts
+        self.pres = list(pres)
+        self.suffs = list(suffs)
+        self.wikt = wikt if wikt is not None else np.zeros(counts.shape, dtype=bool)
+        self.pre_index = {pre: i for i, pre in enumerate(self.pres)}
+        self.suff_index = {suff: i for i, suff in enumerate(self.suffs)}
+        self._orders = {}
+
+    @classmethod
+    def from_df(cls, df, col='count'):
+        """Params:
+        - df: dataframe with row per compound, having columns "pre", "suff", and col,
+              and optionally "wikt"
+        """
+        # Rows and columns in alphabetical order (as with df.pivot)
+        pres = sorted(df.pre.unique())
+        suffs = sorted(df.suff.unique())
+        pre_index = {pre: i for i, pre in enumerate(pres)}
+        suff_index = {suff: i for i, suff in enumerate(suffs)}
+        rows = df.pre.map(pre_index).to_numpy()
+        cols = df.suff.map(suff_index).to_numpy()
+        counts = np.full((len(pres), len(suffs)), np.nan)
+        counts[rows, cols] = df[col].to_numpy(dtype=float)
+        wikt = None
+        if 'wikt' in df.columns:
+            wikt = np.zeros(counts.shape, dtype=bool)
+            wikt[rows, cols] = df['wikt'].to_numpy(dtype=bool)
+        return cls(counts, pres, suffs, wikt)
+
+    def _sort_orders(self, sort):
+        """Return (row order, column order) arrays for the given sort setting
+        (as in matricize_df), computing them on first use.
+        """
+        key = 'log' if sort == 'log' else 'linear'
+        if key not in self._orders:
+            vals = np.log10(self.counts + 10) if key == 'log' else self.counts
+            rowsums = np.nansum(vals, axis=1)
+            colsums = np.nansum(vals, axis=0)
+            self._orders[key] = (
+                    np.argsort(-rowsums, kind='stable'),
+                    np.argsort(-colsums, kind='stable'),
+            )
+        return self._orders[key]
+
+    def _take(self, rows, cols):
+        return AffixMatrix(
+                self.counts[np.ix_(rows, cols)],
+                [self.pres[i] for i in rows],
+                [self.suffs[i] for i in cols],
+                self.wikt[np.ix_(rows, cols)],
+        )
+
+    def sorted(self, sort=True):
+        """Return a copy with rows and columns sorted descending by the sum of
+        log counts (if sort is 'log') or the sum of counts (if sort is otherwise
+        truthy). If sort is falsy, return self.
+        """
+        if not sort:
+            return self
+        return self._take(*self._sort_orders(sort))
+
+    def sub(self, pres=None, suffs=None):
+        """Return the sub-matrix for the given prefixes and suffixes (defaulting to all)."""
+        rows = np.arange(len(self.pres)) if pres is None else [self.pre_index[pre] for pre in pres]
+        cols = np.arange(len(self.suffs)) if suffs is None else [self.suff_index[suff] for suff in suffs]
+        return self._take(rows, cols)
+
+    def normalize_rows(self):
+        """Return a copy with each row scaled to have the same mean."""
+        means = np.nanmean(self.counts, axis=1)
+        target = means.mean()
+        return AffixMatrix(self.counts * (target / means)[:, None], self.pres, self.suffs, self.wikt)
+
+    def top_suffixes(self, pres, k):
+        """Return the k suffixes having the highest total count when combined with the given prefixes."""
+        rows = [self.pre_index[pre] for pre in pres]
+        totals = np.nansum(self.counts[rows], axis=0)
+        return [self.suffs[i] for i in np.argsort(-totals, kind='stable')[:k]]
+
+    def top_prefixes(self, suffs, k):
+        """Return the k prefixes having the highest total count when combined with the given suffixes."""
+        cols = [self.suff_index[suff] for suff in suffs]
+        totals = np.nansum(self.counts[:, cols], axis=1)
+        return [self.pres[i] for i in np.argsort(-totals, kind='stable')[:k]]
+
+    def to_frame(self, values=None):
+        """Return a dataframe labelled by affixes, with the given values (defaulting to counts)."""
+        values = self.counts if values is None else values
+        return pd.DataFrame(values,
+                index=pd.Index(self.pres, name='pre'),
+                columns=pd.Index(self.suffs, name='suff'),
+        )
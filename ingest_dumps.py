@@ -0,0 +1,158 @@
+"""Ingest comments for all our compounds from monthly Reddit comment dump files
+(RC_YYYY-MM.zst, as distributed by Pushshift), as an alternative to the API.
+
+    python ingest_dumps.py /path/to/dumps/ --jobs 16
+
+Each month file is stream-decompressed by its own worker process. Every
+comment whose body contains one of our prefix x suffix compounds is saved
+(in the same form as comments from the API, see dump_comment) to a shard for that term and
+month, e.g. dump_comment_data/poophead/RC_2015-06.jsonl. Once a month is
+finished it's recorded in dump_comment_data/_ingested.json, and skipped by
+later runs. compute_counts.py reads these shards in preference to any data
+downloaded via the API, giving exact (unsampled, uncapped) counts.
+"""
+import io
+import os
+import re
+import sys
+import glob
+import json
+import argparse
+import multiprocessing
+from collections import defaultdict
+
+import zstandard
+
+import comment_store
+from compute_counts import DUMP_DIR, all_terms
+from reddit_counts import prefixes, suffixes, shake_comment_data
+from term_matcher import TermMatcher, trie_pattern
+
+# Some dump files were compressed with a long window
+MAX_WINDOW_SIZE = 2**31
+
+# Flush a term's buffered comments to disk once it has this many
+FLUSH_EVERY = 1000
+
+month_pattern = re.compile(r'RC_(\d{4}-\d{2})\.zst$')
+
+def iter_dump_lines(path):
+    with open(path, 'rb') as fh:
+        dctx = zstandard.ZstdDecompressor(max_window_size=MAX_WINDOW_SIZE)
+        with dctx.stream_reader(fh) as reader:
+            yield from io.TextIOWrapper(reader, encoding='utf-8', errors='replace')
+
+# Built once per worker process, by _init_worker
+_matcher = None
+_compound_pattern = None
+
+def _init_worker(terms):
+    global _matcher, _compound_pattern
+    _matcher = TermMatcher(terms)
+    # Matches exactly when some prefix x suffix compound does, but in C
+    _compound_pattern = re.compile(f'(?:{trie_pattern(prefixes)})(?:{trie_pattern(suffixes)})')
+
+def dump_comment(comment):
+    """Return the given comment from a dump file in the form the API gives
+    it: with only the fields in COMMENT_ATTR_WHITELIST, numbers as ints (the
+    dumps often have them as strings), and a permalink, which older dumps
+    lack (and which the counting code identifies comments by).
+    """
+    shaken = shake_comment_data(comment)
+    shaken['created_utc'] = int(shaken['created_utc'])
+    if shaken.get('score') is not None:
+        shaken['score'] = int(shaken['score'])
+    if not shaken.get('permalink'):
+        # Same shape as the real thing, minus the title slug
+        link_id = comment['link_id'].partition('_')[2]
+        shaken['permalink'] = f"/r/{comment['subreddit']}/comments/{link_id}/_/{comment['id']}/"
+    return shaken
+
+def ingest_month(args):
+    """Scan the given month's dump file, writing matching comments to per-term
+    shards in out_dir. Return the month (e.g. 'RC_2015-06') and number of
+    matching comments.
+    """
+    path, out_dir = args
+    month = os.path.basename(path)[:-len('.zst')]
+    buffers = defaultdict(list)
+    tmp_paths = set()
+
+    def flush(term):
+        tmp = comment_store.shard_path(out_dir, term, month) + '.tmp'
+        if tmp not in tmp_paths:
+            os.makedirs(os.path.dirname(tmp), exist_ok=True)
+            # Clear out any leftovers from an interrupted run
+            open(tmp, 'w').close()
+            tmp_paths.add(tmp)
+        with open(tmp, 'a', encoding='utf-8') as f:
+            f.writelines(json.dumps(comment) + '\n' for comment in buffers[term])
+        buffers[term] = []
+
+    nmatched = 0
+    for line in iter_dump_lines(path):
+        # Searching the whole line for compounds costs more than parsing it
+        # (most of it is metadata), so we only search the body. The regex
+        # rejects most comments much faster than the matcher could.
+        comment = json.loads(line)
+        body = comment.get('body')
+        if not body:
+            continue
+        lower = body.lower()
+        if not _compound_pattern.search(lower):
+            continue
+        found = _matcher.terms_in(lower)
+        nmatched += 1
+        shaken = dump_comment(comment)
+        for term in found:
+            buffers[term].append(shaken)
+            if len(buffers[term]) >= FLUSH_EVERY:
+                flush(term)
+    for term in list(buffers):
+        if buffers[term]:
+            flush(term)
+    # Only make the month's shards visible once it's complete
+    for tmp in tmp_paths:
+        os.replace(tmp, tmp[:-len('.tmp')])
+    return month, nmatched
+
+def ingest(dump_paths, out_dir=DUMP_DIR, jobs=1):
+    terms = all_terms()
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = comment_store.read_ingest_manifest(out_dir) or dict(terms=terms, months=[])
+    if sorted(manifest['terms']) != sorted(terms):
+        sys.exit(f"ERROR: {out_dir} was ingested with a different set of terms. "
+                "Ingest into a fresh directory (--out).")
+    todo = []
+    for path in sorted(dump_paths):
+        match = month_pattern.search(path)
+        assert match, f"Unexpected dump file name: {path}"
+        if os.path.basename(path)[:-len('.zst')] not in manifest['months']:
+            todo.append(path)
+    sys.stderr.write(f"Ingesting {len(todo)} month files ({len(manifest['months'])} already done).\n")
+    tasks = [(path, out_dir) for path in todo]
+    with multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(terms,)) as pool:
+        for month, nmatched in pool.imap_unordered(ingest_month, tasks):
+            manifest['months'].append(month)
+            comment_store.write_ingest_manifest(out_dir, manifest)
+            sys.stderr.write(f"{month}: {nmatched} matching comments\n")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Ingest comments for all compounds from monthly dump files")
+    parser.add_argument('dumps', nargs='+',
+            help="RC_YYYY-MM.zst files, or directories containing them",
+    )
+    parser.add_argument('--out', default=DUMP_DIR,
+            help="Directory to write per-term shards to. NB: compute_counts only reads from the default.",
+    )
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+            help="Number of month files to process at once",
+    )
+    args = parser.parse_args()
+    paths = []
+    for path in args.dumps:
+        if os.path.isdir(path):
+            paths += glob.glob(os.path.join(path, 'RC_*.zst'))
+        else:
+            paths.append(path)
+    ingest(paths, args.out, args.jobs)
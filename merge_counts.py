@@ -0,0 +1,94 @@
+"""Combine the partial outputs of sharded runs (see sharding.py) of
+compute_counts.py (pre,suff,count or pre,suff,sub,count) or
+reddit_counts.py --count-only into one csv, with rows in the same order as an
+unsharded run would have output them.
+
+    python merge_counts.py counts.*.csv > counts.csv
+
+Checks that every term is covered by exactly one of the parts. Terms can have
+no rows at all in a breakdown by subreddit/year (if they have no comments), so
+for those, pass --counts with the merged totals to confirm that the terms
+missing from the breakdown really have a count of zero.
+"""
+import sys
+import csv
+import argparse
+import itertools
+
+from reddit_counts import prefixes, suffixes
+
+def read_part(path):
+    """Return a tuple of (header, dict mapping term to its list of rows) for
+    the given partial output, with rows as lists of strings.
+    """
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        assert header[:2] == ['pre', 'suff'], f"Unexpected header in {path}: {header}"
+        rows = {}
+        for row in reader:
+            rows.setdefault(row[0] + row[1], []).append(row)
+    return header, rows
+
+def merge(paths, zero_terms=None):
+    """Return a tuple of (header, rows in canonical order, list of problems)
+    for the given partial outputs. zero_terms, if given, is the set of terms
+    known to have a count of 0, which may be absent from a breakdown.
+    """
+    problems = []
+    header = None
+    owner = {}
+    rows = {}
+    for path in paths:
+        part_header, part_rows = read_part(path)
+        if header is None:
+            header = part_header
+        elif part_header != header:
+            problems.append(f"{path} has header {part_header}, but {paths[0]} has {header}")
+            continue
+        for term, term_rows in part_rows.items():
+            if term in owner:
+                problems.append(f"{term!r} is in both {owner[term]} and {path}")
+                continue
+            owner[term] = path
+            rows[term] = term_rows
+    # With no breakdown, each term has exactly one row
+    breakdown = 'sub' in header or 'year' in header
+    if not breakdown:
+        problems += [f"{term!r} has {len(term_rows)} rows in {owner[term]}"
+                for term, term_rows in rows.items() if len(term_rows) > 1]
+    terms = [pre + suff for pre, suff in itertools.product(prefixes, suffixes)]
+    known = set(terms)
+    problems += [f"{term!r} (in {owner[term]}) isn't one of our terms" for term in rows if term not in known]
+    missing = [term for term in terms if term not in rows]
+    if breakdown and zero_terms is not None:
+        missing = [term for term in missing if term not in zero_terms]
+    if missing and (not breakdown or zero_terms is not None):
+        problems.append(f"{len(missing)} terms are missing from every part, e.g. {missing[:5]}")
+    elif missing:
+        sys.stderr.write(f"WARNING: {len(missing)} terms have no rows (pass --counts to check they have no comments)\n")
+    merged = [row for term in terms for row in rows.get(term, [])]
+    return header, merged, problems
+
+def zero_count_terms(path):
+    header, rows = read_part(path)
+    col = header.index('count' if 'count' in header else 'hits')
+    return {term for term, term_rows in rows.items() if float(term_rows[0][col]) == 0}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Merge partial outputs of sharded runs into one csv on stdout")
+    parser.add_argument('parts', nargs='+')
+    parser.add_argument('--counts', metavar='CSV',
+            help="Merged per-term counts, used to check that terms absent from a breakdown have none",
+    )
+    args = parser.parse_args()
+    zero_terms = zero_count_terms(args.counts) if args.counts else None
+    header, merged, problems = merge(args.parts, zero_terms)
+    if problems:
+        for problem in problems:
+            sys.stderr.write(f"ERROR: {problem}\n")
+        sys.exit(1)
+    # Rows are written back out exactly as they were read
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    writer.writerow(header)
+    writer.writerows(merged)
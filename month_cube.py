@@ -0,0 +1,81 @@
+"""Counts per (prefix, suffix, month), for looking at how usage of terms has
+changed over time.
+
+Created by running
+    python compute_counts.py --cube month_counts.npz > counts.csv
+(counts are computed in the same pass) and loaded with
+    cube = MonthCube.load('month_counts.npz')
+    cube.series('dumb', 'ass').plot()
+
+For sampled terms, each month's count is extrapolated using the sampling rate
+for its year, so will be fairly noisy.
+"""
+import numpy as np
+import pandas as pd
+
+# Reddit launched in June 2005
+FIRST_MONTH = np.datetime64('2005-06', 'M')
+
+def month_axis(end_timestamp):
+    """Return an array of the months (as datetime64[M]) from FIRST_MONTH up
+    to the one containing the second before end_timestamp.
+    """
+    last = np.datetime64(end_timestamp - 1, 's').astype('datetime64[M]')
+    return np.arange(FIRST_MONTH, last + 1)
+
+def bin_by_month(timestamps, months, weights=None):
+    """Return an array of (weighted) counts of the given utc timestamps falling
+    in each of the given (consecutive) months. Timestamps outside that range
+    are ignored.
+    """
+    idx = (np.asarray(timestamps, dtype='int64').astype('datetime64[s]').astype('datetime64[M]') - months[0]).astype(np.int64)
+    inrange = (idx >= 0) & (idx < len(months))
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float64)[inrange]
+    return np.bincount(idx[inrange], weights=weights, minlength=len(months)).astype(np.float64)
+
+class MonthCube:
+
+    def __init__(self, counts, pres, suffs, months):
+        # counts has shape (len(pres), len(suffs), len(months))
+        self.counts = counts
+        self.pres = list(pres)
+        self.suffs = list(suffs)
+        self.months = np.asarray(months, dtype='datetime64[M]')
+        self.pre_index = {pre: i for i, pre in enumerate(self.pres)}
+        self.suff_index = {suff: i for i, suff in enumerate(self.suffs)}
+
+    @classmethod
+    def build(cls, pres, suffs, months, rows):
+        """Build from an iterable of (pre, suff, monthly counts) tuples."""
+        cube = cls(np.zeros((len(pres), len(suffs), len(months))), pres, suffs, months)
+        for pre, suff, month_counts in rows:
+            cube.counts[cube.pre_index[pre], cube.suff_index[suff]] = month_counts
+        return cube
+
+    def save(self, path):
+        np.savez_compressed(path,
+                counts=self.counts,
+                pres=np.array(self.pres), suffs=np.array(self.suffs),
+                months=self.months.astype(str),
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['counts'], f['pres'], f['suffs'], f['months'])
+
+    def month_index(self):
+        return pd.PeriodIndex(self.months.astype(str), freq='M')
+
+    def series(self, pre, suff):
+        """Return a series of monthly counts for the given term."""
+        return pd.Series(self.counts[self.pre_index[pre], self.suff_index[suff]], index=self.month_index())
+
+    def prefix_totals(self):
+        """Return a dataframe of monthly counts summed over suffixes, with a column per prefix."""
+        return pd.DataFrame(self.counts.sum(axis=1).T, index=self.month_index(), columns=self.pres)
+
+    def suffix_totals(self):
+        """Return a dataframe of monthly counts summed over prefixes, with a column per suffix."""
+        return pd.DataFrame(self.counts.sum(axis=0).T, index=self.month_index(), columns=self.suffs)
@@ -0,0 +1,170 @@
+"""Async client for the Pushshift comment search endpoint, shared by
+reddit_counts.py and sampled_counts.py.
+
+All requests made through a PushshiftClient share a pool of keep-alive
+connections and a single token bucket, so any number of terms/intervals can be
+in flight at once while the total request rate stays within budget.
+
+The endpoint can be pointed elsewhere (e.g. at a local stand-in server for
+testing) by setting the PUSHSHIFT_URL environment variable, or passing url
+to PushshiftClient.
+"""
+import os
+import sys
+import time
+import asyncio
+import email.utils
+
+import aiohttp
+
+SEARCH_URL = os.environ.get('PUSHSHIFT_URL', "https://api.pushshift.io/reddit/comment/search")
+
+USER_AGENT = "script by /u/halfeatenscone"
+
+# If we get a response code other than 200, we will retry up to this many times,
+# waiting 2, 4, 8... seconds between attempts (or however long the server asks
+# us to wait via a Retry-After header)
+MAX_RETRIES = 8
+
+# Default budget shared by all requests. Pushshift asks for no more than one
+# request per second.
+DEFAULT_REQUESTS_PER_SECOND = 1.0
+
+# Max number of simultaneously open connections
+DEFAULT_MAX_CONNECTIONS = 8
+
+class TokenBucket:
+    """Rate limiter allowing bursts of up to capacity requests, refilled at a
+    rate of rate tokens per second.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    async def acquire(self):
+        # Waiters queue up on the lock, so tokens are handed out in FIFO order.
+        async with self.lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+def retry_after_seconds(header):
+    """Parse the value of a Retry-After header (either a number of seconds or
+    an HTTP date). Return None if it's missing or unparseable.
+    """
+    if header is None:
+        return None
+    try:
+        return max(0.0, float(header))
+    except ValueError:
+        pass
+    try:
+        dt = email.utils.parsedate_to_datetime(header)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, dt.timestamp() - time.time())
+
+def total_hits(dat):
+    """Return the total number of comments matching a search, from the metadata
+    of its (metadata=true) response.
+    """
+    meta = dat['metadata']
+    if 'total_results' in meta:
+        return meta['total_results']
+    # Newer versions of the API pass through Elasticsearch's response
+    total = meta['es']['hits']['total']
+    if isinstance(total, dict):
+        if total.get('relation') == 'gte':
+            sys.stderr.write(f"WARNING: hit count {total['value']} is only a lower bound\n")
+        total = total['value']
+    return total
+
+def agg_counts(dat, agg):
+    """Return a dict mapping bucket key to doc count for the given aggregation
+    (e.g. 'subreddit') of a search response.
+    """
+    return {bucket['key']: bucket['doc_count'] for bucket in dat['aggs'][agg]}
+
+class PushshiftClient:
+    """Usage:
+        async with PushshiftClient(requests_per_second=2) as client:
+            dat = await client.search(q='poophead', limit=100, sort='desc')
+            meta = await client.count(q='poophead', aggs=['subreddit'])
+    """
+
+    def __init__(self, requests_per_second=DEFAULT_REQUESTS_PER_SECOND,
+            max_connections=DEFAULT_MAX_CONNECTIONS,
+            url=SEARCH_URL,
+            ):
+        self.url = url
+        self.bucket = TokenBucket(requests_per_second)
+        self.max_connections = max_connections
+        self.session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        self.session = aiohttp.ClientSession(
+                connector=connector,
+                headers={'User-Agent': USER_AGENT},
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    async def search(self, **params):
+        """Return the decoded json response to a search with the given params,
+        or None if we still couldn't get a successful response after
+        MAX_RETRIES retries.
+        """
+        retries = 0
+        while True:
+            await self.bucket.acquire()
+            retry_after = None
+            try:
+                async with self.session.get(self.url, params=params) as response:
+                    if response.status == 200:
+                        return await response.json(content_type=None)
+                    problem = f"status {response.status}"
+                    retry_after = retry_after_seconds(response.headers.get('Retry-After'))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                problem = repr(e)
+            retries += 1
+            if retries > MAX_RETRIES:
+                sys.stderr.write(f"WARNING: giving up on search {params} after max retries ({problem})\n")
+                return None
+            wait = 2**retries if retry_after is None else retry_after
+            await asyncio.sleep(wait)
+
+    async def count(self, aggs=(), frequency=None, **params):
+        """Return counts of the comments matching a search with the given params,
+        without fetching any of them, or None after MAX_RETRIES retries.
+
+        The result is a dict with key 'total' (the number of matching comments),
+        plus one for each of the given aggregations (e.g. 'subreddit', or
+        'created_utc' bucketed by frequency, e.g. 'year'), mapping bucket key
+        to number of comments.
+        """
+        params = dict(params, size=0, metadata='true')
+        if aggs:
+            params['aggs'] = ','.join(aggs)
+        if frequency:
+            params['frequency'] = frequency
+        dat = await self.search(**params)
+        if dat is None:
+            return None
+        counts = dict(total=total_hits(dat))
+        for agg in aggs:
+            counts[agg] = agg_counts(dat, agg)
+        return counts
@@ -1,23 +1,31 @@
 import os
-import requests
 import json
 import datetime
-import time
 import itertools
 import sys
+import asyncio
+import argparse
 import pandas as pd
 
+import comment_store
+import pushshift
+import download_plan
+import sharding
+
 END_TIMESTAMP = int(datetime.datetime(2021, 1, 1).timestamp())
 # Get all comments before 2021. This can be set to a later date to, e.g. fetch only comments for 2020
 EARLIEST_TIMESTAMP = 0
 
+def high_water_mark(cursor):
+    """Return the timestamp before which a term's stored comments are
+    complete, given its cursor. This is END_TIMESTAMP, unless the term has
+    since been brought up to date by refresh.py.
+    """
+    return cursor.get('high_water', END_TIMESTAMP)
+
 # Max value of the limit param. cf. https://www.reddit.com/r/pushshift/comments/ih66b8/difference_between_size_and_limit_and_are_they/
 MAX_RESULTS_PER_REQUEST = 100
 
-# If we get a response code other than 200, we will retry up to this many times,
-# waiting 2, 4, 8... seconds between attempts
-MAX_RETRIES = 8
-
 # Cap to avoid spending huge amounts of time on the most common compounds (e.g. douchebag)
 MAX_REQUESTS_PER_TERM = 400
 
@@ -88,51 +96,191 @@ def load_extant(path):
         return []
 
 
-def download_comments(term):
-    outpath = os.path.join(CACHE_DIR, f'{term}.json')
-    comments = load_extant(outpath)
-    if len(comments) == 0:
-        endpoint = END_TIMESTAMP
-    else:
-        endpoint = comments[-1]['created_utc'] - 1
-    retries = 0
-    while len(comments) < MAX_REQUESTS_PER_TERM * MAX_RESULTS_PER_REQUEST:
-        url = f"https://api.pushshift.io/reddit/comment/search?limit={MAX_RESULTS_PER_REQUEST}&sort=desc&before={endpoint}&after={EARLIEST_TIMESTAMP}&q={term}"
-        response = requests.get(url, headers={'User-Agent': "script by /u/halfeatenscone"})
-        time.sleep(1)
-        if response.status_code != 200:
-            retries += 1
-            if retries > MAX_RETRIES:
-                sys.stderr.write(f"WARNING: aborting term {term} after max retries for url {url}\n")
+async def download_comments(term, client, budget=None):
+    """Download comments containing the given term, appending them to its jsonl
+    file in CACHE_DIR (or the comment database) a page at a time. If a previous
+    download of this term was interrupted, pick up where it left off.
+
+    If a download_plan.RequestBudget is given, stop (leaving the download to
+    be resumed later) when it runs out. Return whether the term is finished.
+    """
+    with comment_store.open_writer(CACHE_DIR, term) as writer:
+        if writer.cursor.get('done'):
+            return True
+        if writer.count == 0:
+            # Carry over any data downloaded in the old single json array format.
+            extant = load_extant(os.path.join(CACHE_DIR, f'{term}.json'))
+            if extant:
+                writer.append(extant, created_utc=extant[-1]['created_utc'])
+        if writer.count == 0:
+            endpoint = END_TIMESTAMP
+        else:
+            endpoint = writer.cursor['created_utc'] - 1
+        while writer.count < MAX_REQUESTS_PER_TERM * MAX_RESULTS_PER_REQUEST:
+            if budget and not budget.take():
+                return False
+            dat = await client.search(limit=MAX_RESULTS_PER_REQUEST, sort='desc',
+                    before=endpoint, after=EARLIEST_TIMESTAMP, q=term,
+            )
+            if dat is None:
+                sys.stderr.write(f"WARNING: aborting term {term} after max retries\n")
+                return False
+            results = dat['data']
+            if results:
+                writer.append([shake_comment_data(comm) for comm in results],
+                        created_utc=results[-1]['created_utc'],
+                )
+            if len(results) < MAX_RESULTS_PER_REQUEST:
                 break
-            wait = 2**retries
-            time.sleep(wait)
-            continue
-        dat = response.json()
-        results = dat['data']
-        comments.extend([shake_comment_data(comm) for comm in results])
-        if len(results) < MAX_RESULTS_PER_REQUEST:
-            break
 
-        endpoint = results[-1]['created_utc'] - 1
+            endpoint = results[-1]['created_utc'] - 1
+        # Either we've exhausted the comments for this term, or hit our cap.
+        writer.append([], done=True)
+        return True
 
-    with open(outpath, 'w') as f:
-        json.dump(comments, f, indent=0)
+async def download_all(terms, requests_per_second, concurrency, budget=None, on_done=None):
+    """Download comments for all the given terms, with up to concurrency terms
+    in flight at once, sharing a budget of requests_per_second. Terms are
+    started in the order given. If given, on_done is called with each term
+    that's finished.
+    """
+    sem = asyncio.Semaphore(concurrency)
+    async with pushshift.PushshiftClient(requests_per_second) as client:
+        async def download_one(term):
+            async with sem:
+                if budget and budget.exhausted:
+                    return
+                sys.stderr.write(f"Downloading comments for term {term!r}\n")
+                if await download_comments(term, client, budget) and on_done:
+                    on_done(term)
+        await asyncio.gather(*[download_one(term) for term in terms])
+
+async def count_hits(term, client, by=None):
+    """Return Pushshift's count of comments containing the given term, without
+    downloading any of them: a dict with key 'total', and if by is 'year' or
+    'sub', a dict mapping year/subreddit to count under that key. Return None
+    if the request failed.
+    """
+    aggs, frequency = dict(year=(['created_utc'], 'year'), sub=(['subreddit'], None)).get(by, ([], None))
+    counts = await client.count(q=term, before=END_TIMESTAMP, after=EARLIEST_TIMESTAMP,
+            aggs=aggs, frequency=frequency,
+    )
+    if counts is None:
+        return None
+    if by == 'year':
+        # Buckets are keyed by the timestamp of the start of the year
+        counts['year'] = {datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).year: n
+                for ts, n in counts.pop('created_utc').items()}
+    elif by == 'sub':
+        counts['sub'] = counts.pop('subreddit')
+    return counts
+
+async def print_all_hit_counts(pairs, requests_per_second, concurrency, by=None):
+    """Print a csv of Pushshift's (unfiltered) count of comments for each of the
+    given (pre, suff) pairs, optionally broken down by year or subreddit. One
+    request per term.
+    """
+    print(f"pre,suff,{by},hits" if by else "pre,suff,hits")
+    sem = asyncio.Semaphore(concurrency)
+    async with pushshift.PushshiftClient(requests_per_second) as client:
+        async def count_one(term):
+            async with sem:
+                return await count_hits(term, client, by)
+        tasks = [asyncio.ensure_future(count_one(pre + suff)) for pre, suff in pairs]
+        # Print rows in order, as soon as they're ready
+        for (pre, suff), task in zip(pairs, tasks):
+            counts = await task
+            if counts is None:
+                sys.stderr.write(f"WARNING: no count for term {pre+suff!r}\n")
+                continue
+            if by:
+                for key, n in counts[by].items():
+                    print(f"{pre},{suff},{key},{n}")
+            else:
+                print(f"{pre},{suff},{counts['total']}")
+
+def load_hit_counts(path):
+    """Return a dict mapping term to total hits, from the output of --count-only."""
+    df = pd.read_csv(path)
+    return dict(zip(df.pre + df.suff, df.hits))
+
+def mark_empty(term):
+    """Record that the given term has no comments to download."""
+    with comment_store.open_writer(CACHE_DIR, term) as writer:
+        if not writer.cursor.get('done'):
+            writer.append([], done=True)
 
 TERMLIMIT = None
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Download comments for all prefix/suffix combinations")
+    parser.add_argument('--rate', type=float, default=pushshift.DEFAULT_REQUESTS_PER_SECOND,
+            help="Max requests per second, across all terms",
+    )
+    parser.add_argument('--concurrency', type=int, default=8,
+            help="Max number of terms to download at once",
+    )
+    parser.add_argument('--count-only', action='store_true',
+            help="Rather than downloading comments, print a csv of the number of "
+            "comments Pushshift has for each term (one request per term)",
+    )
+    parser.add_argument('--by', choices=['year', 'sub'],
+            help="With --count-only, break down counts by year or subreddit",
+    )
+    parser.add_argument('--hits', metavar='CSV',
+            help="Output of a previous --count-only run. Only download terms with some "
+            "hits and few enough to download in full (the rest should be sampled).",
+    )
+    parser.add_argument('--budget', type=int,
+            help="Max number of requests to make in this run. Terms are downloaded in order "
+            "of expected value per request (see download_plan.py).",
+    )
+    parser.add_argument('--plan', default=download_plan.DEFAULT_PLAN_PATH,
+            help="Path of the download plan. An existing plan is resumed.",
+    )
+    parser.add_argument('--replan', action='store_true',
+            help="Make a new download plan, even if one exists",
+    )
+    sharding.add_shard_arguments(parser)
+    args = parser.parse_args()
+    assert not (args.by and not args.count_only), "--by requires --count-only"
     sys.stderr.write(f"Crunching {len(prefixes)} prefixes and {len(suffixes)} suffixes, for a total of {len(prefixes)*len(suffixes)} combinations.\n")
-    n = 0
+    pairs = list(itertools.product(prefixes, suffixes))
+    if args.shard:
+        pairs = sharding.shard_pairs(pairs, args.shard, sharding.load_weights(args.shard_weights))
+        sys.stderr.write(f"{len(pairs)} of them are in shard {args.shard[0]}/{args.shard[1]}.\n")
+        if args.plan == download_plan.DEFAULT_PLAN_PATH:
+            # Each shard has its own plan
+            args.plan = download_plan.shard_plan_path(*args.shard)
+    if args.count_only:
+        asyncio.run(print_all_hit_counts(pairs, args.rate, args.concurrency, args.by))
+        sys.exit(0)
     df = pd.read_csv('counts.csv')
-    for pre, post in itertools.product(prefixes, suffixes):
-        match = df[(df.pre == pre) & (df.suff == post)]
-        assert len(match) in (0, 1)
-        if len(match) == 1:
-            # Skip any compounds for which we already have data.
-            continue
-        term = pre + post
-        print(f"Dowloading comments for term {term!r}")
-        download_comments(term)
-        n += 1
-        if TERMLIMIT and n >= TERMLIMIT:
-            break
+    hits = load_hit_counts(args.hits) if args.hits else None
+    plan = None if args.replan else download_plan.load_plan(args.plan)
+    if plan is None:
+        # Skips any compounds for which we already have data.
+        plan = download_plan.make_plan(pairs, df, hits,
+                MAX_RESULTS_PER_REQUEST, MAX_REQUESTS_PER_TERM,
+        )
+        download_plan.save_plan(plan, args.plan)
+    terms = download_plan.pending_terms(plan)
+    if hits:
+        cap = MAX_REQUESTS_PER_TERM * MAX_RESULTS_PER_REQUEST
+        for term in terms:
+            if hits.get(term) == 0:
+                mark_empty(term)
+                download_plan.mark_done(plan, term)
+        nbig = sum(hits.get(term, 0) >= cap for term in terms)
+        terms = [term for term in terms if 0 < hits.get(term, 1) < cap]
+        sys.stderr.write(f"Skipping {nbig} terms with too many hits to download in full.\n")
+    if TERMLIMIT:
+        terms = terms[:TERMLIMIT]
+    sys.stderr.write(f"{len(terms)} terms left to download (plan in {args.plan}).\n")
+
+    def on_done(term):
+        download_plan.mark_done(plan, term)
+        download_plan.save_plan(plan, args.plan)
+
+    budget = download_plan.RequestBudget(args.budget)
+    asyncio.run(download_all(terms, args.rate, args.concurrency, budget, on_done))
+    download_plan.save_plan(plan, args.plan)
@@ -0,0 +1,281 @@
+"""Bring the dataset up to date with comments posted since it was downloaded,
+without re-downloading or recounting history.
+
+    python refresh.py --through 2022
+
+Each term's stored comments are complete up to a high-water mark recorded in
+its cursor (END_TIMESTAMP, for data from the original downloads). This fetches
+only the comments between that mark and the end of the given year:
+    - for fully downloaded terms, all comments in the new window (up to the
+      usual per-term cap), appended to their comment_data file.
+    - for sampled terms, the comments on DAYS_PER_YEAR days of each new year,
+      chosen by sampled_counts.get_intervals (so the same days are chosen
+      however many years are added at once), appended to their
+      sampled_comment_data file. For adaptively sampled terms, the new days
+      are also added to their sample info, so they're weighted correctly.
+Then the count in counts.csv for each term is increased by the (estimated)
+number of valid comments in its new window.
+
+The window already reflected in counts.csv is recorded per term in a sidecar
+(counts.through.json), along with a hash of counts.csv, so running this again
+(e.g. after an interruption) never adds the same comments twice. If
+counts.csv has been regenerated since (e.g. by a full run of
+compute_counts.py, which counts everything stored), it's assumed to be up to
+date with the stored comments.
+
+Terms whose data was ingested from dump files (see ingest_dumps.py) are left
+alone. Ingest the new months' dumps to extend those.
+"""
+import os
+import sys
+import json
+import asyncio
+import argparse
+import datetime
+import itertools
+
+import comment_store
+import count_cache
+import pushshift
+import sharding
+import compute_counts
+import sampled_counts
+from reddit_counts import (prefixes, suffixes, high_water_mark, shake_comment_data,
+        MAX_REQUESTS_PER_TERM, MAX_RESULTS_PER_REQUEST)
+
+RAW_DIR = compute_counts.RAW_DIR
+SAMPLED_DIR = compute_counts.SAMPLED_DIR
+
+DEFAULT_COUNTS_PATH = 'counts.csv'
+
+def year_end(year):
+    """Return the timestamp of the start of the year after the given one."""
+    return int(datetime.datetime(year + 1, 1, 1).timestamp())
+
+def term_source(term):
+    """Return the directory that the given term's counts come from (RAW_DIR or
+    SAMPLED_DIR), or None if it has no data we can refresh.
+    """
+    if comment_store.find_dump_shards(compute_counts.DUMP_DIR, term, compute_counts._ingest_manifest()) is not None:
+        return None
+    try:
+        _, sampled = compute_counts.comment_sources(term)
+    except FileNotFoundError:
+        return None
+    source = SAMPLED_DIR if sampled else RAW_DIR
+    if comment_store.stored_cursor(source, term) is None:
+        # Written all at once by an older version of the downloaders
+        sys.stderr.write(f"WARNING: skipping {term!r}, which has no cursor in {source}\n")
+        return None
+    return source
+
+def stored_high_water(term, source):
+    cursor = comment_store.stored_cursor(source, term)
+    return None if cursor is None else high_water_mark(cursor)
+
+async def refresh_comments(term, client, until):
+    """Download the given (fully downloaded) term's comments from between its
+    high-water mark and until, appending them to its stored comments a page at
+    a time. If a previous refresh was interrupted, pick up where it left off.
+    Return whether the term is now up to date.
+    """
+    if not comment_store.stored_cursor(RAW_DIR, term).get('done'):
+        sys.stderr.write(f"WARNING: skipping {term!r}, whose original download isn't finished\n")
+        return False
+    with comment_store.open_writer(RAW_DIR, term) as writer:
+        while True:
+            since = high_water_mark(writer.cursor)
+            # An interrupted refresh has to finish its own window first
+            window = writer.cursor.get('refresh') or dict(until=until)
+            if since >= window['until']:
+                return True
+            endpoint = window.get('created_utc', window['until'] + 1) - 1
+            for _ in range(MAX_REQUESTS_PER_TERM):
+                dat = await client.search(limit=MAX_RESULTS_PER_REQUEST, sort='desc',
+                        before=endpoint, after=since - 1, q=term,
+                )
+                if dat is None:
+                    sys.stderr.write(f"WARNING: aborting refresh of {term} after max retries\n")
+                    return False
+                results = dat['data']
+                if results:
+                    writer.append([shake_comment_data(comm) for comm in results],
+                            refresh=dict(window, created_utc=results[-1]['created_utc']),
+                    )
+                if len(results) < MAX_RESULTS_PER_REQUEST:
+                    break
+                endpoint = results[-1]['created_utc'] - 1
+            else:
+                sys.stderr.write(f"WARNING: {term!r} has more than {MAX_REQUESTS_PER_TERM * MAX_RESULTS_PER_REQUEST} "
+                        "new comments. Only the most recent were fetched; it should probably be sampled.\n")
+            writer.append([], high_water=window['until'], refresh=None)
+
+async def refresh_sampled(term, client, until):
+    """Download the given sampled term's comments from the sampled days between
+    its high-water mark and until (which should be the end of a year). If a
+    previous refresh was interrupted, only fetch the days that weren't finished.
+    Return whether the term is now up to date.
+    """
+    since = stored_high_water(term, SAMPLED_DIR)
+    if since >= until:
+        return True
+    last_year = datetime.datetime.fromtimestamp(until - 1).year
+    new_days = [(year, start, end) for year, start, end in sampled_counts.intervals_by_year(last_year=last_year)
+            if since <= start and end < until]
+    with comment_store.open_writer(SAMPLED_DIR, term) as writer:
+        done = set(map(tuple, writer.cursor.get('days_done', [])))
+
+        async def fetch_one(start, end):
+            comms = await sampled_counts.comments_from_interval(term, start, end, client)
+            if comms is None:
+                return
+            done.add((start, end))
+            writer.append([shake_comment_data(comm) for comm in comms], days_done=sorted(done))
+
+        await asyncio.gather(*[fetch_one(start, end) for _, start, end in new_days if (start, end) not in done])
+        if not all((start, end) in done for _, start, end in new_days):
+            # The high-water mark (and the sample info) only move once every
+            # new day is in, so the missing days are retried next time
+            sys.stderr.write(f"WARNING: aborting refresh of {term} after max retries\n")
+            return False
+        info = comment_store.read_sample_info(SAMPLED_DIR, term)
+        # (Terms sampled with fixed intervals have no info: all their days have the same weight.)
+        if info is not None:
+            sampled = {(start, end) for _, start, end in info['intervals']}
+            info['intervals'] += [[year, start, end] for year, start, end in new_days if (start, end) not in sampled]
+            for year in {year for year, _, _ in new_days}:
+                info['days_in_year'][str(year)] = sampled_counts.days_in_year(year)
+            comment_store.write_sample_info(SAMPLED_DIR, term, info)
+        writer.append([], high_water=until)
+    return True
+
+async def refresh_all(sources, until, requests_per_second, concurrency):
+    """Refresh the given terms (a dict mapping term to source directory), up to
+    concurrency at a time.
+    """
+    sem = asyncio.Semaphore(concurrency)
+    async with pushshift.PushshiftClient(requests_per_second) as client:
+        async def refresh_one(term, source):
+            async with sem:
+                sys.stderr.write(f"Refreshing {term!r} ({source})\n")
+                if source == SAMPLED_DIR:
+                    await refresh_sampled(term, client, until)
+                else:
+                    await refresh_comments(term, client, until)
+        await asyncio.gather(*[refresh_one(term, source) for term, source in sources.items()])
+
+def through_path(counts_path):
+    return os.path.splitext(counts_path)[0] + '.through.json'
+
+def load_through(counts_path, sources):
+    """Return a dict mapping each of the given terms to the timestamp up to
+    which its count in counts_path reflects its stored comments.
+    """
+    try:
+        with open(through_path(counts_path)) as f:
+            through = json.load(f)
+    except FileNotFoundError:
+        through = None
+    if through is not None and through['sha256'] == count_cache.file_hash(counts_path):
+        terms = through['terms']
+    else:
+        if through is not None:
+            sys.stderr.write(f"{counts_path} has changed since it was last refreshed. "
+                    "Assuming it's up to date with the stored comments.\n")
+        terms = {}
+    for term, source in sources.items():
+        if term not in terms:
+            terms[term] = stored_high_water(term, source)
+    return terms
+
+def save_through(counts_path, through):
+    path = through_path(counts_path)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(dict(sha256=count_cache.file_hash(counts_path), terms=through), f)
+    os.replace(tmp, path)
+
+def add_window_counts(counts_path, deltas):
+    """Add the given deltas (a dict mapping term to count) to the counts in the
+    given csv, in place. Any count_lo/count_hi columns are shifted by the same
+    amount, so they don't account for the uncertainty of the new windows.
+    """
+    with open(counts_path) as f:
+        lines = f.read().splitlines()
+    header = lines[0].split(',')
+    count_cols = [i for i, col in enumerate(header) if col in ('count', 'count_lo', 'count_hi')]
+    out = [lines[0]]
+    for line in lines[1:]:
+        row = line.split(',')
+        delta = deltas.get(row[0] + row[1])
+        if delta:
+            for i in count_cols:
+                value = float(row[i]) + delta if '.' in row[i] or isinstance(delta, float) else int(row[i]) + delta
+                row[i] = str(value)
+        out.append(','.join(row))
+    tmp = counts_path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write('\n'.join(out) + '\n')
+    os.replace(tmp, counts_path)
+
+def update_counts(counts_path, sources, through, jobs=1):
+    """Add each term's count of valid comments between the time its count is
+    up to date with (in through) and its current high-water mark to
+    counts_path, and record the new windows.
+    """
+    windows = []
+    for term, source in sources.items():
+        high_water = stored_high_water(term, source)
+        if through[term] is not None and high_water > through[term]:
+            windows.append((term, through[term], high_water))
+    sys.stderr.write(f"Counting new comments for {len(windows)} terms.\n")
+    counts = compute_counts.map_terms(compute_counts._window_count_in_worker, windows, jobs=jobs)
+    deltas = {term: count for (term, _, _), count in zip(windows, counts)}
+    add_window_counts(counts_path, deltas)
+    for term, _, high_water in windows:
+        through[term] = high_water
+    # (If we're interrupted before this, the updated counts.csv won't match the
+    # old hash, so is assumed up to date next time)
+    save_through(counts_path, through)
+    return deltas
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fetch and count comments posted since the data was last updated")
+    parser.add_argument('--through', type=int, required=True, metavar='YEAR',
+            help="Fetch comments up to the end of this year",
+    )
+    parser.add_argument('--counts', default=DEFAULT_COUNTS_PATH,
+            help="Counts csv to update in place",
+    )
+    parser.add_argument('--rate', type=float, default=pushshift.DEFAULT_REQUESTS_PER_SECOND,
+            help="Max requests per second, across all terms",
+    )
+    parser.add_argument('--concurrency', type=int, default=8,
+            help="Max number of terms to refresh at once",
+    )
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+            help="Number of worker processes to count new comments with",
+    )
+    parser.add_argument('--no-download', action='store_true',
+            help="Only update counts for comments already fetched",
+    )
+    sharding.add_shard_arguments(parser)
+    args = parser.parse_args()
+    assert os.path.exists(args.counts), f"No counts at {args.counts} to update (run compute_counts.py first)"
+    until = year_end(args.through)
+    pairs = list(itertools.product(prefixes, suffixes))
+    if args.shard:
+        pairs = sharding.shard_pairs(pairs, args.shard, sharding.load_weights(args.shard_weights))
+    sources = {}
+    for pre, suff in pairs:
+        source = term_source(pre + suff)
+        if source is not None:
+            sources[pre + suff] = source
+    sys.stderr.write(f"Refreshing {len(sources)} terms through {args.through}.\n")
+    # Take note of what counts.csv is up to date with before fetching anything
+    through = load_through(args.counts, sources)
+    save_through(args.counts, through)
+    if not args.no_download:
+        asyncio.run(refresh_all(sources, until, args.rate, args.concurrency))
+    deltas = update_counts(args.counts, sources, through, args.jobs)
+    sys.stderr.write(f"Added {sum(deltas.values()):.0f} comments to the counts of {len(deltas)} terms in {args.counts}.\n")
@@ -0,0 +1,138 @@
+"""Render a batch of heatmap figures described by a json spec file, e.g.
+
+    python render_figures.py figures.json --jobs 8
+
+The spec file holds a list of figure specs. Each is a dict with keys:
+    - name: output filename (passed to viz_helpers.savefig)
+    - counts (optional): csv of counts to load with viz_helpers.load_df
+    - pres, suffs (optional): lists of affixes to include (default all)
+    - top_suffixes (optional): instead of suffs, use this many of the suffixes
+      with the highest total count across pres (and vice versa for top_prefixes)
+    - savefig (optional): dict of kwargs for savefig (default bbox_inches='tight')
+Any other keys are passed as kwargs to heatmap.make_heatmap (e.g. figsize,
+sort, cmap, gamma, wiki, wiki_glyph, normalize_rows, linewidths).
+
+Figures are rendered in parallel with the Agg backend. Each png records a hash
+of its spec, its input data, and the plotting code, and is skipped if that hash
+is unchanged since it was last rendered.
+"""
+import os
+import sys
+import json
+import hashlib
+import argparse
+import contextlib
+import multiprocessing
+
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib import pyplot as plt
+from PIL import Image
+
+import viz_helpers
+from heatmap import make_heatmap, AffixMatrix
+
+# Name of the png text chunk holding the render hash
+HASH_KEY = 'render-hash'
+
+# Keys of a figure spec that aren't kwargs for make_heatmap
+SPEC_KEYS = {'name', 'counts', 'pres', 'suffs', 'top_suffixes', 'top_prefixes', 'savefig'}
+
+def needs_wikt(spec):
+    return bool(spec.get('wiki'))
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def render_hash(spec):
+    """Return a hash of everything that determines what the given figure looks like."""
+    h = hashlib.sha256()
+    h.update(json.dumps(spec, sort_keys=True).encode('utf-8'))
+    inputs = [spec.get('counts', viz_helpers.DEFAULT_COUNT_FNAME)]
+    if needs_wikt(spec):
+        inputs.append(viz_helpers.WIKT_FNAME)
+    # Plotting code (viz_helpers has the shared styling and savefig settings)
+    here = os.path.dirname(os.path.abspath(__file__))
+    inputs += [os.path.join(here, fname) for fname in ('heatmap.py', 'viz_helpers.py')]
+    inputs.append(os.path.abspath(__file__))
+    for path in inputs:
+        h.update(file_digest(path).encode('ascii'))
+    return h.hexdigest()
+
+def output_path(spec, outdir):
+    name = spec['name']
+    if '.' not in name:
+        name += '.png'
+    return os.path.join(outdir, name)
+
+def rendered_hash(path):
+    """Return the render hash recorded in the png at the given path, if any."""
+    try:
+        with Image.open(path) as im:
+            return im.text.get(HASH_KEY)
+    except (FileNotFoundError, AttributeError):
+        return None
+
+# Affix matrices loaded by this process, keyed by (counts fname, wikt)
+_matrices = {}
+def affix_matrix(spec):
+    key = (spec.get('counts', viz_helpers.DEFAULT_COUNT_FNAME), needs_wikt(spec))
+    if key not in _matrices:
+        df = viz_helpers.load_df(key[0], wikt=key[1])
+        _matrices[key] = AffixMatrix.from_df(df)
+    return _matrices[key]
+
+def render(spec, outdir, digest):
+    am = affix_matrix(spec)
+    pres = spec.get('pres')
+    suffs = spec.get('suffs')
+    if 'top_suffixes' in spec:
+        suffs = am.top_suffixes(pres or am.pres, spec['top_suffixes'])
+    if 'top_prefixes' in spec:
+        pres = am.top_prefixes(suffs or am.suffs, spec['top_prefixes'])
+    kwargs = {k: v for k, v in spec.items() if k not in SPEC_KEYS}
+    if 'figsize' in kwargs:
+        kwargs['figsize'] = tuple(kwargs['figsize'])
+    fig, ax = make_heatmap(am.sub(pres, suffs), return_fig=True, **kwargs)
+    save_kws = spec.get('savefig', dict(bbox_inches='tight'))
+    viz_helpers.savefig(fig, spec['name'], dirname=outdir, metadata={HASH_KEY: digest}, **save_kws)
+    plt.close(fig)
+
+def _render_if_stale(args):
+    spec, outdir, force = args
+    digest = render_hash(spec)
+    if not force and rendered_hash(output_path(spec, outdir)) == digest:
+        return spec['name'], False
+    render(spec, outdir, digest)
+    return spec['name'], True
+
+def render_all(specs, outdir=viz_helpers.BLOGDIR, jobs=1, force=False):
+    names = [spec['name'] for spec in specs]
+    assert len(set(names)) == len(names), "Duplicate figure names"
+    tasks = [(spec, outdir, force) for spec in specs]
+    nrendered = 0
+    # (The pool's workers are cleaned up even if a render raises)
+    with contextlib.ExitStack() as stack:
+        if jobs == 1:
+            results = map(_render_if_stale, tasks)
+        else:
+            pool = stack.enter_context(multiprocessing.Pool(jobs))
+            results = pool.imap_unordered(_render_if_stale, tasks)
+        for name, rendered in results:
+            nrendered += rendered
+            sys.stderr.write(f"{name}: {'rendered' if rendered else 'up to date'}\n")
+    sys.stderr.write(f"Rendered {nrendered} of {len(specs)} figures.\n")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Render a batch of heatmap figures")
+    parser.add_argument('spec_file', help="json file with a list of figure specs")
+    parser.add_argument('--outdir', default=viz_helpers.BLOGDIR)
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--force', action='store_true',
+            help="Re-render figures even if they seem up to date",
+    )
+    args = parser.parse_args()
+    with open(args.spec_file) as f:
+        specs = json.load(f)
+    render_all(specs, args.outdir, args.jobs, args.force)
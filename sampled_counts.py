@@ -1,15 +1,21 @@
-import requests
-import time
 import sys
-import json
-import random
+import asyncio
+import argparse
+import contextlib
+import itertools
+import math
+import bisect
+from collections import defaultdict
 import datetime
-import pandas as pd
 import numpy as np
 import os
 
 import viz_helpers
-from reddit_counts import shake_comment_data
+import comment_store
+import pushshift
+import sharding
+from reddit_counts import shake_comment_data, load_hit_counts, prefixes, suffixes
+from term_matcher import TermMatcher
 
 """
 Have approx 15 years to sample over (though very little data in first few years)
@@ -37,27 +43,22 @@ LAST_YEAR = 2020
 
 SECONDS_PER_DAY = 24 * 60 * 60
 
-# If we get a response code other than 200, we will retry up to this many times,
-# waiting 2, 4, 8... seconds between attempts
-MAX_RETRIES = 8
 # Max value of the limit param. cf. https://www.reddit.com/r/pushshift/comments/ih66b8/difference_between_size_and_limit_and_are_they/
 MAX_RESULTS_PER_REQUEST = 100
 
-def comments_from_interval(term, start, end, limit=None):
-    retries = 0
+async def comments_from_interval(query, start, end, client, limit=None):
+    """Return all comments matching query from the given interval (or the
+    first limit of them), or None if we gave up on the interval part way
+    through, so callers don't mistake a partial fetch for a complete one.
+    """
     comments = []
     while limit is None or len(comments) < limit:
-        url = f"https://api.pushshift.io/reddit/comment/search?limit={MAX_RESULTS_PER_REQUEST}&sort=asc&before={end+1}&after={start-1}&q={term}"
-        response = requests.get(url, headers={'User-Agent': "script by /u/halfeatenscone"})
-        if response.status_code != 200:
-            retries += 1
-            if retries > MAX_RETRIES:
-                sys.stderr.write(f"WARNING: aborting term {term} after max retries for url {url}\n")
-                break
-            wait = 2**retries
-            time.sleep(wait)
-            continue
-        dat = response.json()
+        dat = await client.search(limit=MAX_RESULTS_PER_REQUEST, sort='asc',
+                before=end+1, after=start-1, q=query,
+        )
+        if dat is None:
+            sys.stderr.write(f"WARNING: aborting query {query} after max retries for interval {start}-{end}\n")
+            return None
         results = dat['data']
         comments += results
         if len(results) < MAX_RESULTS_PER_REQUEST:
@@ -65,19 +66,26 @@ def comments_from_interval(term, start, end, limit=None):
         # If we got 100 results, then keep going, starting from after the
         # last comment
         start = results[-1]['created_utc'] + 1
-        time.sleep(1)
-    time.sleep(1)
     return comments
 
-def get_intervals(seed=1337):
-    """Return a list of inclusive (start, end) utc timestamp tuples
+def day_interval(date):
+    """Return inclusive (start, end) utc timestamps for the given date."""
+    start_timestamp = int(date.timestamp())
+    return (start_timestamp, start_timestamp + SECONDS_PER_DAY-1)
+
+def get_intervals(seed=1337, last_year=LAST_YEAR):
+    """Return a list of inclusive (start, end) utc timestamp tuples, for
+    DAYS_PER_YEAR days of each year from FIRST_YEAR to last_year.
+
+    The days chosen for a given year don't depend on last_year, so the
+    intervals for a later last_year just extend those for an earlier one.
 
     NB: for pushshift API, "after" and "before" are non-inclusive (as you
     might expect).
     """
     np.random.seed(seed)
     intervals = []
-    for year in range(FIRST_YEAR, LAST_YEAR+1):
+    for year in range(FIRST_YEAR, last_year+1):
         base_date = datetime.datetime(year, 1, 1)
         leap_year = year % 4 == 0
         possible_day_offsets = range(365 + int(leap_year))
@@ -87,34 +95,306 @@ def get_intervals(seed=1337):
             # make sure interval doesn't bleed into next day
             #second_offset = random.randint(0, SECONDS_PER_DAY - INTERVAL_SIZE_SECONDS)
             #dt = date + datetime.timedelta(seconds=second_offset)
-            start_timestamp = int(date.timestamp())
-            interval = (start_timestamp, start_timestamp + SECONDS_PER_DAY-1)
-            intervals.append(interval)
+            intervals.append(day_interval(date))
     return intervals
 
+def intervals_by_year(seed=1337, last_year=LAST_YEAR):
+    """Like get_intervals, but return (year, start, end) tuples."""
+    return [(FIRST_YEAR + i // DAYS_PER_YEAR, start, end)
+            for i, (start, end) in enumerate(get_intervals(seed, last_year))]
+
+def days_in_year(year):
+    return (datetime.datetime(year+1, 1, 1) - datetime.datetime(year, 1, 1)).days
+
+def get_shuffled_days(seed=1337):
+    """Return a dict mapping each year to a list of inclusive (start, end)
+    intervals for every day of that year, in random order.
+    """
+    rng = np.random.RandomState(seed)
+    days = {}
+    for year in range(FIRST_YEAR, LAST_YEAR+1):
+        base_date = datetime.datetime(year, 1, 1)
+        offsets = rng.permutation(days_in_year(year))
+        days[year] = [day_interval(base_date + datetime.timedelta(days=int(offset))) for offset in offsets]
+    return days
+
+def stratified_estimate(daily_counts):
+    """Given a dict mapping year to a list of counts for sampled days in that
+    year, return a tuple of (estimated total count, variance of that estimate).
+    Years with no sampled days are ignored.
+    """
+    total = 0.0
+    var = 0.0
+    for year, counts in daily_counts.items():
+        n = len(counts)
+        if n == 0:
+            continue
+        N = days_in_year(year)
+        mean = sum(counts) / n
+        total += N * mean
+        if n > 1:
+            s2 = sum((c - mean)**2 for c in counts) / (n - 1)
+            # (With finite population correction, since we sample days without replacement)
+            var += N**2 * (1 - n/N) * s2 / n
+    return total, var
+
+def relative_standard_error(total, var):
+    return math.sqrt(var) / total if total else 0.0
+
+# Settings for adaptive sampling (see fetch_adaptive).
+# Stop sampling a term once the relative standard error of its estimated count
+# falls below this.
+DEFAULT_TARGET_RSE = 0.05
+# Every year gets at least this many days, so we have some idea of its variance.
+MIN_DAYS_PER_YEAR = 3
+# Number of days to fetch (concurrently) between checks of our stopping condition.
+DAYS_PER_ROUND = 15
+
+def allocate_days(daily_counts, remaining, ndays):
+    """Choose which years to sample the next ndays days from. Return a list of
+    years (possibly with repeats).
+
+    Each day goes to the year where it most reduces the variance of our
+    stratified estimate, i.e. the year maximizing N^2 * s^2 * (1/n - 1/(n+1)).
+    """
+    sizes = {year: len(counts) for year, counts in daily_counts.items()}
+    avail = dict(remaining)
+    spreads = {}
+    for year, counts in daily_counts.items():
+        n = len(counts)
+        mean = sum(counts) / n
+        s2 = sum((c - mean)**2 for c in counts) / (n - 1)
+        spreads[year] = days_in_year(year)**2 * s2
+    chosen = []
+    for _ in range(ndays):
+        candidates = [year for year in avail if avail[year] > 0]
+        if not candidates:
+            break
+        best = max(candidates, key=lambda y: spreads[y] * (1/sizes[y] - 1/(sizes[y]+1)))
+        if spreads[best] == 0:
+            break
+        chosen.append(best)
+        sizes[best] += 1
+        avail[best] -= 1
+    return chosen
+
+async def fetch_adaptive(term, client, target_rse=DEFAULT_TARGET_RSE, seed=1337):
+    """Download sampled comments for the given term, drawing days from each year
+    in random order until the relative standard error of our stratified
+    (by year) estimate of the term's total count is at most target_rse, or
+    we run out of days.
+
+    Which days were sampled, along with the final estimate and its error, are
+    saved to a sample info file alongside the comment data. compute_counts uses
+    this to weight each year's comments appropriately, once the download has
+    been marked done. Return the info, or None if fetching a day failed (in
+    which case no info is saved, and the download isn't done).
+    """
+    assert not os.path.exists(os.path.join(CACHE_DIR, f'{term}.json'))
+    days = get_shuffled_days(seed)
+    with comment_store.open_writer(CACHE_DIR, term) as writer:
+        done = set(map(tuple, writer.cursor.get('days_done', [])))
+        # Recover counts for any days fetched by a previous run
+        starts = sorted(done)
+        recovered = defaultdict(int)
+        if starts:
+            for comm in comment_store.iter_term_comments(CACHE_DIR, term):
+                i = bisect.bisect_right(starts, (comm['created_utc'], math.inf)) - 1
+                if i >= 0 and comm['created_utc'] <= starts[i][1]:
+                    recovered[starts[i]] += 1
+        daily_counts = {}
+        queues = {}
+        for year, intervals in days.items():
+            daily_counts[year] = [recovered[iv] for iv in intervals if iv in done]
+            queues[year] = [iv for iv in intervals if iv not in done]
+
+        async def fetch_one(year, interval):
+            comms = await comments_from_interval(term, interval[0], interval[1], client)
+            if comms is None:
+                return False
+            done.add(interval)
+            daily_counts[year].append(len(comms))
+            writer.append([shake_comment_data(comm) for comm in comms], days_done=sorted(done))
+            return True
+
+        while True:
+            todo = []
+            for year, counts in daily_counts.items():
+                nmin = min(MIN_DAYS_PER_YEAR - len(counts), len(queues[year]))
+                todo += [year] * max(0, nmin)
+            if not todo:
+                total, var = stratified_estimate(daily_counts)
+                if relative_standard_error(total, var) <= target_rse:
+                    break
+                todo = allocate_days(daily_counts,
+                        {year: len(q) for year, q in queues.items()},
+                        DAYS_PER_ROUND,
+                )
+                if not todo:
+                    break
+            fetched = await asyncio.gather(*[fetch_one(year, queues[year].pop(0)) for year in todo])
+            if not all(fetched):
+                # Don't estimate from an incomplete sample. The days fetched so
+                # far are kept, and the rest are picked up by the next run.
+                sys.stderr.write(f"WARNING: aborting adaptive sampling of {term}\n")
+                return None
+
+        total, var = stratified_estimate(daily_counts)
+        sampled = [[year, start, end] for year, intervals in days.items()
+                for (start, end) in intervals if (start, end) in done]
+        info = dict(
+                intervals=sampled,
+                days_in_year={year: days_in_year(year) for year in days},
+                estimate=total,
+                rse=relative_standard_error(total, var),
+                target_rse=target_rse,
+        )
+        comment_store.write_sample_info(CACHE_DIR, term, info)
+        # (Only once the info is there to weight the comments by)
+        writer.append([], done=True)
+    return info
+
 CACHE_DIR = 'sampled_comment_data'
-def fetch_sampled_comments(term, intervals):
-    outpath = os.path.join(CACHE_DIR, f'{term}.json')
-    assert not os.path.exists(outpath)
-    comments = []
-    for start, end in intervals:
-        comms = comments_from_interval(term, start, end)
-        comments += [shake_comment_data(comm) for comm in comms]
-    with open(outpath, 'w') as f:
-        json.dump(comments, f, indent=0)
+async def fetch_sampled_comments(term, intervals, client):
+    """Download comments for the given term from each of the given intervals
+    (concurrently), appending them to the term's jsonl file as each interval is
+    finished. If a previous run was interrupted, only fetch the intervals that
+    weren't finished. Once every interval is in, the download is marked done
+    (until then, compute_counts won't use it).
+    """
+    assert not os.path.exists(os.path.join(CACHE_DIR, f'{term}.json'))
+    with comment_store.open_writer(CACHE_DIR, term) as writer:
+        done = set(writer.cursor.get('intervals_done', []))
+
+        async def fetch_one(i, start, end):
+            comms = await comments_from_interval(term, start, end, client)
+            if comms is None:
+                # Leave the interval to be fetched again on the next run
+                return
+            done.add(i)
+            writer.append([shake_comment_data(comm) for comm in comms], intervals_done=sorted(done))
+
+        await asyncio.gather(*[
+            fetch_one(i, start, end) for i, (start, end) in enumerate(intervals)
+            if i not in done
+        ])
+        if len(done) == len(intervals) and not writer.cursor.get('done'):
+            writer.append([], done=True)
+
+async def fetch_sampled_batch(terms, intervals, client):
+    """Like fetch_sampled_comments, but for a batch of terms at once. We make
+    one OR query per interval for all the terms in the batch, then route each
+    returned comment to the file of every term whose text it contains. A
+    comment containing several of the terms is only fetched once.
+
+    NB: Pushshift's matching is a bit fuzzier than ours (e.g. it may return
+    comments that only contain a term as part of a URL). Such comments are
+    dropped here, whereas fetch_sampled_comments would save them, but either way
+    they wouldn't be counted by compute_counts.
+    """
+    matcher = TermMatcher(terms)
+    with contextlib.ExitStack() as stack:
+        writers = {}
+        done = {}
+        for term in terms:
+            assert not os.path.exists(os.path.join(CACHE_DIR, f'{term}.json'))
+            writers[term] = stack.enter_context(comment_store.open_writer(CACHE_DIR, term))
+            done[term] = set(writers[term].cursor.get('intervals_done', []))
+
+        async def fetch_one(i, start, end):
+            # If we were interrupted, some terms may have already finished this interval
+            pending = [term for term in terms if i not in done[term]]
+            if not pending:
+                return
+            comms = await comments_from_interval('|'.join(pending), start, end, client)
+            if comms is None:
+                return
+            routed = defaultdict(list)
+            for comm in comms:
+                for term in matcher.terms_in(comm['body'].lower()):
+                    routed[term].append(shake_comment_data(comm))
+            for term in pending:
+                done[term].add(i)
+                writers[term].append(routed[term], intervals_done=sorted(done[term]))
+
+        await asyncio.gather(*[fetch_one(i, start, end) for i, (start, end) in enumerate(intervals)])
+        for term in terms:
+            if len(done[term]) == len(intervals) and not writers[term].cursor.get('done'):
+                writers[term].append([], done=True)
+
+# Number of terms per query when fetching in batches. Bounded by how long a
+# query Pushshift will accept.
+DEFAULT_BATCH_SIZE = 20
+
+async def fetch_all_sampled(terms, intervals,
+        requests_per_second=pushshift.DEFAULT_REQUESTS_PER_SECOND,
+        batch_size=1,
+        target_rse=None,
+        ):
+    """Fetch sampled comments for all the given terms. If batch_size > 1, fetch
+    in batches of that many terms using fetch_sampled_batch. If target_rse is
+    given, ignore intervals and sample each term adaptively using fetch_adaptive.
+    """
+    async with pushshift.PushshiftClient(requests_per_second) as client:
+        async def fetch_term(term):
+            if target_rse:
+                info = await fetch_adaptive(term, client, target_rse)
+                if info is None:
+                    return
+                sys.stderr.write(f"{term} ({len(info['intervals'])} days, est. {info['estimate']:.0f} +/- {info['rse']:.1%})\n")
+                return
+            await fetch_sampled_comments(term, intervals, client)
+            sys.stderr.write(term + '\n')
+        async def fetch_batch(batch):
+            await fetch_sampled_batch(batch, intervals, client)
+            sys.stderr.write(','.join(batch) + '\n')
+        if batch_size == 1 or target_rse:
+            await asyncio.gather(*[fetch_term(term) for term in terms])
+        else:
+            batches = [terms[i:i+batch_size] for i in range(0, len(terms), batch_size)]
+            await asyncio.gather(*[fetch_batch(batch) for batch in batches])
 
 def main():
-    """Download sampled data for terms with recorded counts exceeding our
-    cap of 40k.
+    """Download sampled data for terms with recorded (or, with --hits,
+    Pushshift-reported) counts exceeding our cap of 40k.
     """
+    parser = argparse.ArgumentParser(description="Download sampled comments for high-frequency terms")
+    parser.add_argument('--rate', type=float, default=pushshift.DEFAULT_REQUESTS_PER_SECOND,
+            help="Max requests per second, across all terms",
+    )
+    parser.add_argument('--batch-size', type=int, default=1,
+            help="Query for this many terms at once, and split up results locally "
+            f"(e.g. {DEFAULT_BATCH_SIZE}). Default is one query per term.",
+    )
+    parser.add_argument('--adaptive', action='store_true',
+            help="Sample days for each term until its estimated count reaches --target-rse, "
+            f"rather than using a fixed {DAYS_PER_YEAR} days per year",
+    )
+    parser.add_argument('--target-rse', type=float, default=DEFAULT_TARGET_RSE,
+            help="Relative standard error to aim for when sampling adaptively",
+    )
+    parser.add_argument('--hits', metavar='CSV',
+            help="Choose terms to sample by their hit counts from reddit_counts.py --count-only, "
+            "rather than by raw_reddit_counts.csv",
+    )
+    sharding.add_shard_arguments(parser)
+    args = parser.parse_args()
+    assert not (args.adaptive and args.batch_size > 1), "This combination of args not supported"
+    target_rse = args.target_rse if args.adaptive else None
     ints = get_intervals(seed=1337)
-    df = viz_helpers.load_df('raw_reddit_counts.csv', wikt=False)
     cap = 40000
-    exceeders = df[df['count'] >= cap].apply(lambda row: row.pre+row.suff, axis=1)
+    if args.hits:
+        exceeders = [term for term, hits in load_hit_counts(args.hits).items() if hits >= cap]
+    else:
+        df = viz_helpers.load_df('raw_reddit_counts.csv', wikt=False)
+        exceeders = df[df['count'] >= cap].apply(lambda row: row.pre+row.suff, axis=1)
+    if args.shard:
+        pairs = sharding.shard_pairs(list(itertools.product(prefixes, suffixes)), args.shard,
+                sharding.load_weights(args.shard_weights))
+        mine = {pre + suff for pre, suff in pairs}
+        exceeders = [term for term in exceeders if term in mine]
     sys.stderr.write(f'Fetching sampled comments for {len(exceeders)} terms.\n')
-    for term in exceeders:
-        sys.stderr.write(term + '\n')
-        fetch_sampled_comments(term, ints)
+    asyncio.run(fetch_all_sampled(list(exceeders), ints, args.rate, args.batch_size, target_rse))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,91 @@
+"""Deterministic assignment of terms to shards, for splitting a run of
+reddit_counts.py, sampled_counts.py or compute_counts.py across machines, e.g.
+
+    python compute_counts.py --shard 0/4 > counts.0.csv   # on the first node
+    python compute_counts.py --shard 1/4 > counts.1.csv   # on the second node
+    ...
+    python merge_counts.py counts.*.csv > counts.csv
+
+Terms are assigned greedily, heaviest first, to the shard with the least total
+weight so far. A term's weight is its count from a previous run (the
+--shard-weights file, counts.csv by default), capped at the most comments we'd
+download for one term, since that's roughly what it costs to process. Ties
+(e.g. among terms with no previous count) are broken by a stable hash of the
+term. So the assignment only depends on the affix lists and the weights file,
+which should be the same on every node.
+"""
+import os
+import sys
+import heapq
+import hashlib
+import argparse
+
+import pandas as pd
+
+DEFAULT_WEIGHTS_PATH = 'counts.csv'
+
+# Max number of comments downloaded for one term (reddit_counts.py's
+# MAX_REQUESTS_PER_TERM * MAX_RESULTS_PER_REQUEST)
+WEIGHT_CAP = 40000
+# Fixed cost of processing a term (opening its files, making its first
+# request...), in comments
+TERM_OVERHEAD = 100
+
+def parse_shard(spec):
+    """Parse a shard spec like '2/8' (the third of 8 shards) into a tuple (2, 8)."""
+    try:
+        i, n = map(int, spec.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a shard like 0/4, got {spec!r}")
+    if not 0 <= i < n:
+        raise argparse.ArgumentTypeError(f"shard index must be between 0 and {n-1}, got {i}")
+    return i, n
+
+def add_shard_arguments(parser):
+    parser.add_argument('--shard', type=parse_shard, metavar='I/N',
+            help="Only process the I-th of N (0-based) deterministic, balanced shards of the terms",
+    )
+    parser.add_argument('--shard-weights', metavar='CSV', default=DEFAULT_WEIGHTS_PATH,
+            help="Counts (or --count-only hits) used to balance shards. Must be the same on every node.",
+    )
+
+def stable_hash(term):
+    return int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'big')
+
+def load_weights(path=DEFAULT_WEIGHTS_PATH):
+    """Return a dict mapping term to its total count (or hits) in the given csv.
+    If there's no such file, return an empty dict (so shards are balanced by
+    number of terms only).
+    """
+    if not os.path.exists(path):
+        sys.stderr.write(f"WARNING: no shard weights at {path}. Balancing shards by number of terms.\n")
+        return {}
+    df = pd.read_csv(path)
+    col = 'count' if 'count' in df.columns else 'hits'
+    # Sums over any breakdown by year/subreddit
+    totals = df.groupby(df.pre + df.suff)[col].sum()
+    return totals.to_dict()
+
+def assign_shards(terms, nshards, weights=None):
+    """Return a dict mapping each of the given terms to a shard in [0, nshards)."""
+    weights = weights or {}
+    def cost(term):
+        return min(weights.get(term, 0), WEIGHT_CAP)
+    # (load, shard) for each shard
+    loads = [(0.0, shard) for shard in range(nshards)]
+    assignment = {}
+    for term in sorted(terms, key=lambda term: (-cost(term), stable_hash(term))):
+        load, shard = heapq.heappop(loads)
+        assignment[term] = shard
+        heapq.heappush(loads, (load + TERM_OVERHEAD + cost(term), shard))
+    return assignment
+
+def shard_pairs(pairs, shard, weights=None):
+    """Return the (pre, suff) pairs belonging to the given (i, n) shard, in
+    their original order. pairs should be the full product of our prefixes and
+    suffixes (not some subset depending on local state), so that every node
+    agrees on the assignment.
+    """
+    i, n = shard
+    assignment = assign_shards([pre + suff for pre, suff in pairs], n, weights)
+    return [(pre, suff) for pre, suff in pairs if assignment[pre + suff] == i]
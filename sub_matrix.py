@@ -0,0 +1,112 @@
+"""Sparse matrix of comment counts per (term, subreddit).
+
+Rows correspond to compounds (in the usual prefix x suffix order), and columns
+to subreddits, which are interned to integer ids in order of first appearance.
+The matrix is stored in compressed sparse row (CSR) format: the counts for the
+row i are data[indptr[i]:indptr[i+1]], in the columns given by the same slice
+of indices.
+
+Created by running
+    python compute_counts.py --sub --matrix sub_counts.npz
+and loaded with
+    mat = SubCountMatrix.load('sub_counts.npz')
+"""
+import numpy as np
+import pandas as pd
+
+class SubCountMatrix:
+
+    def __init__(self, pres, suffs, subs, indptr, indices, data):
+        self.pres = np.asarray(pres)
+        self.suffs = np.asarray(suffs)
+        self.subs = np.asarray(subs)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.data = np.asarray(data, dtype=np.float64)
+        self.sub_ids = {sub: i for i, sub in enumerate(self.subs)}
+
+    @classmethod
+    def build(cls, pairs, sub_counts):
+        """Build a matrix from a sequence of (pre, suff) pairs and a parallel
+        sequence of dicts mapping subreddit name to count (e.g. from
+        compute_counts.sub_counts_for_term).
+        """
+        sub_ids = {}
+        pres, suffs = [], []
+        indptr = [0]
+        indices = []
+        data = []
+        for (pre, suff), counts in zip(pairs, sub_counts):
+            pres.append(pre)
+            suffs.append(suff)
+            row = sorted((sub_ids.setdefault(sub, len(sub_ids)), count) for sub, count in counts.items())
+            indices += [col for col, _ in row]
+            data += [count for _, count in row]
+            indptr.append(len(indices))
+        return cls(pres, suffs, list(sub_ids), indptr, indices, data)
+
+    def save(self, path):
+        np.savez_compressed(path,
+                pres=self.pres, suffs=self.suffs, subs=self.subs,
+                indptr=self.indptr, indices=self.indices, data=self.data,
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['pres'], f['suffs'], f['subs'], f['indptr'], f['indices'], f['data'])
+
+    @property
+    def shape(self):
+        return (len(self.pres), len(self.subs))
+
+    def row_ids(self):
+        """Return the row index of each stored entry (parallel to indices and data)."""
+        return np.repeat(np.arange(len(self.pres)), np.diff(self.indptr))
+
+    def terms(self):
+        return np.char.add(self.pres, self.suffs)
+
+    def sub_totals(self):
+        """Return a series mapping subreddit to its total count over all terms,
+        sorted descending.
+        """
+        totals = np.bincount(self.indices, weights=self.data, minlength=len(self.subs))
+        return pd.Series(totals, index=self.subs).sort_values(ascending=False)
+
+    def term_totals(self):
+        totals = np.bincount(self.row_ids(), weights=self.data, minlength=len(self.pres))
+        return pd.Series(totals, index=self.terms())
+
+    def top_subs(self, k=10):
+        return self.sub_totals().head(k)
+
+    def top_terms_for_sub(self, sub, k=10):
+        """Return a series of the k terms with the highest counts in the given subreddit."""
+        mask = self.indices == self.sub_ids[sub]
+        rows = self.row_ids()[mask]
+        counts = self.data[mask]
+        order = np.argsort(-counts, kind='stable')[:k]
+        return pd.Series(counts[order], index=self.terms()[rows[order]])
+
+    def top_subs_for_term(self, term, k=10):
+        """Return a series of the k subreddits with the highest counts for the given term."""
+        i = int(np.flatnonzero(self.terms() == term)[0])
+        lo, hi = self.indptr[i], self.indptr[i+1]
+        counts = self.data[lo:hi]
+        order = np.argsort(-counts, kind='stable')[:k]
+        return pd.Series(counts[order], index=self.subs[self.indices[lo:hi][order]])
+
+    def to_scipy(self):
+        from scipy.sparse import csr_matrix
+        return csr_matrix((self.data, self.indices, self.indptr), shape=self.shape)
+
+    def to_long_df(self):
+        """Return a dataframe in the same long format as the csv output of
+        compute_counts.py --sub, with columns pre, suff, sub, count.
+        """
+        rows = self.row_ids()
+        return pd.DataFrame(dict(
+            pre=self.pres[rows], suff=self.suffs[rows],
+            sub=self.subs[self.indices], count=self.data,
+        ))
@@ -0,0 +1,319 @@
+"""Suffix array index over the bodies of all downloaded comments, for quickly
+counting occurrences of arbitrary strings without going back to Pushshift.
+
+Build the index (from comment_data/ and sampled_comment_data/) with
+    python substring_index.py build
+then e.g.
+    python substring_index.py count shitgoblin buttwaffle
+    python substring_index.py expand --rounds 5
+
+Bodies are lowercased, so all matching is case insensitive. Each comment is
+indexed once, even if it appears in the files of several terms.
+
+NB: The corpus only consists of comments that matched one of our existing
+compounds, so counts for other strings are biased towards the company those
+compounds keep. That's fine for ranking candidate affixes relative to one
+another, but these aren't estimates of frequency on Reddit at large.
+"""
+import os
+import sys
+import glob
+import math
+import argparse
+from collections import Counter
+
+import numpy as np
+try:
+    import pydivsufsort
+except ImportError:
+    pydivsufsort = None
+
+import comment_store
+from compute_counts import RAW_DIR, SAMPLED_DIR
+from reddit_counts import prefixes, suffixes
+
+DEFAULT_INDEX_DIR = 'substring_index'
+
+# Separates comments in the indexed text. Never occurs in a (lowercased, utf-8 encoded) query.
+SEP = 0
+
+# Number of chars the first round of prefix doubling sorts by. Each is packed
+# into 9 bits (0 for past the end of the text), so 7 fit in an int64.
+INITIAL_CHARS = 7
+
+def suffix_array(text):
+    """Return the suffix array of the given uint8 array.
+
+    If pydivsufsort is installed, this is computed in O(n log n) time with
+    little memory beyond the result. Otherwise we fall back to prefix doubling
+    in numpy, which is several times slower, and needs ~40 bytes per byte of
+    text at its peak.
+    """
+    n = len(text)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    if pydivsufsort is not None:
+        return pydivsufsort.divsufsort(np.array(text, dtype=np.uint8))
+    dtype = np.int32 if n < 2**31 else np.int64
+    # Sort by the first few chars all at once
+    key = np.zeros(n, dtype=np.int64)
+    chars = np.empty(n, dtype=np.int64)
+    for j in range(INITIAL_CHARS):
+        key <<= 9
+        if j < n:
+            np.add(text[j:], 1, out=chars[:n-j])
+            key[:n-j] |= chars[:n-j]
+    del chars
+    # (The order within a group doesn't matter, as groups get sorted below)
+    sa = np.argsort(key)
+    key = key[sa]
+    sa = sa.astype(dtype)
+    todo = np.arange(n, dtype=dtype)
+    k = INITIAL_CHARS
+    # A suffix's rank is the position in sa of the first suffix in its group
+    # (of suffixes sharing their first k chars), so ranks never need
+    # renumbering when groups are split
+    rank = np.empty(n, dtype=dtype)
+    while True:
+        # key holds the sorted keys of the suffixes at positions todo in sa
+        starts_group = np.concatenate([[True], key[1:] != key[:-1], [True]])
+        del key
+        rank[sa[todo]] = np.maximum.accumulate(np.where(starts_group[:-1], todo, 0))
+        # Only suffixes whose group has other members need sorting further,
+        # and there are usually few left after a couple of rounds
+        todo = todo[~(starts_group[:-1] & starts_group[1:])]
+        del starts_group
+        if not len(todo):
+            return sa
+        idx = sa[todo]
+        # Sort by (rank of the first k chars, rank of the next k chars),
+        # where a suffix ending before then comes first
+        key = rank[idx].astype(np.int64)
+        key *= n + 1
+        more = idx < n - k
+        following = idx[more]
+        following += k
+        following = rank[following]
+        following += 1
+        key[more] += following
+        del more, following
+        order = np.argsort(key)
+        # Groups occupy contiguous runs of todo, so sorting within each keeps them in place
+        sa[todo] = idx[order]
+        del idx
+        key = key[order]
+        del order
+        k *= 2
+
+def iter_corpus_comments():
+    """Yield each downloaded comment once (deduplicated by comment_key)."""
+    seen = set()
+    for dirname in (RAW_DIR, SAMPLED_DIR):
+        paths = sorted(glob.glob(os.path.join(dirname, '*' + comment_store.JSONL_EXT))
+                + glob.glob(os.path.join(dirname, '*' + comment_store.LEGACY_EXT)))
+        for path in paths:
+            if path.endswith(comment_store.SAMPLE_INFO_EXT):
+                continue
+            for comment in comment_store.iter_comments(path):
+                key = comment_store.comment_key(comment)
+                if key is not None:
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                yield comment
+
+# Max length of the runs of letters returned by SubstringIndex.continuations
+MAX_RUN = 64
+# Number of occurrences whose continuations are gathered at once (each takes
+# a few times MAX_RUN bytes of scratch space)
+CONTINUATION_CHUNK = 1 << 16
+
+class SubstringIndex:
+
+    def __init__(self, text, sa, doc_starts):
+        # text is a uint8 array of the concatenated lowercased comment bodies,
+        # each followed by SEP. doc_starts[i] is the offset of the ith comment.
+        self.text = text
+        self.sa = sa
+        self.doc_starts = doc_starts
+
+    @classmethod
+    def build(cls, bodies):
+        chunks = []
+        doc_starts = []
+        offset = 0
+        for body in bodies:
+            b = body.lower().encode('utf-8').replace(b'\x00', b'') + b'\x00'
+            doc_starts.append(offset)
+            chunks.append(b)
+            offset += len(b)
+        text = np.frombuffer(b''.join(chunks), dtype=np.uint8)
+        return cls(text, suffix_array(text), np.array(doc_starts, dtype=np.int64))
+
+    def save(self, dirname=DEFAULT_INDEX_DIR):
+        os.makedirs(dirname, exist_ok=True)
+        np.save(os.path.join(dirname, 'text.npy'), self.text)
+        np.save(os.path.join(dirname, 'sa.npy'), self.sa)
+        np.save(os.path.join(dirname, 'docs.npy'), self.doc_starts)
+
+    @classmethod
+    def load(cls, dirname=DEFAULT_INDEX_DIR):
+        load = lambda name: np.load(os.path.join(dirname, name), mmap_mode='r')
+        return cls(load('text.npy'), load('sa.npy'), load('docs.npy'))
+
+    def _range(self, pattern):
+        """Return the (start, end) range of the suffix array whose suffixes begin
+        with the given (bytes) pattern.
+        """
+        # Each probe only reads m bytes of the text, so it can stay memory mapped
+        text, sa = self.text, self.sa
+        m = len(pattern)
+        lo, hi = 0, len(sa)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = int(sa[mid])
+            if text[pos:pos+m].tobytes() < pattern:
+                lo = mid + 1
+            else:
+                hi = mid
+        start = lo
+        hi = len(sa)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = int(sa[mid])
+            if text[pos:pos+m].tobytes() <= pattern:
+                lo = mid + 1
+            else:
+                hi = mid
+        return start, lo
+
+    def positions(self, s):
+        start, end = self._range(s.lower().encode('utf-8'))
+        return self.sa[start:end]
+
+    def occurrences(self, s):
+        """Return the number of times the given string occurs in the corpus."""
+        start, end = self._range(s.lower().encode('utf-8'))
+        return end - start
+
+    def comment_count(self, s):
+        """Return the number of comments containing the given string."""
+        docs = np.searchsorted(self.doc_starts, self.positions(s), side='right') - 1
+        return len(np.unique(docs))
+
+    def continuations(self, s, forward=True):
+        """Return a Counter of the runs of letters immediately following (or
+        preceding, if forward is False) each occurrence of the given string.
+        e.g. continuations('butt') might include 'head', 'face', 'ocks'...
+        """
+        n = len(s.lower().encode('utf-8'))
+        text = self.text
+        positions = self.positions(s)
+        # Offsets of the window of MAX_RUN bytes after (or before) an occurrence.
+        # Runs longer than the window are cut short, but they're far longer
+        # than any affix we'd consider anyway
+        offsets = np.arange(n, n + MAX_RUN) if forward else np.arange(-MAX_RUN, 0)
+        runs = Counter()
+        for i in range(0, len(positions), CONTINUATION_CHUNK):
+            idx = np.asarray(positions[i:i+CONTINUATION_CHUNK], dtype=np.int64)[:, None] + offsets
+            inside = (idx >= 0) & (idx < len(text))
+            windows = text[np.clip(idx, 0, len(text) - 1)]
+            letters = inside & (windows >= ord('a')) & (windows <= ord('z'))
+            # Only the letters adjacent to the occurrence, up to the first non-letter
+            if forward:
+                in_run = np.logical_and.accumulate(letters, axis=1)
+            else:
+                in_run = np.logical_and.accumulate(letters[:, ::-1], axis=1)[:, ::-1]
+            has_run = in_run[:, 0] if forward else in_run[:, -1]
+            # Zero out everything else (letters are never 0), and tally each
+            # distinct window as a single fixed-width bytes value
+            windows = np.where(in_run, windows, 0).astype(np.uint8)[has_run]
+            distinct, counts = np.unique(windows.view(f'V{MAX_RUN}').ravel(), return_counts=True)
+            for run, count in zip(distinct, counts.tolist()):
+                runs[run.tobytes().strip(b'\x00').decode('ascii')] += count
+        return runs
+
+def affix_score(index, affix, partners, is_suffix):
+    """Sum of log counts of the compounds formed by combining the given affix
+    with each of partners (prefixes, if affix is a suffix, and vice versa).
+    """
+    compounds = [partner + affix for partner in partners] if is_suffix else [affix + partner for partner in partners]
+    return sum(math.log10(1 + index.comment_count(compound)) for compound in compounds)
+
+def candidate_affixes(index, partners, is_suffix, min_len=2, max_len=10, min_count=5):
+    """Return candidate suffixes (or prefixes) found by looking at the runs of
+    letters following (preceding) the given prefixes (suffixes) in the corpus.
+    """
+    runs = Counter()
+    for partner in partners:
+        for run, count in index.continuations(partner, forward=is_suffix).items():
+            if min_len <= len(run) <= max_len:
+                runs[run] += count
+    return [run for run, count in runs.items() if count >= min_count]
+
+def rank_affixes(index, candidates, partners, is_suffix, k=20):
+    """Return the k (score, affix) pairs with the best affix_score."""
+    scores = [(affix_score(index, cand, partners, is_suffix), cand) for cand in candidates]
+    return sorted(scores, reverse=True)[:k]
+
+def expand_affixes(index, pres, suffs, rounds=1, candidates=None):
+    """Greedily grow the given prefix and suffix lists. In each round, add the
+    candidate suffix that best combines with the current prefixes, then the
+    candidate prefix that best combines with the current suffixes. Candidates
+    are mined from the corpus unless given as a (prefixes, suffixes) tuple.
+
+    Return the lists of added prefixes and suffixes, in order of addition.
+    """
+    pres, suffs = list(pres), list(suffs)
+    added_pres, added_suffs = [], []
+    for _ in range(rounds):
+        for is_suffix in (True, False):
+            current, partners = (suffs, pres) if is_suffix else (pres, suffs)
+            if candidates:
+                pool = candidates[1] if is_suffix else candidates[0]
+            else:
+                pool = candidate_affixes(index, partners, is_suffix)
+            pool = [cand for cand in pool if cand not in current]
+            best = rank_affixes(index, pool, partners, is_suffix, k=1)
+            if not best:
+                continue
+            score, affix = best[0]
+            sys.stderr.write(f"Adding {'suffix' if is_suffix else 'prefix'} {affix!r} (score {score:.1f})\n")
+            current.append(affix)
+            (added_suffs if is_suffix else added_pres).append(affix)
+    return added_pres, added_suffs
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build or query a substring index over downloaded comments")
+    parser.add_argument('--index', default=DEFAULT_INDEX_DIR, help="Directory holding the index")
+    subparsers = parser.add_subparsers(dest='cmd', required=True)
+    subparsers.add_parser('build')
+    count_parser = subparsers.add_parser('count')
+    count_parser.add_argument('strings', nargs='+')
+    expand_parser = subparsers.add_parser('expand')
+    expand_parser.add_argument('--rounds', type=int, default=1)
+    expand_parser.add_argument('--top', type=int, default=20,
+            help="Also print the top this many candidates of each kind, as of the first round",
+    )
+    args = parser.parse_args()
+
+    if args.cmd == 'build':
+        index = SubstringIndex.build(comment['body'] for comment in iter_corpus_comments())
+        index.save(args.index)
+        print(f"Indexed {len(index.doc_starts)} comments ({len(index.text)} bytes)")
+    elif args.cmd == 'count':
+        index = SubstringIndex.load(args.index)
+        print("string,occurrences,comments")
+        for s in args.strings:
+            print(f"{s},{index.occurrences(s)},{index.comment_count(s)}")
+    elif args.cmd == 'expand':
+        index = SubstringIndex.load(args.index)
+        for is_suffix in (True, False):
+            current, partners = (suffixes, prefixes) if is_suffix else (prefixes, suffixes)
+            pool = [c for c in candidate_affixes(index, partners, is_suffix) if c not in current]
+            print(f"Top candidate {'suffixes' if is_suffix else 'prefixes'}:")
+            for score, affix in rank_affixes(index, pool, partners, is_suffix, args.top):
+                print(f"  {affix}\t{score:.1f}")
+        added_pres, added_suffs = expand_affixes(index, prefixes, suffixes, args.rounds)
+        print(f"Added prefixes: {','.join(added_pres)}")
+        print(f"Added suffixes: {','.join(added_suffs)}")
@@ -0,0 +1,166 @@
+"""Generate a synthetic corpus of comments for all our compounds, laid out like
+the real thing (comment_data/ and sampled_comment_data/), for benchmarking
+(see benchmark.py) or testing the counting scripts without downloading anything.
+
+    python synth_corpus.py synth/ --comments 100000
+
+Term frequencies follow a Zipf distribution, with the count for the term at
+rank r proportional to r**-exponent. The default exponent roughly matches the
+real counts.csv (see zipf.ipynb), where the top 10 terms account for ~70% of
+comments and the top 100 for ~95%. Body lengths are log-normally distributed.
+A configurable fraction of comments are noise of the kinds compute_counts.py
+filters out: term occurrences inside urls, subreddit/user references, and
+copypasta.
+
+As with the real data, terms with more than --sampled-above comments have only
+that many in comment_data/, plus a sample of ~30 days' worth per year in
+sampled_comment_data/ (in the legacy fixed-interval format, without sample
+info).
+"""
+import os
+import sys
+import argparse
+
+import numpy as np
+
+import comment_store
+from compute_counts import RAW_DIR, SAMPLED_DIR, FIXED_SAMPLING_MULTIPLIER, all_terms
+from reddit_counts import END_TIMESTAMP
+
+ZIPF_EXPONENT = 1.5
+# Parameters of the (log-normal) distribution of the number of words per comment.
+# Median of about 20 words, with a long tail.
+BODY_WORDS_MU = 3.0
+BODY_WORDS_SIGMA = 1.0
+MAX_BODY_WORDS = 2000
+
+DEFAULT_URL_RATE = .03
+DEFAULT_SUB_REF_RATE = .03
+DEFAULT_COPYPASTA_RATE = .01
+
+FIRST_TIMESTAMP = 1136073600 # 2006-01-01
+
+FILLER_WORDS = ("you are such a the what lol this is why i can't even with that guy "
+        "and his friend total absolute complete literally actually just stop being "
+        "seriously who does that my mom said okay but also maybe").split()
+SUBREDDITS = ['AskReddit', 'funny', 'pics', 'gaming', 'worldnews', 'politics',
+        'videos', 'todayilearned', 'movies', 'news', 'nba', 'soccer', 'copypasta']
+# Relative frequencies of the above
+SUBREDDIT_WEIGHTS = [20, 10, 8, 8, 6, 6, 5, 5, 4, 4, 3, 3, .5]
+
+COPYPASTAS = [
+    "homodumbshit cocknugget doochbag",
+    "2 girls 1 cup, 2g1c",
+]
+
+def zipf_counts(nterms, ncomments, exponent, rng):
+    """Return an array of the number of comments for each of nterms terms,
+    summing to ncomments, with a randomly shuffled assignment of ranks to terms.
+    """
+    weights = np.arange(1, nterms+1, dtype=np.float64) ** -exponent
+    counts = rng.multinomial(ncomments, weights / weights.sum())
+    rng.shuffle(counts)
+    return counts
+
+class CommentFactory:
+
+    def __init__(self, rng, url_rate=DEFAULT_URL_RATE, sub_ref_rate=DEFAULT_SUB_REF_RATE,
+            copypasta_rate=DEFAULT_COPYPASTA_RATE):
+        self.rng = rng
+        self.url_rate = url_rate
+        self.sub_ref_rate = sub_ref_rate
+        self.copypasta_rate = copypasta_rate
+        self.sub_probs = np.array(SUBREDDIT_WEIGHTS) / sum(SUBREDDIT_WEIGHTS)
+        self.next_id = 0
+
+    def usage(self, term, r):
+        """Return the text of an occurrence of term, which is noisy (in a url or
+        subreddit/user reference) depending on r, a uniform random number.
+        """
+        if r < self.url_rate:
+            return f"[link](https://www.example.com/{term}/{self.rng.integers(1e6)})"
+        elif r < self.url_rate + self.sub_ref_rate:
+            return self.rng.choice(['/r/', '/u/', 'r/', 'u/']) + term
+        return term if self.rng.random() < .8 else term.capitalize() + '!'
+
+    def make_all(self, term, timestamps):
+        """Return a list of comments using the given term, one per timestamp."""
+        rng = self.rng
+        n = len(timestamps)
+        nwords = np.clip(rng.lognormal(BODY_WORDS_MU, BODY_WORDS_SIGMA, n).astype(int), 1, MAX_BODY_WORDS)
+        words = rng.choice(FILLER_WORDS, nwords.sum())
+        ends = np.cumsum(nwords)
+        noise = rng.random(n)
+        copypasta = rng.random(n) < self.copypasta_rate
+        subs = rng.choice(SUBREDDITS, n, p=self.sub_probs)
+        scores = rng.integers(-10, 100, n)
+        authors = rng.integers(100000, size=n)
+        comments = []
+        for i in range(n):
+            body = words[ends[i]-nwords[i]:ends[i]].tolist()
+            body.insert(int(rng.integers(nwords[i] + 1)), self.usage(term, noise[i]))
+            if copypasta[i]:
+                body.append(COPYPASTAS[i % len(COPYPASTAS)])
+            self.next_id += 1
+            comments.append(dict(
+                    author=f"user{authors[i]}",
+                    body=' '.join(body),
+                    created_utc=int(timestamps[i]),
+                    id=f"s{self.next_id:x}",
+                    permalink=f"/r/{subs[i]}/comments/synth/_/s{self.next_id:x}/",
+                    score=int(scores[i]),
+                    subreddit=str(subs[i]),
+            ))
+        return comments
+
+def sample_mask(timestamps, rng):
+    """Return a boolean mask selecting the comments falling in ~30 randomly
+    chosen days of each year, mimicking sampled_counts.py's fixed intervals.
+    """
+    days = timestamps // 86400
+    uniq = np.unique(days)
+    chosen = uniq[rng.random(len(uniq)) < 1 / FIXED_SAMPLING_MULTIPLIER]
+    return np.isin(days, chosen)
+
+def generate(outdir, ncomments, exponent=ZIPF_EXPONENT, sampled_above=10000, seed=1337, **noise):
+    """Write a synthetic corpus of about ncomments comments under outdir. Return
+    a dict mapping term to the number of comments generated for it.
+    """
+    rng = np.random.default_rng(seed)
+    factory = CommentFactory(rng, **noise)
+    terms = all_terms()
+    counts = zipf_counts(len(terms), ncomments, exponent, rng)
+    raw_dir = os.path.join(outdir, RAW_DIR)
+    sampled_dir = os.path.join(outdir, SAMPLED_DIR)
+    os.makedirs(raw_dir, exist_ok=True)
+    os.makedirs(sampled_dir, exist_ok=True)
+    for term, n in zip(terms, counts):
+        timestamps = np.sort(rng.integers(FIRST_TIMESTAMP, END_TIMESTAMP, n))
+        comments = factory.make_all(term, timestamps)
+        if n > sampled_above:
+            sampled = [c for c, keep in zip(comments, sample_mask(timestamps, rng)) if keep]
+            with comment_store.CommentWriter(comment_store.comments_path(sampled_dir, term)) as writer:
+                writer.append(sampled, done=True)
+            # Like the real downloader, we stop after a fixed number of comments (most recent first)
+            comments = comments[::-1][:sampled_above]
+        with comment_store.CommentWriter(comment_store.comments_path(raw_dir, term)) as writer:
+            writer.append(comments, done=True)
+    return dict(zip(terms, counts.tolist()))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate a synthetic comment corpus")
+    parser.add_argument('outdir')
+    parser.add_argument('-n', '--comments', type=int, default=100000)
+    parser.add_argument('--exponent', type=float, default=ZIPF_EXPONENT)
+    parser.add_argument('--sampled-above', type=int, default=10000,
+            help="Terms with more comments than this get sampled data (and capped raw data)",
+    )
+    parser.add_argument('--url-rate', type=float, default=DEFAULT_URL_RATE)
+    parser.add_argument('--sub-ref-rate', type=float, default=DEFAULT_SUB_REF_RATE)
+    parser.add_argument('--copypasta-rate', type=float, default=DEFAULT_COPYPASTA_RATE)
+    parser.add_argument('--seed', type=int, default=1337)
+    args = parser.parse_args()
+    counts = generate(args.outdir, args.comments, args.exponent, args.sampled_above, args.seed,
+            url_rate=args.url_rate, sub_ref_rate=args.sub_ref_rate, copypasta_rate=args.copypasta_rate)
+    nsampled = sum(n > args.sampled_above for n in counts.values())
+    sys.stderr.write(f"Wrote {sum(counts.values())} comments for {len(counts)} terms ({nsampled} sampled) to {args.outdir}\n")
@@ -0,0 +1,89 @@
+"""Aho-Corasick automaton for finding all of a fixed set of terms occurring in
+a string in a single left-to-right scan.
+
+Used by compute_counts so that a comment containing several of our compounds
+(e.g. "you absolute dickweasel shitgoblin") only needs to be scanned once,
+rather than once per term.
+"""
+import re
+from collections import deque
+
+class TermMatcher:
+
+    def __init__(self, terms):
+        # State 0 is the root. goto[s] maps a character to the next state,
+        # fail[s] is the state for the longest proper suffix of s's string
+        # which is also a prefix of some term, and out[s] is the set of terms
+        # ending at s (including those reachable via fail links).
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [frozenset()]
+        self.terms = []
+        for term in terms:
+            self._insert(term)
+        self._link()
+
+    def _insert(self, term):
+        assert term, "Can't match on empty string"
+        state = 0
+        for ch in term:
+            nxt = self.goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(frozenset())
+                self.goto[state][ch] = nxt
+            state = nxt
+        self.out[state] = self.out[state] | {term}
+        self.terms.append(term)
+
+    def _link(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                if self.out[self.fail[nxt]]:
+                    self.out[nxt] = self.out[nxt] | self.out[self.fail[nxt]]
+
+    def terms_in(self, text):
+        """Return the set of terms occurring as substrings of text (case sensitive).
+        """
+        goto, fail, out = self.goto, self.fail, self.out
+        found = set()
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found |= out[state]
+        return found
+
+def trie_pattern(words):
+    """Return a regex (source) matching any of the given words, with the
+    alternatives factored into a trie (e.g. 'd(?:ick|umb)'), which re can
+    search far faster than a flat alternation of thousands of words.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[''] = None
+
+    def build(node):
+        alts = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not alts:
+            return ''
+        pattern = alts[0] if len(alts) == 1 else '(?:' + '|'.join(alts) + ')'
+        if '' in node:
+            # A word ends here, but longer ones may continue
+            pattern = f'(?:{pattern})?'
+        return pattern
+    return build(trie)
@@ -0,0 +1,100 @@
+"""Tests of reddit_counts.py --count-only, against a local stand-in for the
+Pushshift endpoint that answers each query with a canned response.
+"""
+import asyncio
+
+import pytest
+from aiohttp import web
+
+import pushshift
+import reddit_counts
+from reddit_counts import count_hits
+
+# Start of 2019 and 2020 (UTC), as Pushshift keys its yearly buckets
+Y2019 = 1546300800
+Y2020 = 1577836800
+
+RESPONSES = {
+    # Older versions of the API
+    'dumbass': dict(metadata=dict(total_results=12)),
+    # Newer ones pass through Elasticsearch's hit count, either as a bare int...
+    'dorkwad': dict(metadata=dict(es=dict(hits=dict(total=7)))),
+    # ...or with a relation saying whether it's exact
+    'jerkface': dict(metadata=dict(es=dict(hits=dict(total=dict(value=10000, relation='gte'))))),
+    'lamebrain': dict(
+        metadata=dict(total_results=5),
+        aggs=dict(
+            created_utc=[dict(key=Y2019, doc_count=2), dict(key=Y2020, doc_count=3)],
+            subreddit=[dict(key='AskReddit', doc_count=4), dict(key='pics', doc_count=1)],
+        ),
+    ),
+}
+
+async def with_server(fn, requests, status=200):
+    """Run fn(client), with a client pointed at a stand-in server that
+    records the params of each request it gets in the given list. Return
+    the result.
+    """
+    async def search(request):
+        requests.append(dict(request.query))
+        if status != 200:
+            return web.Response(status=status)
+        return web.json_response(RESPONSES[request.query['q']])
+
+    app = web.Application()
+    app.router.add_get('/reddit/comment/search', search)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    try:
+        url = f'http://127.0.0.1:{port}/reddit/comment/search'
+        async with pushshift.PushshiftClient(requests_per_second=1000, url=url) as client:
+            return await fn(client)
+    finally:
+        await runner.cleanup()
+
+def run(fn, status=200):
+    requests = []
+    result = asyncio.run(with_server(fn, requests, status))
+    return result, requests
+
+def test_count_asks_for_metadata_only():
+    counts, requests = run(lambda client: client.count(q='dumbass', before=100, after=0))
+    assert counts == dict(total=12)
+    [params] = requests
+    assert params == dict(q='dumbass', before='100', after='0', size='0', metadata='true')
+
+@pytest.mark.parametrize('term, total', [
+    ('dumbass', 12),
+    ('dorkwad', 7),
+    ('jerkface', 10000),
+])
+def test_total_hits(term, total):
+    counts, _ = run(lambda client: count_hits(term, client))
+    assert counts == dict(total=total)
+
+def test_total_hits_warns_of_lower_bound(capsys):
+    run(lambda client: count_hits('jerkface', client))
+    assert 'only a lower bound' in capsys.readouterr().err
+
+def test_count_hits_by_year():
+    counts, [params] = run(lambda client: count_hits('lamebrain', client, by='year'))
+    assert counts == dict(total=5, year={2019: 2, 2020: 3})
+    assert params['aggs'] == 'created_utc'
+    assert params['frequency'] == 'year'
+    assert params['before'] == str(reddit_counts.END_TIMESTAMP)
+
+def test_count_hits_by_sub():
+    counts, [params] = run(lambda client: count_hits('lamebrain', client, by='sub'))
+    assert counts == dict(total=5, sub={'AskReddit': 4, 'pics': 1})
+    assert params['aggs'] == 'subreddit'
+    assert 'frequency' not in params
+
+def test_count_hits_failure(monkeypatch, capsys):
+    monkeypatch.setattr(pushshift, 'MAX_RETRIES', 0)
+    counts, requests = run(lambda client: count_hits('dumbass', client), status=500)
+    assert counts is None
+    assert len(requests) == 1
+    assert 'giving up' in capsys.readouterr().err
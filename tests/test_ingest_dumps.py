@@ -0,0 +1,99 @@
+"""Tests of ingest_dumps.py on a tiny synthetic two-month dump, and of
+compute_counts.py reading the resulting shards.
+"""
+import os
+import json
+import datetime
+
+import numpy as np
+import pytest
+import zstandard
+
+import comment_store
+import compute_counts
+import ingest_dumps
+
+def ts(*date):
+    return int(datetime.datetime(*date, tzinfo=datetime.timezone.utc).timestamp())
+
+# In the shape of real dump lines: numbers often given as strings, and (in
+# older dumps) no permalink
+JAN = [
+    dict(id='c1', link_id='t3_l1', subreddit='pics', body="what a dumbass",
+        created_utc=str(ts(2015, 1, 3)), score='5', author='a', subreddit_id='t5_1'),
+    dict(id='c2', link_id='t3_l2', subreddit='AskReddit', body="you dumbass douchebag",
+        created_utc=ts(2015, 1, 9), score=-2, author='b'),
+    dict(id='c3', link_id='t3_l1', subreddit='pics', body="nothing to see here",
+        created_utc=str(ts(2015, 1, 10)), score='1', author='c'),
+    # Same body as c1, but not valid
+    dict(id='c4', link_id='t3_l3', subreddit='copypasta', body="what a dumbass",
+        created_utc=str(ts(2015, 1, 20)), score='0', author='d'),
+]
+FEB = [
+    dict(id='c5', link_id='t3_l4', subreddit='nba', body="Dumbass!",
+        created_utc=str(ts(2015, 2, 1)), score='3', author='e',
+        permalink='/r/nba/comments/l4/some_title/c5/'),
+    dict(id='c6', link_id='t3_l4', subreddit='nba', body="see http://dumbass.com",
+        created_utc=str(ts(2015, 2, 2)), score='1', author='f'),
+]
+
+def write_dump(path, comments):
+    data = ''.join(json.dumps(comment) + '\n' for comment in comments).encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(zstandard.ZstdCompressor().compress(data))
+    return str(path)
+
+@pytest.fixture
+def dumps(tmp_path, monkeypatch):
+    """Write the dump files, and run in a fresh working directory, with
+    compute_counts expecting dumps for just their two months.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(compute_counts, 'FIRST_DUMP_MONTH', np.datetime64('2015-01', 'M'))
+    monkeypatch.setattr(compute_counts, 'END_TIMESTAMP', ts(2015, 3, 1))
+    compute_counts._ingest_manifest.cache_clear()
+    yield write_dump(tmp_path / 'RC_2015-01.zst', JAN), write_dump(tmp_path / 'RC_2015-02.zst', FEB)
+    compute_counts._ingest_manifest.cache_clear()
+
+def read_shard(term, month):
+    return list(comment_store.iter_comments(comment_store.shard_path(compute_counts.DUMP_DIR, term, month)))
+
+def test_ingest(dumps):
+    ingest_dumps.ingest(dumps)
+    manifest = comment_store.read_ingest_manifest(compute_counts.DUMP_DIR)
+    assert sorted(manifest['months']) == ['RC_2015-01', 'RC_2015-02']
+    jan = read_shard('dumbass', 'RC_2015-01')
+    assert [c['body'] for c in jan] == ["what a dumbass", "you dumbass douchebag", "what a dumbass"]
+    assert jan[0] == dict(body="what a dumbass", created_utc=ts(2015, 1, 3), score=5, subreddit='pics',
+            author='a', permalink='/r/pics/comments/l1/_/c1/')
+    # Distinct comments get distinct permalinks, and real ones are kept
+    assert len({c['permalink'] for c in jan}) == 3
+    assert read_shard('dumbass', 'RC_2015-02')[0]['permalink'] == '/r/nba/comments/l4/some_title/c5/'
+    assert [c['body'] for c in read_shard('douchebag', 'RC_2015-01')] == ["you dumbass douchebag"]
+    assert not os.path.exists(comment_store.shard_path(compute_counts.DUMP_DIR, 'douchebag', 'RC_2015-02'))
+
+def test_resume_after_interrupted_month(dumps, capsys):
+    jan, feb = dumps
+    ingest_dumps.ingest([jan])
+    # A run that died partway through February leaves a partial shard behind
+    tmp = comment_store.shard_path(compute_counts.DUMP_DIR, 'dumbass', 'RC_2015-02') + '.tmp'
+    os.makedirs(os.path.dirname(tmp), exist_ok=True)
+    with open(tmp, 'w') as f:
+        f.write('{"body": "half a')
+    capsys.readouterr()
+    ingest_dumps.ingest([jan, feb])
+    assert "Ingesting 1 month files (1 already done)" in capsys.readouterr().err
+    assert [c['body'] for c in read_shard('dumbass', 'RC_2015-02')] == ["Dumbass!", "see http://dumbass.com"]
+    assert not os.path.exists(tmp)
+
+def test_count_from_shards(dumps):
+    ingest_dumps.ingest(dumps)
+    assert compute_counts.comment_sources('dumbass')[1] is False
+    comments, sampled = compute_counts.load_compact_comments('dumbass')
+    assert len(comments) == 5
+    assert list(comments.created_utc)[0] == ts(2015, 1, 3)
+    engine = compute_counts.CountingEngine(compute_counts.all_terms())
+    for term, count in [('dumbass', 3), ('douchebag', 1), ('dorkwad', 0)]:
+        assert compute_counts.count_for_term(term, raw=False) == count
+        assert compute_counts.count_for_term(term, raw=False, engine=engine) == count
+    assert compute_counts.sub_counts_for_term('dumbass', engine) == dict(pics=1, AskReddit=1, nba=1)
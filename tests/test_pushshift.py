@@ -0,0 +1,149 @@
+"""Tests of the shared Pushshift client: paging through results, backing off
+when rate limited, and the token bucket. Run against a local stand-in for the
+endpoint, as in test_count_only.py.
+"""
+import time
+import asyncio
+import email.utils
+
+import pytest
+from aiohttp import web
+
+import comment_store
+import download_plan
+import pushshift
+import reddit_counts
+
+# The stand-in's comments, newest first, 10 seconds apart
+NCOMMENTS = 250
+COMMENTS = [dict(body=f"dumbass #{i}", subreddit='pics', score=1, created_utc=10 * i,
+        permalink=f'/r/pics/comments/x/_/c{i}/', id=f'c{i}')
+        for i in range(NCOMMENTS, 0, -1)]
+
+def search_comments(query):
+    """Answer a search like Pushshift would (for sort=desc)."""
+    before = int(query.get('before', 2**62))
+    after = int(query.get('after', 0))
+    limit = int(query.get('limit', 25))
+    return [c for c in COMMENTS if after < c['created_utc'] < before][:limit]
+
+async def with_server(fn, handle, requests, **client_args):
+    """Run fn(client), with a client pointed at a stand-in server whose
+    responses are given by handle(query, nrequests) (a json-able object, or
+    an aiohttp Response). Each request's params are recorded in requests.
+    """
+    async def search(request):
+        requests.append(dict(request.query))
+        resp = handle(request.query, len(requests))
+        return resp if isinstance(resp, web.Response) else web.json_response(resp)
+
+    app = web.Application()
+    app.router.add_get('/reddit/comment/search', search)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    try:
+        url = f'http://127.0.0.1:{port}/reddit/comment/search'
+        client_args.setdefault('requests_per_second', 1000)
+        async with pushshift.PushshiftClient(url=url, **client_args) as client:
+            return await fn(client)
+    finally:
+        await runner.cleanup()
+
+def run(fn, handle, **client_args):
+    requests = []
+    result = asyncio.run(with_server(fn, handle, requests, **client_args))
+    return result, requests
+
+def paged(query, _):
+    return dict(data=search_comments(query))
+
+def test_search():
+    dat, [params] = run(lambda client: client.search(q='dumbass', limit=3, before=2000), paged)
+    assert [c['created_utc'] for c in dat['data']] == [1990, 1980, 1970]
+    assert params == dict(q='dumbass', limit='3', before='2000')
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / reddit_counts.CACHE_DIR).mkdir()
+
+def stored():
+    return list(comment_store.iter_term_comments(reddit_counts.CACHE_DIR, 'dumbass'))
+
+def test_download_pages(cache_dir):
+    finished, requests = run(lambda client: reddit_counts.download_comments('dumbass', client), paged)
+    assert finished
+    # Full pages of 100, then a short one
+    assert len(requests) == 3
+    assert [int(r['before']) for r in requests] == [reddit_counts.END_TIMESTAMP, 1509, 509]
+    assert [c['created_utc'] for c in stored()] == [c['created_utc'] for c in COMMENTS]
+    # Only the whitelisted fields are kept
+    assert 'id' not in stored()[0]
+    assert comment_store.stored_cursor(reddit_counts.CACHE_DIR, 'dumbass')['done']
+
+def test_download_resumes(cache_dir):
+    budget = download_plan.RequestBudget(1)
+    finished, _ = run(lambda client: reddit_counts.download_comments('dumbass', client, budget), paged)
+    assert not finished
+    assert len(stored()) == 100
+    assert not comment_store.stored_cursor(reddit_counts.CACHE_DIR, 'dumbass').get('done')
+    finished, requests = run(lambda client: reddit_counts.download_comments('dumbass', client), paged)
+    assert finished
+    # Picks up where the first run left off
+    assert int(requests[0]['before']) == 1509
+    assert [c['created_utc'] for c in stored()] == [c['created_utc'] for c in COMMENTS]
+
+def test_retry_after():
+    def rate_limited(query, n):
+        if n < 3:
+            return web.Response(status=429, headers={'Retry-After': '0'})
+        return paged(query, n)
+    t0 = time.monotonic()
+    dat, requests = run(lambda client: client.search(q='dumbass', limit=1), rate_limited)
+    # Waited as long as the server asked (not 2 + 4 seconds)
+    assert time.monotonic() - t0 < 1
+    assert len(requests) == 3
+    assert dat['data'] == COMMENTS[:1]
+
+def test_give_up(monkeypatch, capsys):
+    monkeypatch.setattr(pushshift, 'MAX_RETRIES', 2)
+    unavailable = lambda query, n: web.Response(status=503, headers={'Retry-After': '0'})
+    dat, requests = run(lambda client: client.search(q='dumbass'), unavailable)
+    assert dat is None
+    assert len(requests) == 3
+    assert 'giving up' in capsys.readouterr().err
+
+def test_retry_after_seconds():
+    assert pushshift.retry_after_seconds(None) is None
+    assert pushshift.retry_after_seconds('garbage') is None
+    assert pushshift.retry_after_seconds('7') == 7
+    assert pushshift.retry_after_seconds('-3') == 0
+    date = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 25 < pushshift.retry_after_seconds(date) <= 30
+    past = email.utils.formatdate(time.time() - 30, usegmt=True)
+    assert pushshift.retry_after_seconds(past) == 0
+
+def test_token_bucket():
+    async def acquire_all(bucket, n):
+        t0 = time.monotonic()
+        await asyncio.gather(*[bucket.acquire() for _ in range(n)])
+        return time.monotonic() - t0
+    # The first token is free, and the rest come at the given rate
+    elapsed = asyncio.run(acquire_all(pushshift.TokenBucket(rate=20), 5))
+    assert 4 / 20 <= elapsed < 1
+    # A burst of up to capacity goes through at once
+    elapsed = asyncio.run(acquire_all(pushshift.TokenBucket(rate=20, capacity=5), 5))
+    assert elapsed < 4 / 20
+
+def test_client_rate_limit():
+    async def search_all(client):
+        t0 = time.monotonic()
+        await asyncio.gather(*[client.search(q='dumbass', limit=1) for _ in range(6)])
+        return time.monotonic() - t0
+    elapsed, requests = run(search_all, paged, requests_per_second=25)
+    assert len(requests) == 6
+    # Concurrent searches share one budget
+    assert elapsed >= 5 / 25
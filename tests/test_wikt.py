@@ -0,0 +1,80 @@
+"""Tests of wikt.exists_many and WiktCache, against a local stand-in for
+wiktionary that has pages for a few words.
+"""
+import threading
+from urllib.parse import unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+import wikt
+
+ENTRY = """<html><body><div id="toc"><ul><li class="toclevel-1"><a href="#English"><span class="tocnumber">1</span> <span class="toctext">English</span></a>
+<ul><li class="toclevel-2"><a href="#Noun"><span class="tocnumber">1.1</span> <span class="toctext">Noun</span></a></li></ul></li></ul></div>
+<h2><span class="mw-headline" id="English">English</span></h2>
+<h3><span class="mw-headline" id="Noun">Noun</span></h3>
+<p><strong class="Latn headword">{word}</strong></p>
+<ol><li>A term of abuse.</li></ol>
+</body></html>"""
+
+MISSING = "<html><body><p>Wiktionary does not yet have an entry for this word.</p></body></html>"
+
+WORDS = {'dumbass', 'douchebag', 'Trumptard'}
+
+@pytest.fixture
+def server(monkeypatch):
+    """Serve the stand-in at WIKTIONARY_URL. Yields the list of words
+    requested from it.
+    """
+    requested = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            word = unquote(self.path.split('/wiki/', 1)[1].split('?')[0])
+            requested.append(word)
+            found = word in WORDS
+            body = (ENTRY.format(word=word) if found else MISSING).encode('utf-8')
+            self.send_response(200 if found else 404)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(wikt, 'WIKTIONARY_URL', f'http://127.0.0.1:{httpd.server_port}/wiki/{{}}?printable=yes')
+    try:
+        yield requested
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+def test_exists_many(server):
+    results = wikt.exists_many(['dumbass', 'dorkwad', 'trumptard', 'dumbass'])
+    assert results == dict(dumbass=True, dorkwad=False, trumptard=True)
+    # Duplicates are only looked up once, and trump- terms are capitalized
+    assert sorted(server) == ['Trumptard', 'dorkwad', 'dumbass']
+
+def test_cache_hits_and_misses(server, tmp_path):
+    path = str(tmp_path / 'wikt_cache.sqlite')
+    cache = wikt.WiktCache(path)
+    assert wikt.exists_many(['dumbass', 'dorkwad'], cache) == dict(dumbass=True, dorkwad=False)
+    assert sorted(server) == ['dorkwad', 'dumbass']
+    cache.close()
+
+    # Both positive and negative results persist, so only the new term is fetched
+    server.clear()
+    cache = wikt.WiktCache(path)
+    assert cache.get_many(['dumbass', 'dorkwad', 'douchebag']) == dict(dumbass=True, dorkwad=False)
+    results = wikt.exists_many(['douchebag', 'dorkwad', 'dumbass'], cache)
+    assert results == dict(douchebag=True, dorkwad=False, dumbass=True)
+    assert server == ['douchebag']
+
+    server.clear()
+    assert wikt.exists_many(['douchebag', 'dorkwad'], cache) == dict(douchebag=True, dorkwad=False)
+    assert server == []
+    cache.close()
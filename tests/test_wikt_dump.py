@@ -0,0 +1,115 @@
+"""Tests of wikt_dump.py's offline index, built from a tiny synthetic
+Wiktionary dump.
+"""
+import os
+import bz2
+import sys
+import subprocess
+
+import pandas as pd
+import pytest
+
+from wikt_dump import build_index, TitleIndex
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PAGE = """  <page>
+    <title>{title}</title>
+    <ns>{ns}</ns>
+    <id>{id}</id>{redirect}
+    <revision>
+      <id>{id}0</id>
+      <text bytes="{nbytes}" xml:space="preserve">{text}</text>
+    </revision>
+  </page>
+"""
+
+# (title, namespace, text, redirect target)
+PAGES = [
+    ('dumbass', 0, "==English==\n===Noun===\n# A stupid person.", None),
+    ('fuckwit', 0, "==English==\n===Noun===\n# An idiot.\n\n==Tok Pisin==\n...", None),
+    ('café', 0, "==English==\n===Noun===\n# A coffee shop.\n\n==French==\n...", None),
+    ('Trumptard', 0, "==English==\n===Noun===\n# (derogatory) ...", None),
+    # Only has a German section
+    ('dorkwad', 0, "==German==\n===Noun===\n# ...", None),
+    ('dumb-ass', 0, "#REDIRECT [[dumbass]]", 'dumbass'),
+    # Not an entry, though it has an English section
+    ('Appendix:jerkface', 100, "==English==\nA list of insults.", None),
+    ('douchebag', 0, "{{also|douche bag}}\n==English==\n===Noun===\n# A jerk.", None),
+]
+
+def write_dump(path):
+    pages = []
+    for i, (title, ns, text, target) in enumerate(PAGES, 1):
+        redirect = f'\n    <redirect title="{target}" />' if target else ''
+        pages.append(PAGE.format(title=title, ns=ns, id=i, redirect=redirect,
+                text=text, nbytes=len(text.encode('utf-8'))))
+    xml = ('<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" version="0.10" xml:lang="en">\n'
+            '  <siteinfo><sitename>Wiktionary</sitename></siteinfo>\n'
+            + ''.join(pages) + '</mediawiki>\n')
+    with bz2.open(path, 'wt', encoding='utf-8') as f:
+        f.write(xml)
+
+@pytest.fixture
+def index_path(tmp_path):
+    dump = str(tmp_path / 'enwiktionary-test-pages-articles.xml.bz2')
+    write_dump(dump)
+    path = str(tmp_path / 'wikt_titles.idx')
+    assert build_index(dump, path) == 5
+    return path
+
+def test_index_contents(index_path):
+    with open(index_path, 'rb') as f:
+        titles = f.read().split(b'\n')
+    # Sorted by utf-8 bytes
+    assert titles == [b'Trumptard', 'café'.encode('utf-8'), b'douchebag', b'dumbass', b'fuckwit']
+
+@pytest.mark.parametrize('title, present', [
+    # First and last
+    ('Trumptard', True),
+    ('fuckwit', True),
+    ('café', True),
+    ('dumbass', True),
+    ('douchebag', True),
+    # Misses before the first, after the last, and in between
+    ('Aardvark', False),
+    ('zounds', False),
+    ('cafe', False),
+    ('dumbas', False),
+    ('dumbasses', False),
+    ('trumptard', False),
+    # Non-English, redirect, and non-main namespace pages
+    ('dorkwad', False),
+    ('dumb-ass', False),
+    ('Appendix:jerkface', False),
+    ('jerkface', False),
+    ('', False),
+])
+def test_lookup(index_path, title, present):
+    index = TitleIndex(index_path)
+    try:
+        assert (title in index) == present
+    finally:
+        index.close()
+
+def test_empty_index(tmp_path):
+    path = str(tmp_path / 'empty.idx')
+    open(path, 'wb').close()
+    index = TitleIndex(path)
+    assert 'dumbass' not in index
+    index.close()
+
+def test_wikt_index_option(index_path, tmp_path):
+    counts = tmp_path / 'counts.csv'
+    pd.DataFrame(dict(
+        pre=['dumb', 'dork', 'trump', 'fuck', 'douche'],
+        suff=['ass', 'wad', 'tard', 'wit', 'bag'],
+        count=[10, 5, 3, 2, 1],
+    )).to_csv(counts, index=False)
+    out = tmp_path / 'wikt.csv'
+    subprocess.run([sys.executable, os.path.join(REPO, 'wikt.py'), str(counts), str(out), '--index', index_path],
+            cwd=tmp_path, check=True, capture_output=True)
+    df = pd.read_csv(out)
+    assert list(df.pre + df.suff) == ['dumbass', 'dorkwad', 'trumptard', 'fuckwit', 'douchebag']
+    # trump- terms are looked up capitalized
+    assert list(df.wikt) == [True, False, True, True, True]
@@ -21,10 +21,10 @@ def all_compounds():
     return [pre+suff for (pre, suff) in itertools.product(prefixes, suffixes)]
 
 BLOGDIR = os.path.expanduser("~/src/colinmorris.github.com/assets/compound_curses/")
-def savefig(fig, name, **kwargs):
+def savefig(fig, name, dirname=BLOGDIR, **kwargs):
     if '.' not in name:
         name += '.png'
-    path = os.path.join(BLOGDIR, name)
+    path = os.path.join(dirname, name)
     # Default to doubling dpi to make these less squinty
     kws = kwargs.copy()
     if 'dpi' not in kwargs:
@@ -1,13 +1,31 @@
+import os
 import sys
 import time
 import itertools
+import sqlite3
+import threading
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from wiktionaryparser import WiktionaryParser
 import pandas as pd
 
 from reddit_counts import prefixes, suffixes
+from wikt_dump import TitleIndex
+
+# Can be overridden to point at a local stand-in server for testing. Should
+# have a {} placeholder for the word.
+WIKTIONARY_URL = os.environ.get('WIKTIONARY_URL')
+
+# WiktionaryParser keeps per-fetch state on the instance, so each thread gets its own.
+_local = threading.local()
+def get_parser():
+    if not hasattr(_local, 'parser'):
+        _local.parser = WiktionaryParser()
+        if WIKTIONARY_URL:
+            _local.parser.url = WIKTIONARY_URL
+    return _local.parser
 
-parser = WiktionaryParser()
 """
 Seems like this returns a pseudo-Json object, in the form of a 
 list of dictionaries, each dict having keys like
@@ -19,12 +37,17 @@ If the word doesn't exist, then it returns the following empty shell:
   'definitions': [],
   'pronunciations': {'text': [], 'audio': []}}]
 """
-fetch = lambda w: parser.fetch(w)
+fetch = lambda w: get_parser().fetch(w)
 
-def exists(w):
+def lookup_form(w):
+    """Return the title under which we should look up the given term."""
     # Special case: we'll search for capitalized versions of "trump-" prefixed terms.
     if w.startswith('trump'):
         w = w.capitalize()
+    return w
+
+def exists(w):
+    w = lookup_form(w)
     dat = fetch(w)
     if len(dat) != 1:
         sys.stderr.write(f"WARNING: Got unexpected results length of {len(dat)} for term {w}.\n")
@@ -34,50 +57,135 @@ def exists(w):
             return False
     return len(dat[0]['definitions']) > 0
 
-def checkrow(row):
-    word = row.pre + row.suff
-    return exists(word)
+CACHE_PATH = 'wikt_cache.sqlite'
+# Max number of simultaneous requests to wiktionary
+DEFAULT_MAX_WORKERS = 8
+
+class WiktCache:
+    """Persistent cache of wiktionary lookups, mapping term to whether it has
+    an entry (and when we checked). Negative results are cached too.
+    """
+
+    def __init__(self, path=CACHE_PATH):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS wikt (
+            term TEXT PRIMARY KEY,
+            exists_ INTEGER NOT NULL,
+            fetched_at REAL NOT NULL
+        )""")
+
+    def get_many(self, terms):
+        """Return a dict mapping each of the given terms that's in the cache to
+        whether it exists.
+        """
+        found = {}
+        terms = list(terms)
+        # Stay under sqlite's limit on number of query params
+        chunk = 500
+        for i in range(0, len(terms), chunk):
+            batch = terms[i:i+chunk]
+            qmarks = ','.join('?' * len(batch))
+            rows = self.conn.execute(f"SELECT term, exists_ FROM wikt WHERE term IN ({qmarks})", batch)
+            found.update((term, bool(ex)) for term, ex in rows)
+        return found
 
-def add_wikt_column(df):
+    def put(self, term, exists):
+        self.conn.execute("INSERT OR REPLACE INTO wikt VALUES (?, ?, ?)", (term, int(exists), time.time()))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+def exists_many(terms, cache=None, max_workers=DEFAULT_MAX_WORKERS):
+    """Return a dict mapping each of the given terms to whether it has a
+    wiktionary entry. Terms not found in the given cache are looked up
+    concurrently, using up to max_workers threads, and added to the cache.
+    """
+    terms = list(dict.fromkeys(terms))
+    results = cache.get_many(terms) if cache else {}
+    missing = [term for term in terms if term not in results]
+    if missing:
+        sys.stderr.write(f"Fetching {len(missing)} terms from wiktionary ({len(results)} cached).\n")
+    with ThreadPoolExecutor(max_workers) as pool:
+        futures = {pool.submit(exists, term): term for term in missing}
+        try:
+            for i, future in enumerate(as_completed(futures)):
+                term = futures[future]
+                results[term] = future.result()
+                if cache:
+                    cache.put(term, results[term])
+                    if i % 100 == 0:
+                        cache.commit()
+        finally:
+            if cache:
+                cache.commit()
+    return results
+
+def add_wikt_column(df, cache=None, max_workers=DEFAULT_MAX_WORKERS, index=None):
     """Add a boolean column to given df indicating whether given term has a wiktionary entry.
+
+    If index (a wikt_dump.TitleIndex) is given, check against that rather than
+    fetching from wiktionary.
     """
     col_name = 'wikt'
     assert col_name not in df.columns
-    df.loc[:, col_name] = df.apply(checkrow, axis=1)
+    terms = df.pre + df.suff
+    if index is not None:
+        df.loc[:, col_name] = [lookup_form(term) in index for term in terms]
+        return
+    results = exists_many(terms, cache, max_workers)
+    df.loc[:, col_name] = terms.map(results)
 
 def main():
     t0 = time.time()
-    try:
-        fname = sys.argv[1]
-    except IndexError:
-        print(f"Usage: {sys.argv[0]} INPUT_CSV [OUT_FNAME]")
-        sys.exit(1)
-    try:
-        outname = sys.argv[2]
-    except IndexError:
-        outname = 'wikt.csv'
+    argparser = argparse.ArgumentParser(description="Add a column to a csv of counts recording which terms have a wiktionary entry")
+    argparser.add_argument('input_csv')
+    argparser.add_argument('out_fname', nargs='?', default='wikt.csv')
+    argparser.add_argument('--index', metavar='PATH',
+            help="Check terms against a local index built by wikt_dump.py, rather than fetching them from wiktionary",
+    )
+    args = argparser.parse_args()
+    fname = args.input_csv
 
     sep = '\t' if fname.endswith('.tsv') else ','
     df = pd.read_csv(fname, sep=sep)
-    add_wikt_column(df)
-    df.to_csv(outname, index=False)
+    if args.index:
+        index = TitleIndex(args.index)
+        add_wikt_column(df, index=index)
+        index.close()
+    else:
+        cache = WiktCache()
+        try:
+            add_wikt_column(df, cache)
+        finally:
+            cache.close()
+    df.to_csv(args.out_fname, index=False)
     elapsed = time.time() - t0
     print(f"Finished in {elapsed:.1f} seconds.")
 
 def main2():
     extant_fname = 'wikt.csv'
     df = pd.read_csv(extant_fname)
+    extant = {(pre, suff): wikt for pre, suff, wikt in zip(df.pre, df.suff, df.wikt)}
+    assert len(extant) == len(df)
+    pairs = list(itertools.product(prefixes, suffixes))
+    to_fetch = [pre + suff for (pre, suff) in pairs
+            if (pre, suff) not in extant or pre == 'trump'] # XXX
+    cache = WiktCache()
+    try:
+        fetched = exists_many(to_fetch, cache)
+    finally:
+        cache.close()
     # Header
     print("pre,suff,wikt")
-    for (pre, suff) in itertools.product(prefixes, suffixes):
-        extant = df.loc[(df.pre == pre) & (df.suff == suff)]
-        assert len(extant) <= 1
-        if len(extant) == 1 and pre != 'trump': # XXX
-            wikt = extant.iloc[0].wikt
+    for (pre, suff) in pairs:
+        if (pre, suff) in extant and pre != 'trump': # XXX
+            wikt = extant[(pre, suff)]
         else:
-            term = pre + suff
-            sys.stderr.write(f"Fetching term {term}\n")
-            wikt = exists(term)
+            wikt = fetched[pre + suff]
         print(f"{pre},{suff},{wikt}")
 
 if __name__ == '__main__':
@@ -0,0 +1,101 @@
+"""Offline index of English Wiktionary entries, built from a local xml dump
+(e.g. enwiktionary-latest-pages-articles.xml.bz2 from dumps.wikimedia.org).
+
+    python wikt_dump.py enwiktionary-latest-pages-articles.xml.bz2 wikt_titles.idx
+
+streams through the dump and writes the titles of all main namespace pages
+having an English section to an index file: the titles, utf-8 encoded, sorted
+and newline-separated. TitleIndex memory-maps this file and checks membership
+with a binary search, so lookups need neither the network nor loading the
+index into memory. See wikt.py for how it's used.
+"""
+import bz2
+import sys
+import mmap
+import xml.etree.ElementTree as ET
+
+ENGLISH_HEADER = '==English=='
+
+def _local(tag):
+    """Strip the namespace from an element tag."""
+    return tag.rsplit('}', 1)[-1]
+
+def iter_english_titles(dump_path):
+    """Yield the title of each article in the given (optionally bz2 compressed)
+    Wiktionary xml dump which has an English section.
+    """
+    opener = bz2.open if dump_path.endswith('.bz2') else open
+    with opener(dump_path, 'rb') as f:
+        context = ET.iterparse(f, events=('start', 'end'))
+        _, root = next(context)
+        title = ns = None
+        for event, elem in context:
+            if event != 'end':
+                continue
+            tag = _local(elem.tag)
+            if tag == 'title':
+                title = elem.text
+            elif tag == 'ns':
+                ns = elem.text
+            elif tag == 'text':
+                if ns == '0' and elem.text and ENGLISH_HEADER in elem.text:
+                    yield title
+            elif tag == 'page':
+                title = ns = None
+                # Discard everything parsed so far, to keep memory use constant
+                root.clear()
+
+def build_index(dump_path, index_path):
+    """Write an index of the English titles in the given dump. Return the
+    number of titles written.
+    """
+    # Sort by utf-8 bytes, which is the order TitleIndex's binary search expects
+    titles = sorted(set(title.encode('utf-8') for title in iter_english_titles(dump_path)))
+    with open(index_path, 'wb') as f:
+        f.write(b'\n'.join(titles))
+    return len(titles)
+
+class TitleIndex:
+    """Set-like view of the titles in an index file written by build_index."""
+
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        try:
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Can't mmap an empty file
+            self.mm = b''
+
+    def __contains__(self, title):
+        key = title.encode('utf-8')
+        mm = self.mm
+        lo, hi = 0, len(mm)
+        # Invariant: key, if present, is on a line starting in [lo, hi)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = mm.rfind(b'\n', 0, mid) + 1
+            end = mm.find(b'\n', start)
+            if end == -1:
+                end = len(mm)
+            line = mm[start:end]
+            if line == key:
+                return True
+            if line < key:
+                lo = end + 1
+            else:
+                hi = start
+        return False
+
+    def close(self):
+        if isinstance(self.mm, mmap.mmap):
+            self.mm.close()
+        self.f.close()
+
+if __name__ == '__main__':
+    try:
+        dump_path, index_path = sys.argv[1:3]
+    except ValueError:
+        print(f"Usage: {sys.argv[0]} DUMP_PATH INDEX_PATH")
+        sys.exit(1)
+    n = build_index(dump_path, index_path)
+    print(f"Wrote {n} English titles to {index_path}")